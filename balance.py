@@ -0,0 +1,94 @@
+from __future__ import annotations
+import torch
+import dgl
+
+def seed_costs(graph: dgl.DGLGraph, fanouts: list[int]) -> torch.Tensor:
+    """Expected number of edges a seed contributes to the top block (blocks[0], the P3 first layer).
+
+    cost_0(v) = min(deg(v), fanouts[0]) edges are sampled into v at the input layer;
+    one layer down, u samples min(deg(u), f) of its deg(u) in-neighbors, so
+    cost_i(u) = min(deg(u), fanouts[i]) / deg(u) * sum of cost_{i-1} over the in-neighbors of u.
+    """
+    deg = graph.in_degrees().float()
+    cost = deg.clamp(max=fanouts[0])
+    if len(fanouts) == 1:
+        return cost
+    src, dst = graph.adj_tensors('coo')
+    src = src.long()
+    dst = dst.long()
+    for fanout in fanouts[1:]:
+        cost = torch.zeros_like(cost).index_add_(0, dst, cost[src]) * (deg.clamp(max=fanout) / deg.clamp(min=1))
+    return cost
+
+class BalancedAssigner:
+    """Assigns the train seeds to ranks so every rank's minibatch has a similar top block.
+
+    Every epoch the seeds are shuffled (same generator on every rank) and cut into global
+    batches of batch_size * world_size seeds. Within a global batch the seeds are sorted by
+    cost and dealt to the ranks in snake order (0 .. W-1, W-1 .. 0, ...), so every rank gets
+    batch_size seeds and close to 1 / W of the batch's expected edges.
+    """
+    def __init__(self, seeds: torch.Tensor, costs: torch.Tensor, batch_size: int, rank: int, world_size: int, seed: int = 0):
+        self.seeds = seeds.to('cpu')
+        self.costs = costs.to('cpu').float()
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        positions = torch.arange(batch_size * world_size)
+        round_idx = positions // world_size
+        slot = positions % world_size
+        snake = torch.where(round_idx % 2 == 0, slot, world_size - 1 - slot)
+        self.columns = (snake == rank).nonzero().flatten() # positions of this rank in a cost-sorted global batch
+
+    def num_batches(self) -> int:
+        return int(self.seeds.shape[0] / (self.batch_size * self.world_size))
+
+    def next_epoch(self) -> torch.Tensor:
+        # this rank's seeds of the next epoch, batch after batch (batch_size seeds each)
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        global_size = self.batch_size * self.world_size
+        num_batches = self.num_batches()
+        perm = torch.randperm(self.seeds.shape[0], generator=generator)[:num_batches * global_size].view(num_batches, global_size)
+        order = torch.argsort(self.costs[perm], dim=1, descending=True)
+        perm = torch.gather(perm, 1, order)
+        return self.seeds[perm[:, self.columns].flatten()]
+
+class BalancedBatchLoader:
+    """Minibatches of a BalancedAssigner, sampled with a dgl sampler.
+
+    Stands in for the dgl DataLoader (num_workers=0) with the same topo handling:
+    gpu: the graph is moved to the device, uva: the graph is pinned, cpu: sampled on the host.
+    """
+    def __init__(self, assigner: BalancedAssigner, graph: dgl.DGLGraph, sampler, device: torch.device, topo: str):
+        self.assigner = assigner
+        self.sampler = sampler
+        self.device = device
+        self.topo = topo
+        if topo == 'gpu':
+            graph = graph.to(device)
+        elif topo == 'uva':
+            graph.pin_memory_()
+        self.graph = graph
+        self.seeds: torch.Tensor = None
+        self.batch_idx = 0
+
+    def __len__(self) -> int:
+        return self.assigner.num_batches()
+
+    def __iter__(self):
+        seeds = self.assigner.next_epoch()
+        self.seeds = seeds if self.topo == 'cpu' else seeds.to(self.device)
+        self.batch_idx = 0
+        return self
+
+    def __next__(self):
+        if self.batch_idx == len(self):
+            raise StopIteration
+        batch_size = self.assigner.batch_size
+        seeds = self.seeds[self.batch_idx * batch_size : (self.batch_idx + 1) * batch_size]
+        self.batch_idx += 1
+        input_nodes, output_nodes, blocks = self.sampler.sample(self.graph, seeds)
+        return input_nodes.to(self.device), output_nodes.to(self.device), [block.to(self.device) for block in blocks]
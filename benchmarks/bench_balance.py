@@ -0,0 +1,74 @@
+# Benchmark: per-iteration imbalance of the P3 first layer, random seed split vs balance.BalancedAssigner
+# Simulates world_size ranks in one process: every iteration samples the minibatch of every rank,
+# times the first layer (SAGEConv on the top block with in_feats / world_size input columns) of every
+# rank and takes the slowest rank as the iteration's critical path
+# Example: python3 benchmarks/bench_balance.py --graph_name ogbn-products --nprocs 4
+import os
+import sys
+import time
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import dgl
+from dgl.nn.pytorch.conv import SAGEConv
+from preprocess import load_dataset
+from balance import seed_costs, BalancedAssigner
+
+def random_batches(seeds: torch.Tensor, batch_size: int, world_size: int, num_iters: int) -> list[list[torch.Tensor]]:
+    # DGL's ddp split: a random permutation cut into equal shards, each shard batched in order
+    seeds = seeds[torch.randperm(seeds.shape[0])]
+    step = int(seeds.shape[0] / world_size)
+    shards = [seeds[rank * step : (rank + 1) * step] for rank in range(world_size)]
+    return [[shard[it * batch_size : (it + 1) * batch_size] for shard in shards] for it in range(num_iters)]
+
+def balanced_batches(seeds: torch.Tensor, costs: torch.Tensor, batch_size: int, world_size: int, num_iters: int) -> list[list[torch.Tensor]]:
+    rank_seeds = [BalancedAssigner(seeds, costs, batch_size, rank, world_size).next_epoch() for rank in range(world_size)]
+    return [[rank_seeds[rank][it * batch_size : (it + 1) * batch_size] for rank in range(world_size)] for it in range(num_iters)]
+
+def run(graph, sampler, conv, feat, batches) -> tuple[list[float], list[float]]:
+    # returns the critical path (ms) and the max / mean top block edges of every iteration
+    critical = []
+    edge_ratio = []
+    for rank_batches in batches:
+        times = []
+        edges = []
+        for seeds in rank_batches:
+            input_nodes, _, blocks = sampler.sample(graph, seeds)
+            start = time.perf_counter()
+            with torch.no_grad():
+                conv(blocks[0], feat[input_nodes.long()])
+            times.append((time.perf_counter() - start) * 1e3)
+            edges.append(blocks[0].num_edges())
+        critical.append(max(times))
+        edge_ratio.append(max(edges) / statistics.mean(edges))
+    return critical, edge_ratio
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='seed balancing benchmark')
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--nprocs', default=4, type=int, help='Number of simulated ranks')
+    parser.add_argument('--batch_size', default=1024, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--hid_feats', default=256, type=int)
+    args = parser.parse_args()
+    project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    data_dir = os.path.join(project_dir, "dataset")
+
+    timings = {}
+    graph, _, idx_split, _, feat, _ = load_dataset(args.graph_name, data_dir, timings, use_cache=True)
+    fanouts = [20, 20, 20]
+    sampler = dgl.dataloading.NeighborSampler(fanouts)
+    local_width = max(feat.shape[1] // args.nprocs, 1)
+    feat = feat[:, :local_width] # the column slice of one rank
+    conv = SAGEConv(in_feats=local_width, out_feats=args.hid_feats, aggregator_type='mean')
+    train_nids = idx_split['train']
+    costs = seed_costs(graph, fanouts)[train_nids.long()]
+    num_iters = min(args.iters, int(train_nids.shape[0] / (args.batch_size * args.nprocs)))
+
+    print(f"graph={args.graph_name} ranks={args.nprocs} batch_size={args.batch_size} iters={num_iters}")
+    for name, batches in [("random", random_batches(train_nids, args.batch_size, args.nprocs, num_iters)),
+                          ("balanced", balanced_batches(train_nids, costs, args.batch_size, args.nprocs, num_iters))]:
+        critical, edge_ratio = run(graph, sampler, conv, feat, batches)
+        print(f"{name:>9}: critical path mean {statistics.mean(critical):8.2f} ms | stdev {statistics.stdev(critical):7.2f} ms"
+              f" | max/mean top block edges {statistics.mean(edge_ratio):6.3f}")
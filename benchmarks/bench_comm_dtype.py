@@ -0,0 +1,153 @@
+# Benchmark: bytes on the wire and numerical error of the P2 / P3 wire formats (--comm_dtype / --comm_row_scale)
+# Replays the three P2 / P3 transfers on random data:
+#   shuffle: P3 first-layer reduction of [num_dst, hid] partial activations (comm.OverlappedReduce)
+#   grad:    P3 backward all_gather of [num_dst, hid] gradients
+#   feat:    P2 exchange of [num_input, local_width] feature slices
+# Error is the relative L2 error against the float32 transfer.
+# Accuracy: a two-layer classifier trained on a synthetic dataset (class means plus noise) with the P2 transfer
+# (input features) or the P3 transfers (first-layer output forward, its gradient backward) passed through the
+# wire format, val accuracy and delta against float32 per setting.
+# End-to-end accuracy impact: compare val_acc of run.py with and without --comm_dtype.
+# Example: python3 benchmarks/bench_comm_dtype.py --nprocs 4 --device cpu
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from comm import OverlappedReduce, WireCodec, WIRE_DTYPES, all_gather_var, wire_stats
+
+SETTINGS = [("float32", False), ("float16", False), ("float16", True), ("bfloat16", False), ("bfloat16", True)]
+
+class WireRoundTrip(torch.autograd.Function):
+    # encode + decode of the forward tensor and, with grad, of its gradient
+    @staticmethod
+    def forward(ctx, tensor, codec, grad):
+        ctx.codec, ctx.grad = codec, grad
+        return codec.decode(*codec.encode(tensor)).clone() # float32: decode returns the input itself
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if ctx.grad:
+            grad_output = ctx.codec.decode(*ctx.codec.encode(grad_output))
+        return grad_output, None, None
+
+def train_accuracy(codec, mode, width, hid, num_classes, num_nodes, epochs):
+    # val accuracy of a two-layer classifier, mode p2: features on the wire, p3: activations and gradients
+    gen = torch.Generator().manual_seed(0)
+    labels = torch.randint(0, num_classes, [num_nodes], generator=gen)
+    feats = torch.randn([num_classes, width], generator=gen)[labels] + 4 * torch.randn([num_nodes, width], generator=gen)
+    num_train = int(0.8 * num_nodes)
+    torch.manual_seed(0)
+    layers = torch.nn.ModuleList([torch.nn.Linear(width, hid), torch.nn.Linear(hid, num_classes)])
+    optimizer = torch.optim.Adam(layers.parameters(), lr=1e-3)
+
+    def forward(x):
+        if mode == "p2":
+            x = WireRoundTrip.apply(x, codec, False)
+        hid_feats = layers[0](x)
+        if mode == "p3":
+            hid_feats = WireRoundTrip.apply(hid_feats, codec, True)
+        return layers[1](F.relu(hid_feats))
+
+    for _ in range(epochs):
+        for batch in torch.randperm(num_train, generator=gen).split(1024):
+            loss = F.cross_entropy(forward(feats[batch]), labels[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    with torch.no_grad():
+        pred = forward(feats[num_train:]).argmax(dim=1)
+    return (pred == labels[num_train:]).float().mean().item()
+
+def run_transfers(rank, world_size, device, codec, data, iters):
+    rows, hids, grads, feats = data
+    reducer = OverlappedReduce(rank, world_size, mode="reduce", codec=codec)
+    out = {}
+    for name in ["shuffle", "grad", "feat"]:
+        wire_stats.reset()
+        start = time.perf_counter()
+        for _ in range(iters):
+            if name == "shuffle":
+                reducer.reset(rows)
+                for r in range(world_size):
+                    reducer.launch(r, hids[r])
+                result = reducer.wait().clone()
+            elif name == "grad":
+                result = [torch.empty([n, grads.shape[1]], device=device) for n in rows]
+                all_gather_var(result, grads[:rows[rank]], codec=codec)
+                result = torch.cat(result)
+            else:
+                result = [torch.empty_like(feats) for _ in range(world_size)]
+                all_gather_var(result, feats, codec=codec)
+                result = torch.cat(result)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        out[name] = (result, wire_stats.reset() / iters, (time.perf_counter() - start) / iters)
+    return out
+
+def bench(rank: int, world_size: int, device_type: str, num_dst: int, hid: int, num_input: int, width: int, iters: int):
+    backend = "nccl" if device_type == "cuda" else "gloo"
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = "12357"
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    device = torch.device("cpu")
+    if device_type == "cuda":
+        torch.cuda.set_device(rank)
+        device = torch.device(f"cuda:{rank}")
+    gen = torch.Generator().manual_seed(rank)
+    # every rank has a different number of first-layer dst nodes, like the P3 top blocks
+    rows = [num_dst + 17 * r for r in range(world_size)]
+    hids = [torch.randn([n, hid], generator=gen).to(device) for n in rows]
+    grads = (torch.randn([max(rows), hid], generator=gen) * 1e-4).to(device) # gradients are small
+    feats = torch.rand([num_input, width], generator=gen).to(device)
+    data = (rows, hids, grads, feats)
+
+    reference = run_transfers(rank, world_size, device, WireCodec(None), data, 1)
+    results = []
+    for dtype_name, row_scale in SETTINGS:
+        codec = WireCodec(WIRE_DTYPES[dtype_name], row_scale=row_scale)
+        out = run_transfers(rank, world_size, device, codec, data, iters)
+        for name, (result, sent, latency) in out.items():
+            ref = reference[name][0]
+            err = ((result - ref).norm() / ref.norm()).item()
+            results.append((f"{dtype_name}{'+scale' if row_scale else ''}", name, sent, latency, err))
+    if rank == 0:
+        print(f"world_size={world_size} backend={backend} num_dst={num_dst} hid={hid} num_input={num_input} width={width}")
+        print(f"{'wire format':>16} {'transfer':>8} {'bytes/iter':>12} {'ms/iter':>9} {'rel err':>10}")
+        for setting, name, sent, latency, err in results:
+            print(f"{setting:>16} {name:>8} {int(sent):>12} {latency * 1000:>9.3f} {err:>10.2e}")
+    dist.destroy_process_group()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='wire format benchmark')
+    parser.add_argument('--nprocs', default=4, type=int, help='Number of processes')
+    parser.add_argument('--device', default="cuda", type=str, help='cuda (nccl) or cpu (gloo)', choices=["cuda", "cpu"])
+    parser.add_argument('--num_dst', default=20000, type=int, help='First-layer dst nodes per GPU')
+    parser.add_argument('--hid_feats', default=256, type=int, help='Size of a hidden feature')
+    parser.add_argument('--num_input', default=100000, type=int, help='Input nodes per GPU (P2 feature exchange)')
+    parser.add_argument('--local_width', default=32, type=int, help='Local feature width per GPU (P2 feature exchange)')
+    parser.add_argument('--iters', default=20, type=int, help='Measured iterations')
+    parser.add_argument('--train_nodes', default=50000, type=int, help='Nodes of the synthetic accuracy comparison')
+    parser.add_argument('--train_epochs', default=10, type=int, help='Epochs of the accuracy comparison (0: skip)')
+    args = parser.parse_args()
+    world_size = args.nprocs
+    if args.device == "cuda":
+        world_size = min(world_size, torch.cuda.device_count())
+    mp.spawn(bench, args=(world_size, args.device, args.num_dst, args.hid_feats, args.num_input, args.local_width, args.iters), nprocs=world_size)
+
+    if args.train_epochs > 0:
+        width = args.local_width * world_size
+        print(f"accuracy: synthetic {args.train_nodes} nodes, width={width}, hid={args.hid_feats}, {args.train_epochs} epochs")
+        print(f"{'wire format':>16} {'p2 acc':>8} {'p2 delta':>9} {'p3 acc':>8} {'p3 delta':>9}")
+        reference = {}
+        for dtype_name, row_scale in SETTINGS:
+            codec = WireCodec(WIRE_DTYPES[dtype_name], row_scale=row_scale)
+            accs = {mode: train_accuracy(codec, mode, width, args.hid_feats, 16, args.train_nodes, args.train_epochs) for mode in ["p2", "p3"]}
+            if dtype_name == "float32":
+                reference = accs
+            print(f"{dtype_name + ('+scale' if row_scale else ''):>16} {accs['p2']:>8.4f} {accs['p2'] - reference['p2']:>+9.4f}"
+                  f" {accs['p3']:>8.4f} {accs['p3'] - reference['p3']:>+9.4f}")
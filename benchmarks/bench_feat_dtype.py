@@ -0,0 +1,100 @@
+# Benchmark: accuracy vs throughput of the feature storage dtypes (--feat_dtype float32 / float16 / int8)
+# For every storage dtype of the node feature matrix of a dataset:
+#   gather:  feat_quant.gather_rows of batches of random input nodes (gpu / uva / cpu feature extraction),
+#            rows moved in the storage dtype and converted to float32 on the device
+#   error:   relative L2 and max abs error of the gathered rows against float32
+#   probe:   val accuracy of a linear classifier trained on the gathered features (same seed and batches
+#            for every dtype), a cheap proxy of the accuracy impact of the storage precision
+# End-to-end accuracy impact: run.py with --feat_dtype logs acc_delta / speedup against the float32 log of the same run.
+# Example: python3 benchmarks/bench_feat_dtype.py --graph_name ogbn-products --feat uva
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import torch.nn.functional as F
+from dgl.utils import pin_memory_inplace
+from feat_quant import FEAT_STORAGE, QuantizedFeat, compress_feat, feat_storage, gather_rows
+from preprocess import load_dataset
+
+def storage_bytes(feat) -> int:
+    if isinstance(feat, QuantizedFeat):
+        return feat.nbytes()
+    return feat.numel() * feat.element_size()
+
+def bench_gather(feat, batches, mode, device, iters):
+    for nids in batches[:2]: # warmup
+        gather_rows(feat, nids, mode, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for it in range(iters):
+        gather_rows(feat, batches[it % len(batches)], mode, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+def probe_accuracy(feat, labels, idx_split, num_classes, mode, device, epochs, batch_size):
+    # linear classifier on the gathered (dequantized) rows
+    torch.manual_seed(0)
+    model = torch.nn.Linear(feat.shape[1], num_classes).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    train_nids, valid_nids = idx_split['train'].long(), idx_split['valid'].long()
+    gen = torch.Generator().manual_seed(0)
+    for _ in range(epochs):
+        for batch in train_nids[torch.randperm(train_nids.shape[0], generator=gen)].split(batch_size):
+            loss = F.cross_entropy(model(gather_rows(feat, batch.to(device), mode, device)), labels[batch].to(device))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    correct = 0
+    with torch.no_grad():
+        for batch in valid_nids.split(batch_size):
+            logits = model(gather_rows(feat, batch.to(device), mode, device))
+            correct += (logits.argmax(dim=1).cpu() == labels[batch]).sum().item()
+    return correct / valid_nids.shape[0]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='feature storage dtype benchmark')
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--device', default="cuda", type=str, choices=["cuda", "cpu"])
+    parser.add_argument('--feat', default="uva", type=str, help='Feature extraction: gpu, uva or cpu (cpu device: cpu only)', choices=["gpu", "uva", "cpu"])
+    parser.add_argument('--num_input', default=200000, type=int, help='Input nodes per gather (about the input nodes of a 1024 seed, 3 layer minibatch)')
+    parser.add_argument('--iters', default=50, type=int, help='Measured gathers')
+    parser.add_argument('--probe_epochs', default=5, type=int, help='Epochs of the linear probe (0: skip)')
+    parser.add_argument('--probe_batch_size', default=4096, type=int)
+    parser.add_argument('--cache', action='store_true', help='Read the preprocessed dataset from dataset/cache (see run.py --cache)')
+    args = parser.parse_args()
+    data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "dataset")
+    device = torch.device(args.device)
+    mode = args.feat if args.device == "cuda" else "cpu"
+
+    graph, labels, idx_split, num_classes, feat, _ = load_dataset(args.graph_name, data_dir, {}, use_cache=args.cache)
+    num_nodes = graph.num_nodes()
+    del graph
+    labels = labels.view(-1).long()
+    gen = torch.Generator().manual_seed(0)
+    batches = [torch.randint(0, num_nodes, [args.num_input], generator=gen).to(device if mode != "cpu" else "cpu") for _ in range(8)]
+    reference = [gather_rows(feat, nids, "cpu", device) for nids in batches[:2]]
+
+    print(f"graph={args.graph_name} nodes={num_nodes} width={feat.shape[1]} feat={mode} device={device} num_input={args.num_input}")
+    print(f"{'storage':>8} {'MB':>9} {'ms/gather':>10} {'Mrows/s':>8} {'GB/s':>7} {'rel err':>9} {'max err':>9} {'probe acc':>10}")
+    for feat_dtype in FEAT_STORAGE:
+        stored = feat if feat_dtype == "float32" else compress_feat(feat, feat_dtype)
+        pinned_handle = None
+        if mode == "uva":
+            pinned_handle = pin_memory_inplace(feat_storage(stored))
+        elif mode == "gpu":
+            stored = stored.to(device)
+        latency = bench_gather(stored, batches, mode, device, args.iters)
+        rows = [gather_rows(stored, nids, mode, device) for nids in batches[:2]]
+        rel_err = max(((row - ref).norm() / ref.norm()).item() for row, ref in zip(rows, reference))
+        max_err = max((row - ref).abs().max().item() for row, ref in zip(rows, reference))
+        acc = float("nan")
+        if args.probe_epochs > 0:
+            acc = probe_accuracy(stored, labels, idx_split, num_classes, mode, device, args.probe_epochs, args.probe_batch_size)
+        row_bytes = feat_storage(stored).shape[1] * feat_storage(stored).element_size()
+        print(f"{feat_dtype:>8} {storage_bytes(stored) / 2**20:>9.1f} {latency * 1000:>10.3f} {args.num_input / latency / 1e6:>8.2f}"
+              f" {args.num_input * row_bytes / latency / 1e9:>7.2f} {rel_err:>9.2e} {max_err:>9.2e} {acc:>10.4f}")
+        del stored, pinned_handle
@@ -0,0 +1,56 @@
+# Benchmark: cpu minibatch sampling, dgl.dataloading.NeighborSampler vs sampler.CSCNeighborSampler
+# Both sample the same random seed batches from the preprocessed (cached) int32 graph
+# Example: python3 benchmarks/bench_sampler.py --graph_name ogbn-products --threads 1 4 8
+import os
+import sys
+import time
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import dgl
+from preprocess import load_dataset
+from sampler import CSCNeighborSampler
+
+def bench(graph: dgl.DGLGraph, sampler, seed_batches: list[torch.Tensor], warmup: int) -> tuple[list[float], float, float]:
+    for seeds in seed_batches[:warmup]:
+        sampler.sample(graph, seeds)
+    latency = []
+    input_nodes = []
+    edges = []
+    for seeds in seed_batches[warmup:]:
+        start = time.perf_counter()
+        _input_nodes, _, blocks = sampler.sample(graph, seeds)
+        latency.append((time.perf_counter() - start) * 1e3)
+        input_nodes.append(_input_nodes.shape[0])
+        edges.append(sum(block.num_edges() for block in blocks))
+    return latency, statistics.mean(input_nodes), statistics.mean(edges)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='neighbor sampler benchmark')
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--batch_size', default=1024, type=int)
+    parser.add_argument('--iters', default=50, type=int)
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--threads', default=[1, 4], type=int, nargs='+', help='Thread counts of the csc sampler')
+    args = parser.parse_args()
+    project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    data_dir = os.path.join(project_dir, "dataset")
+
+    timings = {}
+    graph, _, idx_split, _, _, _ = load_dataset(args.graph_name, data_dir, timings, use_cache=True)
+    graph = graph.formats("csc")
+    fanouts = [20, 20, 20]
+    train_nids = idx_split['train']
+    seed_batches = [train_nids[torch.randperm(train_nids.shape[0])[:args.batch_size]] for _ in range(args.warmup + args.iters)]
+
+    samplers = [("dgl", dgl.dataloading.NeighborSampler(fanouts))]
+    for num_threads in args.threads:
+        samplers.append((f"csc x{num_threads}", CSCNeighborSampler(fanouts, num_threads=num_threads)))
+    print(f"graph={args.graph_name} fanouts={fanouts} batch_size={args.batch_size} iters={args.iters} torch_threads={torch.get_num_threads()}")
+    for name, sampler in samplers:
+        latency, input_nodes, edges = bench(graph, sampler, seed_batches, args.warmup)
+        latency.sort()
+        p95 = latency[int(0.95 * (len(latency) - 1))]
+        print(f"{name:>8}: mean {statistics.mean(latency):8.2f} ms | p50 {statistics.median(latency):8.2f} ms | p95 {p95:8.2f} ms"
+              f" | input nodes {input_nodes:10.1f} | edges {edges:10.1f}")
@@ -0,0 +1,57 @@
+# Benchmark: minibatch frontier size under random vs locality-aware train seed assignment
+# Samples minibatches of every rank's seeds (single process, no communication) and reports the
+# mean number of unique input nodes and edges per minibatch, and the reduction of locality vs random
+# Example: python3 benchmarks/bench_seed_partition.py --graph_name ogbn-products --nprocs 4
+import os
+import sys
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import dgl
+from preprocess import load_dataset
+from partition import load_clusters, locality_partition
+
+def random_partition(nids: torch.Tensor, world_size: int) -> list[torch.Tensor]:
+    # what DGL's use_ddp split does: a random permutation cut into equal slices
+    nids = nids[torch.randperm(nids.shape[0])]
+    step = int(nids.shape[0] / world_size)
+    return [nids[rank * step : (rank + 1) * step] for rank in range(world_size)]
+
+def frontier_stats(graph: dgl.DGLGraph, sampler, parts: list[torch.Tensor], batch_size: int, num_batches: int) -> tuple[float, float]:
+    input_nodes = []
+    edges = []
+    for seeds in parts:
+        seeds = seeds[torch.randperm(seeds.shape[0])] # reshuffled within the partition
+        for idx in range(min(num_batches, int(seeds.shape[0] / batch_size))):
+            batch = seeds[idx * batch_size : (idx + 1) * batch_size]
+            _input_nodes, _, blocks = sampler.sample(graph, batch)
+            input_nodes.append(_input_nodes.shape[0])
+            edges.append(sum(block.num_edges() for block in blocks))
+    return statistics.mean(input_nodes), statistics.mean(edges)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='seed partition frontier benchmark')
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--nprocs', default=4, type=int, help='Number of ranks the seeds are split across')
+    parser.add_argument('--batch_size', default=1024, type=int)
+    parser.add_argument('--num_batches', default=16, type=int, help='Minibatches sampled per rank')
+    args = parser.parse_args()
+    project_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    data_dir = os.path.join(project_dir, "dataset")
+
+    timings = {}
+    graph, _, idx_split, _, _, _ = load_dataset(args.graph_name, data_dir, timings, use_cache=True)
+    sampler = dgl.dataloading.NeighborSampler([20, 20, 20])
+    clusters = load_clusters(graph, os.path.join(data_dir, "partition"), args.graph_name)
+    train_nids = idx_split['train']
+
+    results = {}
+    for name, parts in [("random", random_partition(train_nids, args.nprocs)),
+                        ("locality", locality_partition(train_nids, clusters, args.nprocs))]:
+        results[name] = frontier_stats(graph, sampler, parts, args.batch_size, args.num_batches)
+    print(f"graph={args.graph_name} ranks={args.nprocs} batch_size={args.batch_size}")
+    for name, (input_nodes, edges) in results.items():
+        print(f"{name:>9}: input nodes {input_nodes:12.1f} | edges {edges:12.1f}")
+    (rand_nodes, rand_edges), (loc_nodes, loc_edges) = results["random"], results["locality"]
+    print(f"reduction: input nodes {1 - loc_nodes / rand_nodes:.1%} | edges {1 - loc_edges / rand_edges:.1%}")
@@ -0,0 +1,67 @@
+# Microbenchmark: per-iteration latency of the size exchange done before every P2 / P3 minibatch
+# Compares dist.all_gather_object (pickled python tuples) against comm.SizeExchange
+# (one all_gather into a preallocated int64 tensor)
+# Example: python3 benchmarks/bench_size_exchange.py --nprocs 8 --device cpu
+import os
+import sys
+import time
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from comm import SizeExchange
+
+def bench(rank: int, world_size: int, device_type: str, iters: int, warmup: int):
+    backend = "nccl" if device_type == "cuda" else "gloo"
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = "12356"
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    device = torch.device("cpu")
+    if device_type == "cuda":
+        torch.cuda.set_device(rank)
+        device = torch.device(f"cuda:{rank}")
+
+    size_lst = [(0, 0, 0, 0)] * world_size
+    def object_step(i):
+        size_lst[rank] = (rank, i + rank, 2 * i + rank, 3 * i + rank)
+        dist.all_gather_object(object_list=size_lst, obj=size_lst[rank])
+        return size_lst
+
+    size_exchange = SizeExchange(world_size, 3, device)
+    def tensor_step(i):
+        return size_exchange.exchange(i + rank, 2 * i + rank, 3 * i + rank)
+
+    results = {}
+    for name, step in [("all_gather_object", object_step), ("SizeExchange", tensor_step)]:
+        for i in range(warmup):
+            step(i)
+        dist.barrier()
+        latency = []
+        for i in range(iters):
+            start = time.perf_counter()
+            sizes = step(i)
+            latency.append((time.perf_counter() - start) * 1e6)
+        assert(sizes[world_size - 1][-1] == 3 * (iters - 1) + world_size - 1)
+        results[name] = latency
+
+    if rank == 0:
+        print(f"world_size={world_size} backend={backend} iters={iters}")
+        for name, latency in results.items():
+            latency.sort()
+            p95 = latency[int(0.95 * (len(latency) - 1))]
+            print(f"{name:>18}: mean {statistics.mean(latency):8.1f} us | p50 {statistics.median(latency):8.1f} us | p95 {p95:8.1f} us")
+    dist.destroy_process_group()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='size exchange microbenchmark')
+    parser.add_argument('--nprocs', default=4, type=int, help='Number of processes')
+    parser.add_argument('--device', default="cuda", type=str, help='cuda (nccl) or cpu (gloo)', choices=["cuda", "cpu"])
+    parser.add_argument('--iters', default=1000, type=int, help='Measured iterations')
+    parser.add_argument('--warmup', default=50, type=int, help='Warmup iterations')
+    args = parser.parse_args()
+    world_size = args.nprocs
+    if args.device == "cuda":
+        world_size = min(world_size, torch.cuda.device_count())
+    mp.spawn(bench, args=(world_size, args.device, args.iters, args.warmup), nprocs=world_size)
@@ -0,0 +1,161 @@
+# Benchmark harness: sweeps run.py over a matrix of settings and aggregates the TrainProfiler logs
+# Every point of mode x world size x batch size x hidden size x fanouts x model x feat:topo placement
+# is one run.py process training warmup + epochs epochs with its own --log_dir; the rows of the measured
+# epochs are aggregated into one table: median / p95 epoch time, median throughput (training seeds / second
+# over all the processes) and median comm_bytes per epoch (bytes a rank hands to collectives: the DDP
+# gradient allreduce of every mode, plus the P2 / P3 feature, activation and gradient exchange).
+# --graph_name synthetic needs no dataset download and, with --device cpu, no gpu (e.g. on a CI machine).
+# Output: <out>/summary.csv, <out>/sweep.json (arguments and commands) and per run <out>/<run>/ (csv log, stdout)
+# Example: python3 benchmarks/harness.py --device cpu --graph_name synthetic --modes 1 2 3 --world_sizes 2 --placements cpu:cpu
+import os
+import sys
+import csv
+import math
+import json
+import time
+import itertools
+import subprocess
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import torch
+from utils import RunConfig
+from preprocess import synthetic_name
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FIELDS = ["run", "status", "epochs", "epoch_time_median", "epoch_time_p95", "seeds_per_sec", "comm_bytes", "val_acc"]
+
+def percentile(values: list[float], q: float) -> float:
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+def run_name(mode, world_size, batch_size, hid_feats, fanouts, model, placement) -> str:
+    feat, topo = placement.split(":")
+    return f"v{mode}_w{world_size}_b{batch_size}_h{hid_feats}_f{fanouts.replace(',', 'x')}_{model}_{feat}feat_{topo}topo"
+
+def skip_reason(args, mode, world_size, placement) -> str:
+    # None: the point can run here
+    feat, topo = placement.split(":")
+    if args.device == "cpu" and (mode == 0 or feat != "cpu" or topo != "cpu"):
+        return "cpu runs need modes 1-3 and placement cpu:cpu"
+    if args.device == "cuda" and world_size > torch.cuda.device_count():
+        return f"{torch.cuda.device_count()} gpus"
+    return None
+
+def log_path(graph_name, mode, world_size, batch_size, hid_feats, placement, log_dir) -> str:
+    # the csv log run.py names with RunConfig.set_logpath; with a precision tag (--extra "--amp") the
+    # name grows, the log is the shortest csv with the name as prefix (aux csvs are <log>_<suffix>.csv)
+    config = RunConfig()
+    config.graph_name = graph_name
+    config.mode = mode
+    config.world_size = world_size
+    config.batch_size = batch_size
+    config.hid_feats = hid_feats
+    config.feat, config.topo = placement.split(":")
+    config.log_dir = log_dir
+    config.set_logpath()
+    prefix = os.path.splitext(os.path.basename(config.log_path))[0]
+    names = [name for name in os.listdir(log_dir) if name.startswith(prefix) and name.endswith(".csv")]
+    return os.path.join(log_dir, min(names, key=len)) if len(names) > 0 else config.log_path
+
+def aggregate(rows: list[dict], warmup: int) -> dict:
+    # rows: the csv rows of a run (run.py does not write epoch 0), the epochs < warmup are dropped
+    rows = [row for row in rows if int(row["epoch"]) >= warmup]
+    if len(rows) == 0:
+        return {"status": "no rows"}
+    epoch_times = [float(row["epoch_time"]) for row in rows]
+    result = {
+        "status": "ok",
+        "epochs": len(rows),
+        "epoch_time_median": statistics.median(epoch_times),
+        "epoch_time_p95": percentile(epoch_times, 95),
+        "seeds_per_sec": statistics.median(float(row["throughput"]) for row in rows) if "throughput" in rows[0] else "-",
+        "comm_bytes": int(statistics.median(float(row["comm_bytes"]) for row in rows)) if "comm_bytes" in rows[0] else "-",
+    }
+    accs = [float(row["val_acc"]) for row in rows if row.get("val_acc", "nan") != "nan"]
+    result["val_acc"] = accs[-1] if len(accs) > 0 else "-"
+    return result
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4f}" if value < 1000 else f"{value:.0f}"
+    return str(value)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='run.py sweep over modes and settings')
+    parser.add_argument('--graph_name', default="synthetic", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M', 'synthetic'])
+    parser.add_argument('--synthetic', default="100000,10,128,16", type=str, help='Random graph of --graph_name synthetic: num_nodes,avg_degree,feat_width,num_classes')
+    parser.add_argument('--device', default="cuda", type=str, choices=["cuda", "cpu"])
+    parser.add_argument('--modes', default=[1, 2, 3], type=int, nargs="+", help='run.py modes (0: Quiver, 1: DGL, 2: P2, 3: P3)')
+    parser.add_argument('--world_sizes', default=[4], type=int, nargs="+", help='Numbers of GPUs / processes')
+    parser.add_argument('--batch_sizes', default=[1024], type=int, nargs="+")
+    parser.add_argument('--hid_feats', default=[256], type=int, nargs="+")
+    parser.add_argument('--fanouts', default=["20,20,20"], type=str, nargs="+", help='Comma-separated fanouts, one value per setting, e.g. 20,20,20 10,10')
+    parser.add_argument('--models', default=["sage"], type=str, nargs="+", choices=['sage', 'gat'])
+    parser.add_argument('--placements', default=["uva:uva"], type=str, nargs="+", help='feat:topo placements, e.g. uva:uva gpu:gpu cpu:cpu')
+    parser.add_argument('--warmup', default=1, type=int, help='Epochs dropped before the measured ones (at least 1, run.py never logs epoch 0)')
+    parser.add_argument('--epochs', default=3, type=int, help='Measured epochs per run')
+    parser.add_argument('--timeout', default=3600, type=int, help='Seconds before a run is stopped')
+    parser.add_argument('--cache', action='store_true', help='Pass --cache to run.py (preprocessed dataset under dataset/cache)')
+    parser.add_argument('--out', default="", type=str, help='Output directory (default: logs/harness_<time>)')
+    parser.add_argument('--extra', default="", type=str, help='Extra run.py arguments for every run, e.g. "--prefetch --comm_dtype float16"')
+    args = parser.parse_args()
+    if args.warmup < 1:
+        parser.error("--warmup must be at least 1")
+    out_dir = args.out if args.out != "" else os.path.join(PROJECT_DIR, "logs", time.strftime("harness_%Y%m%d_%H%M%S"))
+    os.makedirs(out_dir, exist_ok=True)
+    graph_name = synthetic_name(args.synthetic) if args.graph_name == "synthetic" else args.graph_name
+
+    results = []
+    commands = {}
+    matrix = itertools.product(args.modes, args.world_sizes, args.batch_sizes, args.hid_feats, args.fanouts, args.models, args.placements)
+    for mode, world_size, batch_size, hid_feats, fanouts, model, placement in matrix:
+        name = run_name(mode, world_size, batch_size, hid_feats, fanouts, model, placement)
+        reason = skip_reason(args, mode, world_size, placement)
+        if reason is not None:
+            print(f"skip {name}: {reason}")
+            results.append({"run": name, "status": f"skipped ({reason})"})
+            continue
+        feat, topo = placement.split(":")
+        run_dir = os.path.join(out_dir, name)
+        os.makedirs(run_dir, exist_ok=True)
+        cmd = [sys.executable, os.path.join(PROJECT_DIR, "run.py"),
+               "--mode", str(mode), "--nprocs", str(world_size), "--batch_size", str(batch_size),
+               "--hid_feats", str(hid_feats), "--fanouts", fanouts, "--model", model,
+               "--feat", feat, "--topo", topo, "--device", args.device,
+               "--graph_name", args.graph_name, "--synthetic", args.synthetic,
+               "--total_epochs", str(args.warmup + args.epochs), "--eval_every", "0",
+               "--save_every", str(args.warmup + args.epochs + 1), "--log_dir", run_dir]
+        if args.cache:
+            cmd.append("--cache")
+        cmd += args.extra.split()
+        commands[name] = cmd
+        print(f"run {name}")
+        start = time.time()
+        with open(os.path.join(run_dir, "stdout.txt"), "w") as stdout:
+            try:
+                code = subprocess.run(cmd, cwd=PROJECT_DIR, stdout=stdout, stderr=subprocess.STDOUT, timeout=args.timeout).returncode
+            except subprocess.TimeoutExpired:
+                code = "timeout"
+        path = log_path(graph_name, mode, world_size, batch_size, hid_feats, placement, run_dir)
+        if code != 0 or not os.path.exists(path):
+            results.append({"run": name, "status": f"failed ({code}, see {run_dir}/stdout.txt)"})
+            continue
+        with open(path) as file:
+            result = aggregate(list(csv.DictReader(file)), args.warmup)
+        result["run"] = name
+        results.append(result)
+        print(f"  {time.time() - start:.1f}s, median epoch {format_value(result.get('epoch_time_median', '-'))}s")
+
+    with open(os.path.join(out_dir, "sweep.json"), "w") as file:
+        json.dump({"args": vars(args), "graph_name": graph_name, "commands": commands}, file, indent=1)
+    with open(os.path.join(out_dir, "summary.csv"), "w") as file:
+        writer = csv.DictWriter(file, FIELDS, restval="-")
+        writer.writeheader()
+        writer.writerows(results)
+    widths = [max([len(field)] + [len(format_value(result.get(field, "-"))) for result in results]) for field in FIELDS]
+    print(" ".join(field.rjust(width) for field, width in zip(FIELDS, widths)))
+    for result in results:
+        print(" ".join(format_value(result.get(field, "-")).rjust(width) for field, width in zip(FIELDS, widths)))
+    print("summary:", os.path.join(out_dir, "summary.csv"))
@@ -0,0 +1,143 @@
+from __future__ import annotations
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+import dgl
+
+def snapshot(obj):
+    # detached cpu copy of every tensor in a (nested) state dict, safe to write while training goes on
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+def reseed_dgl() -> int:
+    # dgl's sampling rng has no state getter: it is reseeded with a draw from the torch generator
+    seed = int(torch.randint(0, 2**31 - 1, [1]).item())
+    dgl.seed(seed)
+    return seed
+
+def rng_state(device: torch.device) -> dict:
+    # reseeds dgl: the state is taken before the draw, so set_rng_state replays the same seed
+    state = {"torch": torch.get_rng_state(), "python": random.getstate(), "numpy": np.random.get_state()}
+    if device.type == 'cuda':
+        state["cuda"] = torch.cuda.get_rng_state(device)
+    state["dgl"] = reseed_dgl()
+    return state
+
+def set_rng_state(state: dict, device: torch.device):
+    torch.set_rng_state(state["torch"])
+    random.setstate(state["python"])
+    if "numpy" in state:
+        np.random.set_state(state["numpy"])
+    if "cuda" in state and device.type == 'cuda':
+        torch.cuda.set_rng_state(state["cuda"], device)
+    if "dgl" in state:
+        reseed_dgl()
+
+class Checkpointer:
+    """Resumable checkpoints of a distributed run, written in a background thread.
+
+    A checkpoint of epoch e is one shared file written by rank 0 ({dir}/shared_e{e}.pt: the
+    data-parallel model and optimizer, the log rows) and one shard per rank ({dir}/rank{r}_e{e}.pt:
+    state that differs across ranks, e.g. the P3 local model and optimizer, and the rng state).
+    save() snapshots the state to host memory on the calling thread and returns; the files are
+    written by a thread (at most one save in flight), first to a .tmp file and then renamed,
+    so a file that exists is complete.
+    latest() is the newest epoch with the shared file and the shards of all the ranks on disk.
+    Old checkpoints are pruned by save() on the calling thread, once every rank agrees on the newest
+    complete epoch (a collective, see resume_epoch): the newest `keep` complete ones are kept.
+    """
+    def __init__(self, dir: str, rank: int, world_size: int, keep: int = 2, device: torch.device = torch.device("cpu")):
+        self.dir = dir
+        self.rank = rank
+        self.world_size = world_size
+        self.keep = keep
+        self.device = device
+        self.thread: threading.Thread = None
+        self.error: BaseException = None
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _path(self, name: str, epoch: int) -> str:
+        return os.path.join(self.dir, f"{name}_e{epoch}.pt")
+
+    def _epochs(self, name: str) -> set[int]:
+        pattern = re.compile(rf"{name}_e(\d+)\.pt$")
+        return {int(match.group(1)) for match in map(pattern.match, os.listdir(self.dir)) if match is not None}
+
+    def latest(self) -> int:
+        # -1: no complete checkpoint
+        epochs = self._epochs("shared")
+        for rank in range(self.world_size):
+            epochs &= self._epochs(f"rank{rank}")
+        return max(epochs, default=-1)
+
+    def resume_epoch(self, device: torch.device) -> int:
+        # collective: newest checkpoint complete in the view of every rank
+        epoch = self.latest()
+        if self.world_size > 1:
+            epoch_tensor = torch.tensor([epoch], dtype=torch.int64, device=device)
+            dist.all_reduce(epoch_tensor, op=dist.ReduceOp.MIN)
+            epoch = int(epoch_tensor.item())
+        return epoch
+
+    def _write(self, epoch: int, shared: dict, shard: dict):
+        try:
+            items = [("shared", shared)] if shared is not None else []
+            items.append((f"rank{self.rank}", shard))
+            for name, state in items:
+                path = self._path(name, epoch)
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+        except BaseException as e:
+            self.error = e
+
+    def _prune(self):
+        # collective: only epochs older than the newest one complete on every rank are removed,
+        # a rank whose write lags cannot lose the epoch the others would resume from
+        complete = self.resume_epoch(self.device)
+        names = [f"rank{self.rank}"] + (["shared"] if self.rank == 0 else [])
+        for name in names:
+            old_epochs = sorted(epoch for epoch in self._epochs(name) if epoch < complete)
+            for old_epoch in old_epochs[:max(0, len(old_epochs) - (self.keep - 1))]:
+                os.remove(self._path(name, old_epoch))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, epoch: int, shared: dict, shard: dict):
+        # collective, shared: only used on rank 0 (None elsewhere)
+        self.wait()
+        self._prune()
+        shared = snapshot(shared) if self.rank == 0 else None
+        shard = snapshot(shard)
+        self.thread = threading.Thread(target=self._write, args=(epoch, shared, shard), daemon=False)
+        self.thread.start()
+
+    def load(self, epoch: int) -> tuple[dict, dict]:
+        # every rank reads the shared file and its own shard, on the host
+        # (load_state_dict moves the tensors to the parameters' device, rng states must stay on the cpu)
+        shared = torch.load(self._path("shared", epoch), map_location="cpu")
+        shard = torch.load(self._path(f"rank{self.rank}", epoch), map_location="cpu")
+        return shared, shard
+
+def load_model_state(path: str) -> dict:
+    # data-parallel model state from a checkpoint directory (newest shared file) or a plain state_dict file
+    if not os.path.isdir(path):
+        return torch.load(path, map_location="cpu")
+    epochs = Checkpointer(path, 0, 1)._epochs("shared")
+    if len(epochs) == 0:
+        raise FileNotFoundError(f"no checkpoint in {path}")
+    return torch.load(os.path.join(path, f"shared_e{max(epochs)}.pt"), map_location="cpu")["model"]
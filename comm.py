@@ -0,0 +1,291 @@
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+class CompletedWork:
+    # stand-in for the handle returned by async collectives that were executed synchronously
+    def wait(self) -> bool:
+        return True
+
+    def is_completed(self) -> bool:
+        return True
+
+def is_gloo(group=None) -> bool:
+    return dist.get_backend(group) == dist.Backend.GLOO
+
+class WireStats:
+    # bytes this rank sent through the helpers in this module (and the trainers' own collectives)
+    def __init__(self):
+        self.bytes = 0
+
+    def add(self, tensor: torch.Tensor):
+        self.bytes += tensor.numel() * tensor.element_size()
+
+    def reset(self) -> int:
+        sent = self.bytes
+        self.bytes = 0
+        return sent
+
+wire_stats = WireStats()
+
+def allreduce_hook(state, bucket):
+    # DDP comm hook: the default allreduce, counting every gradient bucket in wire_stats
+    wire_stats.add(bucket.buffer())
+    return default_hooks.allreduce_hook(state, bucket)
+
+WIRE_DTYPES = {"float32": None, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+class WireCodec:
+    """Compresses float32 activations / gradients / features for the wire.
+
+    dtype: float16 or bfloat16 (None: send float32 unchanged)
+    row_scale: divide every row by its max magnitude before casting and send the
+    float32 scales along; keeps float16 away from overflow / underflow.
+    Decoding always produces float32, so all accumulation stays in float32.
+    """
+    def __init__(self, dtype: torch.dtype = None, row_scale: bool = False):
+        self.dtype = dtype
+        self.row_scale = row_scale and dtype is not None
+
+    def enabled(self) -> bool:
+        return self.dtype is not None
+
+    def encode(self, tensor: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor | None]:
+        if not self.enabled():
+            return tensor, None
+        if self.row_scale:
+            scale = tensor.abs().amax(dim=1, keepdim=True).clamp_(min=1e-12).float()
+            return (tensor / scale).to(self.dtype), scale
+        return tensor.to(self.dtype), None
+
+    def decode(self, payload: torch.Tensor, scale: torch.Tensor | None) -> torch.Tensor:
+        tensor = payload.float()
+        if scale is not None:
+            tensor = tensor * scale
+        return tensor
+
+def all_gather_var(tensor_list: list[torch.Tensor], tensor: torch.Tensor, group=None, async_op=False, codec: WireCodec = None):
+    """all_gather for tensors whose first dimension differs across ranks.
+
+    tensor_list[r] must already be sized to rank r's tensor.
+    NCCL handles uneven shapes natively; gloo requires equal sizes,
+    so the payload is padded to the largest rank and sliced back on receipt.
+    With an enabled codec the payload is sent compressed and decoded into tensor_list
+    (the collective then completes before returning).
+    """
+    if codec is not None and codec.enabled():
+        payload, scale = codec.encode(tensor)
+        payload_lst = [payload.new_empty((t.shape[0], *payload.shape[1:])) for t in tensor_list]
+        all_gather_var(payload_lst, payload, group=group)
+        scale_lst = [None] * len(tensor_list)
+        if scale is not None:
+            scale_lst = [scale.new_empty((t.shape[0], 1)) for t in tensor_list]
+            all_gather_var(scale_lst, scale, group=group)
+        for out, recv, recv_scale in zip(tensor_list, payload_lst, scale_lst):
+            out.copy_(codec.decode(recv, recv_scale))
+        return CompletedWork() if async_op else None
+
+    if not is_gloo(group):
+        wire_stats.add(tensor)
+        return dist.all_gather(tensor_list=tensor_list, tensor=tensor, group=group, async_op=async_op)
+
+    max_len = max(t.shape[0] for t in tensor_list)
+    padded = tensor.new_zeros((max_len, *tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    wire_stats.add(padded)
+    recv_lst = [torch.empty_like(padded) for _ in tensor_list]
+    dist.all_gather(tensor_list=recv_lst, tensor=padded, group=group)
+    for out, recv in zip(tensor_list, recv_lst):
+        out.copy_(recv[:out.shape[0]])
+    if async_op:
+        return CompletedWork()
+    return None
+
+class SizeExchange:
+    """Exchanges a fixed number of integers (e.g. tensor sizes) between all ranks.
+
+    Replacement for dist.all_gather_object on the per-iteration path:
+    a single all_gather into a preallocated [world_size, num_fields] int64 tensor,
+    so nothing is pickled and only one small collective is launched.
+    """
+    def __init__(self, world_size: int, num_fields: int, device: torch.device, group=None):
+        self.world_size = world_size
+        self.num_fields = num_fields
+        self.device = device
+        self.group = group
+        self.host = torch.zeros(num_fields, dtype=torch.int64, pin_memory=device.type == 'cuda')
+        self.host_view = self.host.numpy()
+        self.local = self.host if device.type == 'cpu' else torch.zeros(num_fields, dtype=torch.int64, device=device)
+        self.buffer = torch.zeros([world_size, num_fields], dtype=torch.int64, device=device)
+        self.buffer_lst = list(self.buffer.unbind(0)) # views of buffer, one row per rank
+
+    def exchange(self, *sizes: int) -> list[list[int]]:
+        # returns [world_size][num_fields] python ints
+        self.host_view[:] = sizes
+        if self.local is not self.host:
+            self.local.copy_(self.host, non_blocking=True)
+        wire_stats.add(self.local)
+        dist.all_gather(tensor_list=self.buffer_lst, tensor=self.local, group=self.group)
+        return self.buffer.tolist()
+
+class PackedAllGather:
+    """Moves several 1-D tensors of every rank with a single all_gather.
+
+    The tensors of a rank are concatenated into one send slot padded to the largest
+    rank's total length. Slots are received into a capacity-grown arena and handed
+    back as zero-copy views, so there is one collective per call instead of one per
+    tensor and no per-iteration resize_ of receive buffers.
+    The views are only valid until the next call.
+    """
+    def __init__(self, world_size: int, dtype: torch.dtype, device: torch.device, capacity: int = 0):
+        self.world_size = world_size
+        self.dtype = dtype
+        self.device = device
+        self.capacity = 0
+        self.send = None
+        self.arena = None
+        self._reserve(capacity)
+
+    def _reserve(self, width: int):
+        if width <= self.capacity:
+            return
+        self.capacity = max(width, int(self.capacity * 1.5))
+        self.send = torch.empty(self.capacity, dtype=self.dtype, device=self.device)
+        self.arena = torch.empty(self.world_size * self.capacity, dtype=self.dtype, device=self.device)
+
+    def all_gather(self, tensors: list[torch.Tensor], sizes: list[list[int]], group=None, async_op=False):
+        """
+        Args:
+            tensors: the local tensors, in the same order on every rank
+            sizes: sizes[r][i] is the length of tensors[i] on rank r (e.g. from SizeExchange)
+        Returns:
+            (handle, views) where views[r][i] is tensors[i] of rank r, valid after handle.wait()
+        """
+        totals = [sum(size) for size in sizes]
+        width = max(totals)
+        self._reserve(width)
+        local_total = sum(t.shape[0] for t in tensors)
+        torch.cat([t.to(self.dtype) for t in tensors], out=self.send[:local_total])
+        recv = self.arena[:self.world_size * width].view(self.world_size, width)
+        wire_stats.add(self.send[:width])
+        handle = dist.all_gather(tensor_list=list(recv.unbind(0)), tensor=self.send[:width], group=group, async_op=async_op)
+        views = []
+        for r, size in enumerate(sizes):
+            rank_views = []
+            offset = 0
+            for length in size:
+                rank_views.append(recv[r, offset : offset + length])
+                offset += length
+            views.append(rank_views)
+        return handle, views
+
+class OverlappedReduce:
+    """Sums tensor r of every rank onto rank r (the P3 first-layer shuffle) without blocking.
+
+    launch(r, tensor) must be called for r = 0 .. world_size - 1 in the same order on
+    every rank, as soon as each tensor is ready, so the reduction of tensor r is in
+    flight while the caller computes tensor r + 1. wait() waits on every tracked handle
+    and returns this rank's reduced tensor.
+
+    mode 'reduce': one async dist.reduce per destination rank
+    mode 'reduce_scatter': tensors are packed into [world_size * max_rows, cols] and reduced
+    with a single reduce_scatter once the last one is launched (gloo has no reduce_scatter,
+    there every slot of the packed buffer is reduced to its owner instead)
+    With an enabled codec, tensor r is compressed and gathered on rank r instead, which
+    decodes and sums the parts in float32 (a reduce would accumulate in the wire dtype).
+    """
+    def __init__(self, rank: int, world_size: int, mode: str = "reduce", group=None, codec: WireCodec = None):
+        self.rank = rank
+        self.world_size = world_size
+        self.mode = mode
+        self.group = group
+        self.gloo = is_gloo(group)
+        self.codec = codec if codec is not None and codec.enabled() else None
+        self.sent: list = [] # compressed tensors in flight
+        self.recv_payload_lst: list[torch.Tensor] = []
+        self.recv_scale_lst: list[torch.Tensor] = []
+        self.num_rows: list[int] = []
+        self.handles = []
+        self.pending: list[torch.Tensor] = []
+        self.packed: torch.Tensor = None
+        self.result: torch.Tensor = None
+
+    def reset(self, num_rows: list[int]):
+        # num_rows[r]: rows of the tensor reduced onto rank r
+        self.num_rows = num_rows
+        self.handles = []
+        self.pending = []
+        self.sent = []
+        self.result = None
+
+    def launch(self, dst: int, tensor: torch.Tensor):
+        tensor = tensor.detach()
+        if self.codec is not None:
+            self._launch_gather(dst, tensor)
+            return
+        if self.mode == "reduce_scatter":
+            self.pending.append(tensor)
+            if len(self.pending) == self.world_size:
+                self._reduce_scatter()
+            return
+        if dst == self.rank:
+            self.result = tensor.clone()
+            send = self.result
+        elif self.gloo:
+            # gloo may use the input of non-root ranks as scratch space
+            send = tensor.clone()
+        else:
+            send = tensor
+        wire_stats.add(send)
+        self.handles.append(dist.reduce(tensor=send, dst=dst, group=self.group, async_op=True))
+
+    def _launch_gather(self, dst: int, tensor: torch.Tensor):
+        payload, scale = self.codec.encode(tensor)
+        self.sent.append((payload, scale))
+        wire_stats.add(payload)
+        payload_lst = None
+        scale_lst = None
+        if dst == self.rank:
+            self.recv_payload_lst = payload_lst = [torch.empty_like(payload) for _ in range(self.world_size)]
+            if scale is not None:
+                self.recv_scale_lst = scale_lst = [torch.empty_like(scale) for _ in range(self.world_size)]
+        self.handles.append(dist.gather(tensor=payload, gather_list=payload_lst, dst=dst, group=self.group, async_op=True))
+        if scale is not None:
+            wire_stats.add(scale)
+            self.handles.append(dist.gather(tensor=scale, gather_list=scale_lst, dst=dst, group=self.group, async_op=True))
+
+    def _reduce_scatter(self):
+        max_rows = max(self.num_rows)
+        cols = self.pending[0].shape[1]
+        numel = self.world_size * max_rows * cols
+        if self.packed is None or self.packed.numel() < numel or self.packed.dtype != self.pending[0].dtype:
+            self.packed = self.pending[0].new_empty(numel)
+        packed = self.packed[:numel].view(self.world_size * max_rows, cols)
+        packed.zero_()
+        for r, tensor in enumerate(self.pending):
+            packed[r * max_rows : r * max_rows + tensor.shape[0]] = tensor
+        wire_stats.add(packed)
+        if self.gloo:
+            for r in range(self.world_size):
+                self.handles.append(dist.reduce(tensor=packed[r * max_rows : (r + 1) * max_rows], dst=r, group=self.group, async_op=True))
+            # a view of the scratch buffer until wait() copies it out
+            self.result = packed[self.rank * max_rows : (self.rank + 1) * max_rows]
+        else:
+            self.result = packed.new_empty([max_rows, cols])
+            self.handles.append(dist.reduce_scatter_tensor(self.result, packed, group=self.group, async_op=True))
+        self.pending = []
+
+    def wait(self) -> torch.Tensor:
+        for handle in self.handles:
+            handle.wait()
+        self.handles = []
+        self.sent = []
+        if self.mode == "reduce_scatter" and self.gloo and self.codec is None:
+            # packed is zeroed and refilled by the next _reduce_scatter, the result must not alias it
+            self.result = self.result.clone()
+        if self.codec is not None:
+            scale_lst = self.recv_scale_lst if self.codec.row_scale else [None] * self.world_size
+            self.result = self.codec.decode(self.recv_payload_lst[0], scale_lst[0])
+            for payload, scale in zip(self.recv_payload_lst[1:], scale_lst[1:]):
+                self.result += self.codec.decode(payload, scale)
+        return self.result[:self.num_rows[self.rank]]
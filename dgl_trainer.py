@@ -1,15 +1,16 @@
 import torch
 import torch.nn.functional as F
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
-import torch.distributed as dist
-from torch.cuda import Event as event
 import time
 from dgl.dataloading import DataLoader as DglDataLoader
-import csv
-import torchmetrics.functional as MF
-from utils import RunConfig, TrainProfiler, QuiverDglSageSample
-from dgl.utils import gather_pinned_tensor_rows
+from utils import RunConfig, TrainProfiler, QuiverDglSageSample, device_synchronize, ddp_wrap
+from tracer import Tracer
+from checkpoint import Checkpointer, rng_state, set_rng_state
+from eval_engine import Evaluator
+from mixed_precision import MixedPrecision, PrecisionBaseline
+from feat_quant import gather_rows
+from comm import wire_stats
+from inference import LayerwiseInference, layer_widths
+from sample_workers import WorkerPoolLoader
 
 class DglTrainer:
     def __init__(
@@ -26,7 +27,7 @@ class DglTrainer:
         self.config = config
         self.rank = config.rank
         self.world_size = config.world_size
-        self.device = torch.device(f"cuda:{self.rank}")
+        self.device = config.get_device()
         self.feat = feat
         self.node_labels = label
         self.train_data = train_data
@@ -35,102 +36,143 @@ class DglTrainer:
         if config.world_size == 1:
             self.model = model.to(device=self.device)
         elif config.world_size > 1:
-            self.model = DDP(model.to(device=self.device), device_ids=[self.rank], output_device=self.rank)
+            self.model = ddp_wrap(model.to(device=self.device), self.device)
         self.num_classes = config.num_classes
         self.save_every = config.save_every        
         self.log = TrainProfiler(config.log_path)
-        self.checkpt_path = config.checkpt_path
-        self.stream = torch.cuda.current_stream(self.device)
+        self.tracer = Tracer(self.rank, enabled=config.trace)
+        self.evaluator = Evaluator(self.val_data, self.device, self.world_size, config.total_epoch,
+                                   overlap=config.eval_overlap, every=config.eval_every)
+        self.checkpointer = Checkpointer(config.checkpt_dir(), self.rank, self.world_size, device=self.device)
+        self.start_epoch = 0
+        self.amp = MixedPrecision(config.amp, self.device, self.world_size)
+        self.baseline = PrecisionBaseline(config.baseline_log_path())
+
+    def _gather_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        # rows are moved in the storage dtype (--feat_dtype) and computed on in float32
+        return gather_rows(self.feat, input_nodes, self.config.feat, self.device)
     
     def _run_epoch(self, epoch):
         forward = 0.0
         backward = 0.0
         sample_time = 0.0
         feat_time = 0.0
-        
+        num_seeds = 0
+        wire_stats.reset()
         start = time.time()
         sample_start = time.time()
         for input_nodes, output_nodes, blocks in self.train_data:
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             feat_start = sample_end = time.time()
-            input_feats = None
-            if self.config.feat == 'cpu':
-                input_feats = self.feat[input_nodes.to("cpu")].to(self.device)
-            elif self.config.feat == 'uva':
-                input_feats = gather_pinned_tensor_rows(self.feat, input_nodes)
-            else: # gpu feature extraction
-                input_feats = self.feat[input_nodes]
+            input_feats = self._gather_feat(input_nodes)
             output_labels = self.node_labels[output_nodes]
 
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             feat_end = forward_start = time.time()
-            output_pred = self.model(blocks, input_feats)    
-            loss = F.cross_entropy(output_pred, output_labels)
+            with self.amp.autocast():
+                output_pred = self.model(blocks, input_feats)
+                loss = F.cross_entropy(output_pred, output_labels)
 
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             forward_end = backward_start = time.time()
             
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.amp.scale(loss).backward()
+            with self.tracer.span("optimizer"):
+                self.amp.step(self.optimizer)
+                self.amp.update()
             
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             backward_end = time.time()
             forward += forward_end - forward_start
             backward += backward_end - backward_start
             feat_time += feat_end - feat_start
             sample_time += sample_end - sample_start
+            num_seeds += output_nodes.shape[0]
+            self.tracer.record("sample", sample_start, sample_end)
+            self.tracer.record("feat_gather", feat_start, feat_end)
+            self.tracer.record("forward", forward_start, forward_end)
+            self.tracer.record("backward", backward_start, backward_end)
+            self.tracer.next_iter()
             
             sample_start = time.time()
         end = time.time()
         epoch_time = end - start
-        acc = self.evaluate()
+        extra = {"comm_bytes": wire_stats.reset()} # DDP gradient allreduce
+        if isinstance(self.train_data, WorkerPoolLoader):
+            extra.update(self.train_data.worker_stats())
+        acc = float("nan")
+        extra["eval_time"] = 0.0 # skipped evaluation
+        if self.evaluator.should_run(epoch):
+            eval_start = time.time()
+            acc = self.evaluate()
+            extra["eval_time"] = time.time() - eval_start
+        extra["throughput"] = num_seeds * self.world_size / epoch_time # training seeds / second over all the gpus
+        if self.amp.enabled:
+            extra["loss_scale"] = self.amp.loss_scale()
+        extra.update(self.baseline.delta(epoch, acc, extra["throughput"]))
         if self.rank == 0 or self.world_size == 1:
-            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time)
+            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time, extra=extra)
             print(info)
 
     def _save_checkpoint(self, epoch):
+        model = self.model.module if self.world_size > 1 else self.model
+        shared = {"epoch": epoch, "model": model.state_dict(), "optimizer": self.optimizer.state_dict(), "log": self.log.items,
+                  "amp": self.amp.state_dict()}
+        shard = {"epoch": epoch, "rng": rng_state(self.device)}
+        self.checkpointer.save(epoch, shared, shard)
+        if self.rank == 0 or self.world_size == 1:
+            print(f"Epoch {epoch} | Training checkpoint queued for {self.checkpointer.dir}")
+
+    def _resume(self):
+        epoch = self.checkpointer.resume_epoch(self.device)
+        if epoch < 0:
+            print(f"rank {self.rank}: no checkpoint in {self.checkpointer.dir}, starting from epoch 0")
+            return
+        shared, shard = self.checkpointer.load(epoch)
+        model = self.model.module if self.world_size > 1 else self.model
+        model.load_state_dict(shared["model"])
+        self.optimizer.load_state_dict(shared["optimizer"])
+        self.log.restore(shared["log"])
+        self.amp.load_state_dict(shared.get("amp", {}))
+        set_rng_state(shard["rng"], self.device)
+        self.start_epoch = epoch + 1
+        assigner = getattr(self.train_data, "assigner", None)
+        if assigner is not None:
+            assigner.epoch = self.start_epoch
+        if isinstance(self.train_data, WorkerPoolLoader):
+            self.train_data.epoch = self.start_epoch # seeds the global shard permutation
         if self.rank == 0 or self.world_size == 1:
-            ckp = None
-            if self.world_size == 1:
-                ckp = self.model.state_dict()
-            elif self.world_size > 1: 
-                # using ddp
-                ckp = self.model.module.state_dict()
-            torch.save(ckp, self.checkpt_path)
-            print(f"Epoch {epoch} | Training checkpoint saved at {self.checkpt_path}")
+            print(f"Resumed from the checkpoint of epoch {epoch}")
 
     def train(self):
         self.model.train()
-        for epoch in range(self.config.total_epoch):
+        if self.config.resume:
+            self._resume()
+        for epoch in range(self.start_epoch, self.config.total_epoch):
             self._run_epoch(epoch)
             if self.rank == 0 or self.world_size == 1:
                 self.log.saveToDisk()
-                if epoch % self.save_every == 0 and epoch > 0:
-                    self._save_checkpoint(epoch)
+            if (epoch % self.save_every == 0 and epoch > 0) or epoch == self.config.total_epoch - 1:
+                self._save_checkpoint(epoch)
+        self.checkpointer.wait()
+        self.tracer.export(self.config.trace_path(), self.world_size)
                         
     def evaluate(self):
         self.model.eval()
-        ys = []
-        y_hats = []
-        for it, (input_nodes, output_nodes, blocks) in enumerate(self.val_data):
+        for input_nodes, output_nodes, blocks in self.evaluator.batches():
             with torch.no_grad():
-                input_feats = None
-                if self.config.feat == 'cpu':
-                    input_feats = self.feat[input_nodes.to("cpu")].to(self.device)
-                elif self.config.feat == 'uva':
-                    input_feats = gather_pinned_tensor_rows(self.feat, input_nodes)
-                else: # gpu feature extraction
-                    input_feats = self.feat[input_nodes]
-                ys.append(self.node_labels[output_nodes])
-                y_hats.append(self.model(blocks, input_feats))
-                
-        acc = MF.accuracy(
-            torch.cat(y_hats),
-            torch.cat(ys),
-            task="multiclass",
-            num_classes=self.num_classes)
-        
-        dist.all_reduce(acc, op=dist.ReduceOp.SUM)
-        return (acc / self.world_size).item()
-    
\ No newline at end of file
+                input_feats = self._gather_feat(input_nodes)
+                with self.amp.autocast():
+                    output_pred = self.model(blocks, input_feats)
+                self.evaluator.update(output_pred, self.node_labels[output_nodes])
+        return self.evaluator.accuracy()
+
+    def infer(self, graph):
+        # layer-wise full-neighbor inference of all the nodes
+        model = self.model.module if self.world_size > 1 else self.model
+        model.eval()
+        engine = LayerwiseInference(graph, self.config.infer_dir(), self.device, self.rank, self.world_size, self.config.infer_chunk_size)
+        engine.layers(model, self._gather_feat, layer_widths(self.config))
+        if self.rank == 0 or self.world_size == 1:
+            print(engine.report())
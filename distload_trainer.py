@@ -1,13 +1,17 @@
 import torch
 import torch.nn.functional as F
-from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.distributed as dist
 import time
 from dgl.dataloading import DataLoader as DglDataLoader
-import torchmetrics.functional as MF
-from utils import RunConfig, TrainProfiler, QuiverDglSageSample
-import quiver
-from dgl.utils import gather_pinned_tensor_rows
+from utils import RunConfig, TrainProfiler, device_synchronize, ddp_wrap
+from tracer import Tracer
+from checkpoint import Checkpointer, rng_state, set_rng_state
+from eval_engine import Evaluator
+from mixed_precision import MixedPrecision, PrecisionBaseline
+from comm import all_gather_var, SizeExchange, WireCodec, WIRE_DTYPES, wire_stats
+from feat_cache import FeatCache
+from feat_quant import decode_rows, feat_storage, fetch_rows, gather_rows
+from sample_workers import WorkerPoolLoader
 
 class P2Trainer:
     def __init__(
@@ -19,12 +23,13 @@ class P2Trainer:
         local_feat: torch.Tensor, # local feature
         label: torch.Tensor,
         optimizer: torch.optim.Optimizer,
-        nid_dtype: torch.dtype = torch.int32
+        nid_dtype: torch.dtype = torch.int32,
+        cache_scores: torch.Tensor = None # node ranking of the static feature cache policies
     ) -> None:
         self.config = config
         self.rank = config.rank
         self.world_size = config.world_size
-        self.device = torch.device(f"cuda:{self.rank}")
+        self.device = config.get_device()
         self.local_feat = local_feat # horizontally partitioned feature
         self.node_labels = label
         self.train_data = train_data
@@ -33,16 +38,30 @@ class P2Trainer:
         if config.world_size == 1:
             self.model = model
         elif config.world_size > 1:
-            self.model = DDP(model, device_ids=[self.rank], output_device=self.rank)
+            self.model = ddp_wrap(model, self.device)
         self.num_classes = config.num_classes
         self.save_every = config.save_every
         self.feat_mode = config.feat    
         self.log = TrainProfiler(config.log_path)
-        self.checkpt_path = config.checkpt_path
+        self.tracer = Tracer(self.rank, enabled=config.trace)
+        self.evaluator = Evaluator(self.val_data, self.device, self.world_size, config.total_epoch,
+                                   overlap=config.eval_overlap, every=config.eval_every)
+        self.checkpointer = Checkpointer(config.checkpt_dir(), self.rank, self.world_size, device=self.device)
+        self.start_epoch = 0
+        self.amp = MixedPrecision(config.amp, self.device, self.world_size)
+        self.baseline = PrecisionBaseline(config.baseline_log_path())
         # Initialize buffers for storing feature data fetched from other GPUs
-        self.input_node_size_lst: list= [(0, 0)] * self.world_size
+        self.size_exchange = SizeExchange(self.world_size, 1, self.device) # num_input_nodes
         self.est_node_size = self.config.batch_size * 20
         self.local_feat_width = self.local_feat.shape[1]
+        self.feat_cache = None
+        if config.feat_cache_ratio > 0 and self.feat_mode != 'gpu':
+            # hot rows of this gpu's local slice, looked up with the input nodes of every gpu
+            num_nodes = self.local_feat.shape[0]
+            # the cached rows stay in the storage dtype of --feat_dtype, decoded after the hit / miss merge
+            storage = feat_storage(self.local_feat)
+            self.feat_cache = FeatCache(self._fetch_local_rows, num_nodes, storage.shape[1], int(config.feat_cache_ratio * num_nodes),
+                                        self.device, policy=config.feat_cache_policy, scores=cache_scores, dtype=storage.dtype)
         self.input_node_buffer_lst: list[torch.Tensor] = [] # storing input node for gathering feature data
         self.global_feat_buffer_lst: list[torch.Tensor] = [] # storing feature data gathered for other gpus
         self.local_feat_buffer_lst: list[torch.Tensor] = [] # storing feature data gathered from other gpus
@@ -50,8 +69,130 @@ class P2Trainer:
             self.input_node_buffer_lst.append(torch.zeros(self.est_node_size, dtype=nid_dtype, device=self.device))
             self.global_feat_buffer_lst.append(torch.zeros([self.est_node_size, self.local_feat_width], dtype=torch.float32, device=self.device))
             self.local_feat_buffer_lst.append(torch.zeros([self.est_node_size, self.local_feat_width], dtype=torch.float32, device=self.device))
-        # torch.cuda.set_device(self.device)
-        self.stream = torch.cuda.current_stream(self.device)
+        self.transport = config.p2_transport
+        self.concat_time = 0.0
+        # wire format of the exchanged feature slices
+        self.codec = WireCodec(WIRE_DTYPES[config.comm_dtype], row_scale=config.comm_row_scale)
+        self.wire_dtype = self.codec.dtype if self.codec.enabled() else torch.float32
+        # all_to_all transport: flat send / receive buffers, grown on demand
+        self.send_buffer = torch.zeros(self.est_node_size * self.local_feat_width, dtype=self.wire_dtype, device=self.device)
+        self.recv_buffer = torch.zeros(self.est_node_size * self.local_feat_width * self.world_size, dtype=self.wire_dtype, device=self.device)
+        self.send_scale_buffer = torch.zeros(self.est_node_size, dtype=torch.float32, device=self.device)
+        self.recv_scale_buffer = torch.zeros(self.est_node_size * self.world_size, dtype=torch.float32, device=self.device)
+
+    def _gather_local_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        if self.feat_cache is not None:
+            return decode_rows(self.local_feat, self.feat_cache.gather(input_nodes))
+        return self._fetch_local_feat(input_nodes)
+
+    def _fetch_local_rows(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        return fetch_rows(self.local_feat, input_nodes, self.feat_mode, self.device)
+
+    def _fetch_local_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        # rows are moved in the storage dtype (--feat_dtype) and computed on in float32;
+        # the exchange in _fetch_feat sends them in the wire format of --comm_dtype
+        return gather_rows(self.local_feat, input_nodes, self.feat_mode, self.device)
+
+    # Fetch the feature slices of input_nodes from all the gpus, returns [num_input_nodes, global_width]
+    def _fetch_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        # 1. Send and Receive input_nodes for all the other gpus
+        with self.tracer.span("size_exchange"):
+            input_node_sizes = [size for size, in self.size_exchange.exchange(input_nodes.shape[0])]
+        for rank, input_node_size in enumerate(input_node_sizes):
+            self.input_node_buffer_lst[rank].resize_(input_node_size)
+        with self.tracer.span("node_all_gather"):
+            all_gather_var(tensor_list=self.input_node_buffer_lst, tensor=input_nodes)
+        if self.transport == 'gather':
+            return self._fetch_feat_gather(input_nodes)
+
+        # 2. Fetch feature data for other GPUs
+        # The slice for gpu r is packed transposed ([local_width, n_r]), so the chunks received
+        # from all the gpus stack into [global_width, num_input_nodes]: the transpose of the
+        # input feature matrix, with every gpu's columns already in place (no concatenation)
+        width = self.local_feat_width
+        num_input = input_nodes.shape[0]
+        send_sizes = [size * width for size in input_node_sizes]
+        recv_size = num_input * width
+        if self.send_buffer.shape[0] < sum(send_sizes):
+            self.send_buffer = torch.empty(sum(send_sizes), dtype=self.wire_dtype, device=self.device)
+            self.send_scale_buffer = torch.empty(sum(input_node_sizes), dtype=torch.float32, device=self.device)
+        if self.recv_buffer.shape[0] < recv_size * self.world_size:
+            self.recv_buffer = torch.empty(recv_size * self.world_size, dtype=self.wire_dtype, device=self.device)
+            self.recv_scale_buffer = torch.empty(num_input * self.world_size, dtype=torch.float32, device=self.device)
+        offset = 0
+        scale_offset = 0
+        with self.tracer.span("feat_gather"):
+            for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
+                size = input_node_sizes[rank]
+                payload, scale = self.codec.encode(self._gather_local_feat(_input_nodes))
+                self.send_buffer[offset : offset + size * width].view(width, size).copy_(payload.t())
+                if scale is not None:
+                    self.send_scale_buffer[scale_offset : scale_offset + size].copy_(scale.view(-1))
+                offset += size * width
+                scale_offset += size
+        # 3. Send & Receive feature data from all the GPUs in one collective
+        send = self.send_buffer[:offset]
+        recv = self.recv_buffer[:recv_size * self.world_size]
+        wire_stats.add(send)
+        with self.tracer.span("feat_exchange"):
+            dist.all_to_all_single(recv, send, output_split_sizes=[recv_size] * self.world_size, input_split_sizes=send_sizes)
+        if not self.codec.enabled():
+            return recv.view(self.world_size * width, num_input).t()
+        # decode to float32, [world_size, width, num_input] with per-(gpu, node) scales
+        input_feats = recv.view(self.world_size, width, num_input).float()
+        if self.codec.row_scale:
+            send_scale = self.send_scale_buffer[:scale_offset]
+            recv_scale = self.recv_scale_buffer[:num_input * self.world_size]
+            wire_stats.add(send_scale)
+            dist.all_to_all_single(recv_scale, send_scale, output_split_sizes=[num_input] * self.world_size, input_split_sizes=input_node_sizes)
+            input_feats *= recv_scale.view(self.world_size, 1, num_input)
+        return input_feats.view(self.world_size * width, num_input).t()
+
+    # Original transport: one blocking dist.gather per destination gpu, then concatenate the column slices
+    def _fetch_feat_gather(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        for rank in range(self.world_size):
+            self.local_feat_buffer_lst[rank].resize_([input_nodes.shape[0], self.local_feat_width])
+        # 3. Fetch feature data for other GPUs
+        with self.tracer.span("feat_gather"):
+            for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
+                self.global_feat_buffer_lst[rank] = self._gather_local_feat(_input_nodes)
+        # 4. Send & Receive feature data from other GPUs
+        with self.tracer.span("feat_exchange"):
+            if self.codec.enabled():
+                self._gather_coded(input_nodes.shape[0])
+            else:
+                for rank in range(self.world_size):
+                    wire_stats.add(self.global_feat_buffer_lst[rank])
+                    if rank == self.rank:
+                        dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=self.local_feat_buffer_lst, dst=rank, async_op=False) # gathering data from other GPUs
+                    else:
+                        dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=None, dst=rank, async_op=False) # gathering data from other GPUs
+        device_synchronize(self.device)
+        concat_start = time.time()
+        input_feats = torch.cat(self.local_feat_buffer_lst, dim=1)
+        device_synchronize(self.device)
+        concat_end = time.time()
+        self.concat_time += concat_end - concat_start
+        self.tracer.record("concat", concat_start, concat_end)
+        return input_feats
+
+    # dist.gather transport with compressed slices, decoded into local_feat_buffer_lst
+    def _gather_coded(self, num_input: int):
+        for rank in range(self.world_size):
+            payload, scale = self.codec.encode(self.global_feat_buffer_lst[rank])
+            payload_lst = None
+            scale_lst = None
+            if rank == self.rank:
+                payload_lst = [payload.new_empty([num_input, self.local_feat_width]) for _ in range(self.world_size)]
+                scale_lst = [torch.empty([num_input, 1], dtype=torch.float32, device=self.device) for _ in range(self.world_size)]
+            wire_stats.add(payload)
+            dist.gather(tensor=payload, gather_list=payload_lst, dst=rank, async_op=False)
+            if scale is not None:
+                wire_stats.add(scale)
+                dist.gather(tensor=scale, gather_list=scale_lst, dst=rank, async_op=False)
+            if rank == self.rank:
+                for r in range(self.world_size):
+                    self.local_feat_buffer_lst[r].copy_(self.codec.decode(payload_lst[r], scale_lst[r] if scale is not None else None))
 
     # fetch data from remote GPUs before forward pass
     def _run_epoch(self, epoch):
@@ -59,143 +200,126 @@ class P2Trainer:
         backward = 0.0
         sample_time = 0.0
         feat_time = 0.0
-        concat_time = 0.0
+        self.concat_time = 0.0
+        num_seeds = 0
+        wire_stats.reset()
         start = sample_start = time.time()
         iter_idx = 0
         for input_nodes, output_nodes, blocks in self.train_data:
             iter_idx += 1
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             feat_start = sample_end = time.time()
-            # 1. Send and Receive input_nodes for all the other gpus
-            self.input_node_size_lst[self.rank] = (self.rank, input_nodes.shape[0])
-            dist.all_gather_object(object_list=self.input_node_size_lst, obj=self.input_node_size_lst[self.rank])
-            for rank, input_node_size in self.input_node_size_lst:
-                self.input_node_buffer_lst[rank].resize_(input_node_size)
-                # self.global_feat_buffer_lst[rank].resize_([input_node_size, self.local_feat_width])
-                self.local_feat_buffer_lst[rank].resize_([input_nodes.shape[0], self.local_feat_width]) # 
-            
-            dist.all_gather(tensor_list=self.input_node_buffer_lst, tensor=input_nodes)
-            # 3. Fetch feature data for other GPUs
-            # for rank in range(self.world_size):
-            #     self.global_feat_buffer_lst[rank] = self.local_feat[self.input_node_buffer_lst[rank]]
-            #     torch.cuda.synchronize(self.device)                
-            #     print(f"feat {self.rank=} {rank=}")
-                
-            for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
-                if self.feat_mode == 'gpu':
-                    self.global_feat_buffer_lst[rank] = self.local_feat[_input_nodes]
-                elif self.feat_mode == 'uva':
-                    self.global_feat_buffer_lst[rank] = gather_pinned_tensor_rows(self.local_feat, _input_nodes)
-                else: # 'cpu'
-                    self.global_feat_buffer_lst[rank] = self.local_feat[_input_nodes.to('cpu')].to(self.device)
-                    
-            # 4. Send & Receive feature data from other GPUs
-            for rank in range(self.world_size):
-                if rank == self.rank:
-                    dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=self.local_feat_buffer_lst, dst=rank, async_op=False) # gathering data from other GPUs
-                else:
-                    dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=None, dst=rank, async_op=False) # gathering data from other GPUs
-            
-            torch.cuda.synchronize(self.device)
-            concat_start = time.time()
-            input_feats = torch.cat(self.local_feat_buffer_lst, dim=1)
-            torch.cuda.synchronize(self.device)
-            concat_end = time.time()
-                        
+            input_feats = self._fetch_feat(input_nodes)
             output_labels = self.node_labels[output_nodes]
             
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             feat_end = forward_start = time.time()
             # 6. Compute forward pass locally
-            output_pred = self.model(blocks, input_feats)            
-            loss = F.cross_entropy(output_pred, output_labels) 
+            with self.amp.autocast():
+                output_pred = self.model(blocks, input_feats)
+                loss = F.cross_entropy(output_pred, output_labels) 
                 
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             forward_end = backward_start = time.time()                
             # Backward Pass
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.amp.scale(loss).backward()
+            with self.tracer.span("optimizer"):
+                self.amp.step(self.optimizer)
+                self.amp.update()
             
-            torch.cuda.synchronize(self.device)
+            device_synchronize(self.device)
             backward_end = time.time()
             
             forward += forward_end - forward_start
             backward += backward_end - backward_start
             feat_time += feat_end - feat_start
             sample_time += sample_end - sample_start
-            concat_time += concat_end - concat_start
-            torch.cuda.synchronize(self.device)
+            num_seeds += output_nodes.shape[0]
+            self.tracer.record("sample", sample_start, sample_end)
+            self.tracer.record("feat", feat_start, feat_end)
+            self.tracer.record("forward", forward_start, forward_end)
+            self.tracer.record("backward", backward_start, backward_end)
+            self.tracer.next_iter()
+            device_synchronize(self.device)
             sample_start = time.time()
         
-        torch.cuda.synchronize(self.device)
+        device_synchronize(self.device)
         end = time.time()
         epoch_time = end - start
-        acc = self.evaluate()
+        extra = {"comm_bytes": wire_stats.reset()}
+        if self.transport == 'gather':
+            extra["concat"] = self.concat_time
+        if self.feat_cache is not None:
+            extra["cache_hit_rate"] = self.feat_cache.reset_stats()
+        if isinstance(self.train_data, WorkerPoolLoader):
+            extra.update(self.train_data.worker_stats())
+        acc = float("nan")
+        extra["eval_time"] = 0.0 # skipped evaluation
+        if self.evaluator.should_run(epoch):
+            eval_start = time.time()
+            acc = self.evaluate()
+            extra["eval_time"] = time.time() - eval_start
+            if self.feat_cache is not None:
+                self.feat_cache.reset_stats() # validation lookups do not count towards the next epoch's hit rate
+        extra["throughput"] = num_seeds * self.world_size / epoch_time # training seeds / second over all the gpus
+        if self.amp.enabled:
+            extra["loss_scale"] = self.amp.loss_scale()
+        extra.update(self.baseline.delta(epoch, acc, extra["throughput"]))
         if self.rank == 0 or self.world_size == 1:
-            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time)
-            print(info, "concat:", round(concat_time, 4))
+            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time, extra=extra)
+            print(info)
 
     def _save_checkpoint(self, epoch):
+        model = self.model.module if self.world_size > 1 else self.model
+        shared = {"epoch": epoch, "model": model.state_dict(), "optimizer": self.optimizer.state_dict(), "log": self.log.items,
+                  "amp": self.amp.state_dict()}
+        shard = {"epoch": epoch, "rng": rng_state(self.device)}
+        self.checkpointer.save(epoch, shared, shard)
         if self.rank == 0 or self.world_size == 1:
-            ckp = None
-            if self.world_size == 1:
-                ckp = self.model.state_dict()
-            elif self.world_size > 1: 
-                # using ddp
-                ckp = self.model.module.state_dict()
-            torch.save(ckp, self.checkpt_path)
-            print(f"Epoch {epoch} | Training checkpoint saved at {self.checkpt_path}")
+            print(f"Epoch {epoch} | Training checkpoint queued for {self.checkpointer.dir}")
+
+    def _resume(self):
+        epoch = self.checkpointer.resume_epoch(self.device)
+        if epoch < 0:
+            print(f"rank {self.rank}: no checkpoint in {self.checkpointer.dir}, starting from epoch 0")
+            return
+        shared, shard = self.checkpointer.load(epoch)
+        model = self.model.module if self.world_size > 1 else self.model
+        model.load_state_dict(shared["model"])
+        self.optimizer.load_state_dict(shared["optimizer"])
+        self.log.restore(shared["log"])
+        self.amp.load_state_dict(shared.get("amp", {}))
+        set_rng_state(shard["rng"], self.device)
+        self.start_epoch = epoch + 1
+        assigner = getattr(self.train_data, "assigner", None)
+        if assigner is not None:
+            assigner.epoch = self.start_epoch
+        if isinstance(self.train_data, WorkerPoolLoader):
+            self.train_data.epoch = self.start_epoch # seeds the global shard permutation
+        if self.rank == 0 or self.world_size == 1:
+            print(f"Resumed from the checkpoint of epoch {epoch}")
 
     def train(self):
         self.model.train()
-        for epoch in range(self.config.total_epoch):
+        if self.config.resume:
+            self._resume()
+        for epoch in range(self.start_epoch, self.config.total_epoch):
             self._run_epoch(epoch)
             if self.rank == 0 or self.world_size == 1:
                 self.log.saveToDisk()
-                if epoch % self.save_every == 0 and epoch > 0:
-                    self._save_checkpoint(epoch)
+            if (epoch % self.save_every == 0 and epoch > 0) or epoch == self.config.total_epoch - 1:
+                self._save_checkpoint(epoch)
+        self.checkpointer.wait()
+        self.tracer.export(self.config.trace_path(), self.world_size)
                         
     def evaluate(self):
         self.model.eval()
-        ys = []
-        y_hats = []
-        for it, (input_nodes, output_nodes, blocks) in enumerate(self.val_data):
+        for input_nodes, output_nodes, blocks in self.evaluator.batches():
             with torch.no_grad():
-                # 1. Send and Receive input_nodes for all the other gpus
-                self.input_node_size_lst[self.rank] = (self.rank, input_nodes.shape[0])
-                dist.all_gather_object(object_list=self.input_node_size_lst, obj=self.input_node_size_lst[self.rank])
-                for rank, input_node_size in self.input_node_size_lst:
-                    self.input_node_buffer_lst[rank].resize_(input_node_size)
-                    # self.global_feat_buffer_lst[rank].resize_([input_node_size, self.local_feat_width])
-                    self.local_feat_buffer_lst[rank].resize_([input_nodes.shape[0], self.local_feat_width]) # 
-                    
-                dist.all_gather(tensor_list=self.input_node_buffer_lst, tensor=input_nodes)
-                # 3. Fetch feature data for other GPUs
-                for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
-                    if self.feat_mode == 'gpu':
-                        self.global_feat_buffer_lst[rank] = self.local_feat[_input_nodes]
-                    elif self.feat_mode == 'uva':
-                        self.global_feat_buffer_lst[rank] = gather_pinned_tensor_rows(self.local_feat, _input_nodes)
-                    else: # 'cpu'
-                        self.global_feat_buffer_lst[rank] = self.local_feat[_input_nodes.to('cpu')].to(self.device)
-                        
-                # 4. Send & Receive feature data from other GPUs
-                for rank in range(self.world_size):
-                    if rank == self.rank:
-                        dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=self.local_feat_buffer_lst, dst=rank, async_op=False) # gathering data from other GPUs
-                    else:
-                        dist.gather(tensor=self.global_feat_buffer_lst[rank], gather_list=None, dst=rank, async_op=False) # gathering data from other GPUs
-                x = torch.cat(self.local_feat_buffer_lst, dim=1)
-                ys.append(self.node_labels[output_nodes])
-                y_hats.append(self.model(blocks, x))
-                
-        acc = MF.accuracy(
-            torch.cat(y_hats),
-            torch.cat(ys),
-            task="multiclass",
-            num_classes=self.num_classes)
-        
-        dist.all_reduce(acc, op=dist.ReduceOp.SUM)
-        return (acc / self.world_size).item()
+                x = self._fetch_feat(input_nodes)
+                with self.amp.autocast():
+                    output_pred = self.model(blocks, x)
+                self.evaluator.update(output_pred, self.node_labels[output_nodes])
+        return self.evaluator.accuracy()
     
\ No newline at end of file
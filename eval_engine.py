@@ -0,0 +1,58 @@
+from __future__ import annotations
+import torch
+import torch.distributed as dist
+from prefetch import Prefetcher
+
+def _identity(batch):
+    return batch
+
+class Evaluator:
+    """Validation pass of a trainer with streaming accuracy.
+
+    batches() yields the validation minibatches with `stage` applied to each of them. With overlap,
+    a Prefetcher samples (and runs `stage` on) the next batch in a background thread while the
+    trainer runs the model on the current one.
+    update() only adds the number of correct predictions and the number of labels of a batch
+    to two counters on the device; accuracy() sums them over the ranks, so no logits are kept.
+
+    every: evaluate after every `every` epochs (and always after the last one), 0: last epoch only.
+    """
+    def __init__(self,
+                 loader,
+                 device: torch.device,
+                 world_size: int,
+                 total_epoch: int,
+                 stage=None,
+                 overlap: bool = True,
+                 depth: int = 1,
+                 every: int = 1):
+        self.loader = loader
+        self.stage = _identity if stage is None else stage
+        self.device = device
+        self.world_size = world_size
+        self.total_epoch = total_epoch
+        self.every = every
+        self.prefetcher = Prefetcher(loader, self.stage, device, depth=depth) if overlap else None
+        self.counts = torch.zeros(2, dtype=torch.int64, device=device) # correct, total
+
+    def should_run(self, epoch: int) -> bool:
+        if epoch == self.total_epoch - 1:
+            return True
+        return self.every > 0 and (epoch + 1) % self.every == 0
+
+    def batches(self):
+        self.counts.zero_()
+        if self.prefetcher is not None:
+            return self.prefetcher
+        return (self.stage(batch) for batch in self.loader)
+
+    def update(self, logits: torch.Tensor, labels: torch.Tensor):
+        self.counts[0] += (logits.argmax(dim=1) == labels).sum()
+        self.counts[1] += labels.shape[0]
+
+    def accuracy(self) -> float:
+        # collective when world_size > 1
+        if self.world_size > 1:
+            dist.all_reduce(self.counts, op=dist.ReduceOp.SUM)
+        correct, total = self.counts.tolist()
+        return correct / total if total > 0 else float("nan") # no validation batch
@@ -0,0 +1,181 @@
+# Export node embeddings (penultimate layer output) and logits of a trained model
+# The model runs over the whole graph with layer-wise full-neighbor inference (inference.LayerwiseInference):
+# every layer is computed once for all the nodes, each process a contiguous range of them. The penultimate
+# and the last layer buffers are then copied, for the requested node ids, into one shared memory-mapped
+# output file, every process writing its own range of rows
+# Example: python3 export.py --graph_name ogbn-products --model sage --checkpt logs/ogbn-products_v1_w4_uvafeat_uvatopo_h256_b1024_ckpt --dtype float16
+from __future__ import annotations
+import os
+import json
+import time
+import shutil
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import dgl
+from utils import RunConfig
+from run import create_model, load_worker_feat, ddp_setup
+from checkpoint import load_model_state
+from feat_store import FeatureStore
+from feat_quant import gather_rows
+from inference import LayerwiseInference, layer_widths
+from preprocess import GraphCache, load_dataset, timed, format_timings
+
+HEADER_SIZE = 4096 # bytes reserved for the json index
+EXPORT_DTYPES = {"float16": np.float16, "float32": np.float32}
+
+class EmbeddingFile:
+    """Node ids, embeddings and logits of num_rows nodes in one file.
+
+    Layout: a HEADER_SIZE byte json index (space padded) followed by
+    node_ids int64 [num_rows] | embeddings [num_rows, emb_dim] | logits [num_rows, num_classes],
+    embeddings and logits in float16 or float32. The index holds the shapes, the dtype and the byte
+    offset of every section, so a reader maps any section without parsing the rest of the file.
+    Row i of every section belongs to the same node.
+    """
+    def __init__(self, path: str, mode: str = "r"):
+        self.path = path
+        with open(path, "rb") as file:
+            self.index = json.loads(file.read(HEADER_SIZE).decode().strip())
+        num_rows = self.index["num_rows"]
+        dtype = EXPORT_DTYPES[self.index["dtype"]]
+        offsets = self.index["offsets"]
+        self.node_ids = np.memmap(path, dtype=np.int64, mode=mode, offset=offsets["node_ids"], shape=(num_rows,))
+        self.embeddings = np.memmap(path, dtype=dtype, mode=mode, offset=offsets["embeddings"], shape=(num_rows, self.index["emb_dim"]))
+        self.logits = np.memmap(path, dtype=dtype, mode=mode, offset=offsets["logits"], shape=(num_rows, self.index["num_classes"]))
+
+    @staticmethod
+    def create(path: str, num_rows: int, emb_dim: int, num_classes: int, dtype: str = "float16"):
+        # writes the index and sizes the file, the rows are filled in by the writers (mode "r+")
+        itemsize = np.dtype(EXPORT_DTYPES[dtype]).itemsize
+        offsets = {"node_ids": HEADER_SIZE}
+        offsets["embeddings"] = offsets["node_ids"] + num_rows * 8
+        offsets["logits"] = offsets["embeddings"] + num_rows * emb_dim * itemsize
+        size = offsets["logits"] + num_rows * num_classes * itemsize
+        index = {
+            "format": "p3-gnn-embeddings",
+            "version": 1,
+            "num_rows": num_rows,
+            "emb_dim": emb_dim,
+            "num_classes": num_classes,
+            "dtype": dtype,
+            "offsets": offsets,
+        }
+        header = json.dumps(index).encode()
+        assert len(header) <= HEADER_SIZE
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(header.ljust(HEADER_SIZE, b" "))
+            file.truncate(size)
+
+    def flush(self):
+        for section in [self.node_ids, self.embeddings, self.logits]:
+            section.flush()
+
+def row_range(num_rows: int, rank: int, world_size: int) -> tuple[int, int]:
+    step = int(np.ceil(num_rows / world_size))
+    start = min(rank * step, num_rows)
+    return start, min(start + step, num_rows)
+
+def export_worker(rank: int,
+                  world_size: int,
+                  config: RunConfig,
+                  feat: torch.Tensor | FeatureStore,
+                  nids: torch.Tensor,
+                  out_path: str,
+                  chunk_size: int):
+    ddp_setup(rank, world_size, config.backend)
+    config.rank = rank
+    device = config.get_device()
+    if isinstance(feat, FeatureStore):
+        feat = load_worker_feat(config, feat, 0)
+    graph = dgl.hetero_from_shared_memory("dglgraph").formats("csc")
+    model = create_model(config)
+    model.load_state_dict(load_model_state(config.checkpt_path))
+    model.eval()
+    # layer buffers next to the output, the penultimate one (the embeddings) is kept for the copy
+    engine = LayerwiseInference(graph, out_path + "_layers", device, rank, world_size, chunk_size)
+    widths = layer_widths(config)
+    num_layers = len(widths)
+    start_time = time.time()
+    logits = engine.layers(model, lambda input_nodes: gather_rows(feat, input_nodes, 'cpu', device), widths, keep=(num_layers - 2,))
+    embeddings = np.load(engine.layer_path(num_layers - 2), mmap_mode="r")
+    out = EmbeddingFile(out_path, mode="r+")
+    dtype = EXPORT_DTYPES[out.index["dtype"]]
+    start, end = row_range(nids.shape[0], rank, world_size)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        rows = nids[chunk_start:chunk_end].numpy()
+        out.node_ids[chunk_start:chunk_end] = rows
+        out.embeddings[chunk_start:chunk_end] = embeddings[rows].astype(dtype)
+        out.logits[chunk_start:chunk_end] = logits[rows].astype(dtype)
+    out.flush()
+    del embeddings, logits
+    dist.barrier()
+    if rank == 0:
+        shutil.rmtree(engine.out_dir)
+    elapsed = time.time() - start_time
+    print(f"rank {rank}: {engine.report()}, exported rows [{start}, {end}) in {elapsed:.2f}s")
+    dist.destroy_process_group()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='export node embeddings and logits of a trained model')
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--checkpt', required=True, type=str, help='Checkpoint directory of a run (logs/<run>_ckpt, modes 0-2) or a state_dict file')
+    parser.add_argument('--out', default="", type=str, help='Output file (default: logs/<graph_name>.emb)')
+    parser.add_argument('--nids', default="", type=str, help='Optional .npy file of the node ids to export (default: all the nodes)')
+    parser.add_argument('--dtype', default="float16", type=str, help='Stored dtype of the embeddings and logits', choices=list(EXPORT_DTYPES.keys()))
+    parser.add_argument('--model', default="gat", type=str, help='Model type: sage or gat', choices=['sage', 'gat'])
+    parser.add_argument('--num_heads', default=4, type=int, help='Number of heads for GAT model')
+    parser.add_argument('--hid_feats', default=256, type=int, help='Size of a hidden feature')
+    parser.add_argument('--num_layers', default=3, type=int, help='Number of layers of the model (at least 2)')
+    parser.add_argument('--chunk_size', default=16384, type=int, help='Destination nodes per block of the layer-wise inference and rows per copy into the output')
+    parser.add_argument('--nprocs', default=4, type=int, help='Number of GPUs / processes')
+    parser.add_argument('--device', default="cuda", type=str, choices=["cuda", "cpu"])
+    parser.add_argument('--cache', action='store_true', help='Read the preprocessed dataset from dataset/cache (see run.py --cache)')
+    args = parser.parse_args()
+    if args.num_layers < 2:
+        parser.error("--num_layers must be at least 2 (the embeddings are the output of the penultimate layer)")
+    project_dir = os.path.dirname(os.path.realpath(__file__))
+    data_dir = os.path.join(project_dir, "dataset")
+    out_path = args.out if args.out != "" else os.path.join(project_dir, "logs", f"{args.graph_name}.emb")
+
+    config = RunConfig()
+    config.device = args.device
+    config.backend = "nccl" if config.use_cuda() else "gloo"
+    world_size = min(args.nprocs, torch.cuda.device_count()) if config.use_cuda() else args.nprocs
+    config.world_size = world_size
+    config.graph_name = args.graph_name
+    config.model = args.model
+    config.num_heads = args.num_heads
+    config.hid_feats = args.hid_feats
+    config.checkpt_path = args.checkpt
+    config.feat = 'cpu'
+    config.fanouts = [-1] * args.num_layers # all the neighbors
+
+    timings = {}
+    graph, node_labels, idx_split, num_classes, feat, from_cache = load_dataset(args.graph_name, data_dir, timings, use_cache=args.cache)
+    config.num_classes = num_classes
+    config.global_in_feats = int(feat.shape[1])
+    if args.nids != "":
+        nids = torch.from_numpy(np.load(args.nids)).type(graph.idtype)
+    else:
+        nids = torch.arange(graph.num_nodes(), dtype=graph.idtype)
+    emb_dim = args.hid_feats if args.model == 'sage' else int(args.hid_feats / args.num_heads) * args.num_heads
+    EmbeddingFile.create(out_path, nids.shape[0], emb_dim, num_classes, args.dtype)
+    with timed(timings, "shared_memory"):
+        if from_cache:
+            shared_graph = graph.shared_memory("dglgraph", formats=["csc"])
+            # workers map the cached features instead of receiving a copy
+            feat = GraphCache(os.path.join(data_dir, "cache"), args.graph_name).feat_store()
+        else:
+            graph.create_formats_()
+            shared_graph = graph.shared_memory("dglgraph")
+    del graph
+    print("startup:", format_timings(timings))
+    start = time.time()
+    mp.spawn(export_worker, args=(world_size, config, feat, nids, out_path, args.chunk_size), nprocs=world_size)
+    elapsed = time.time() - start
+    print(f"exported {nids.shape[0]} nodes to {out_path} in {elapsed:.2f}s ({nids.shape[0] / elapsed:.0f} nodes/sec)")
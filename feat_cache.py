@@ -0,0 +1,120 @@
+from __future__ import annotations
+from typing import Callable
+import torch
+import dgl
+
+CACHE_POLICIES = ["degree", "presample", "lru", "lfu"]
+
+def degree_scores(graph: dgl.DGLGraph) -> torch.Tensor:
+    # in-degree is the number of sampled neighbor lists a node can appear in
+    return graph.in_degrees().float()
+
+def presample_scores(dataloader, num_nodes: int, num_batches: int = 8) -> torch.Tensor:
+    # how often every node is an input node in the first num_batches minibatches
+    scores = torch.zeros(num_nodes, dtype=torch.float32)
+    for idx, (input_nodes, _, _) in enumerate(dataloader):
+        if idx == num_batches:
+            break
+        scores[input_nodes.to('cpu').long()] += 1
+    return scores
+
+class FeatCache:
+    """Device-resident copy of the hottest rows of a (local) feature slice.
+
+    Sits in front of the uva / cpu feature gather of a trainer: gather(nids) serves cached rows
+    from device memory and fetches only the misses through fetch(nids).
+    Works on whatever slice the trainer holds, so with P2 / P3 every rank caches the hot rows
+    of its own get_local_feat columns. Rows are cached as fetch returns them: the trainers fetch
+    in the storage dtype of --feat_dtype (dtype / width of feat_storage) and decode the merged rows.
+
+    policy 'degree' / 'presample': the capacity highest-scoring nodes are cached once (static)
+    policy 'lru' / 'lfu': misses are admitted after every gather, replacing the least recently /
+    least frequently requested cached rows
+    """
+    def __init__(self,
+                 fetch: Callable[[torch.Tensor], torch.Tensor],
+                 num_nodes: int,
+                 width: int,
+                 capacity: int,
+                 device: torch.device,
+                 policy: str = "degree",
+                 scores: torch.Tensor = None,
+                 dtype: torch.dtype = torch.float32):
+        assert policy in CACHE_POLICIES, f"unknown cache policy {policy}"
+        self.fetch = fetch
+        self.policy = policy
+        self.device = device
+        self.capacity = min(capacity, num_nodes)
+        self.dynamic = policy in ["lru", "lfu"]
+        self.slot = torch.full([num_nodes], -1, dtype=torch.int32, device=device) # node id -> cache slot (-1: not cached)
+        self.owner = torch.full([self.capacity], -1, dtype=torch.int64, device=device) # cache slot -> node id
+        self.data = torch.zeros([self.capacity, width], dtype=dtype, device=device)
+        self.hits = torch.zeros([], dtype=torch.int64, device=device)
+        self.lookups = 0
+        self.step = 0
+        if policy == "lfu":
+            self.freq = torch.zeros([num_nodes], dtype=torch.int32, device=device)
+        elif policy == "lru":
+            self.last_used = torch.full([self.capacity], -1, dtype=torch.int64, device=device) # per slot
+        if not self.dynamic and self.capacity > 0:
+            assert scores is not None, f"policy {policy} requires node scores"
+            hot = torch.topk(scores.to(device), self.capacity).indices
+            self._fill(torch.arange(self.capacity, device=device), hot)
+
+    def _fill(self, slots: torch.Tensor, nids: torch.Tensor, rows: torch.Tensor = None):
+        if rows is None:
+            rows = self.fetch(nids.to(self.slot.dtype))
+        evicted = self.owner[slots]
+        self.slot[evicted[evicted >= 0]] = -1
+        self.owner[slots] = nids.long()
+        self.slot[nids.long()] = slots.to(self.slot.dtype)
+        self.data[slots] = rows.to(self.data.dtype)
+
+    def gather(self, nids: torch.Tensor) -> torch.Tensor:
+        self.step += 1
+        self.lookups += nids.shape[0]
+        if self.capacity == 0:
+            return self.fetch(nids)
+        nids_dev = nids.to(self.device).long()
+        slots = self.slot[nids_dev].long()
+        hit = slots >= 0
+        miss = ~hit
+        self.hits += hit.sum()
+        out = torch.empty([nids.shape[0], self.data.shape[1]], dtype=self.data.dtype, device=self.device)
+        out[hit] = self.data[slots[hit]]
+        miss_nids = nids[miss.to(nids.device)]
+        miss_rows = self.fetch(miss_nids)
+        out[miss] = miss_rows.to(self.data.dtype)
+        if self.dynamic:
+            self._update(nids_dev, slots[hit], nids_dev[miss], miss_rows)
+        return out
+
+    def _update(self, nids: torch.Tensor, hit_slots: torch.Tensor, miss_nids: torch.Tensor, miss_rows: torch.Tensor):
+        # input nodes of a minibatch are unique, plain indexing counts every node once
+        if self.policy == "lfu":
+            self.freq[nids] += 1
+            cand_score = self.freq[miss_nids].long()
+            slot_score = torch.where(self.owner >= 0, self.freq[self.owner.clamp(min=0)].long(), -1)
+        else: # lru
+            self.last_used[hit_slots] = self.step
+            cand_score = torch.full([miss_nids.shape[0]], self.step, dtype=torch.int64, device=self.device)
+            slot_score = self.last_used
+        num = min(miss_nids.shape[0], self.capacity)
+        if num == 0:
+            return
+        # pair the best candidates with the worst cached rows, admit where the candidate wins
+        cand_score, cand = torch.topk(cand_score, num)
+        victim_score, victims = torch.topk(slot_score, num, largest=False)
+        admit = cand_score > victim_score
+        cand = cand[admit]
+        victims = victims[admit]
+        self._fill(victims, miss_nids[cand], miss_rows[cand])
+        if self.policy == "lru":
+            self.last_used[victims] = self.step
+
+    def reset_stats(self) -> float:
+        # hit rate since the last call
+        hit_rate = self.hits.item() / self.lookups if self.lookups > 0 else 0.0
+        self.hits.zero_()
+        self.lookups = 0
+        return hit_rate
@@ -0,0 +1,115 @@
+from __future__ import annotations
+import torch
+from dgl.utils import gather_pinned_tensor_rows
+
+FEAT_DTYPES = {"float32": torch.float32, "float16": torch.float16} # plain casts
+FEAT_STORAGE = list(FEAT_DTYPES.keys()) + ["int8"] # --feat_dtype choices, int8: QuantizedFeat
+
+def column_range(feat: torch.Tensor, chunk_rows: int = 1 << 20) -> tuple[torch.Tensor, torch.Tensor]:
+    # per-column min / max, chunk_rows rows at a time (feat may be memory-mapped)
+    low = torch.full((feat.shape[1],), float("inf"))
+    high = torch.full((feat.shape[1],), float("-inf"))
+    for start in range(0, feat.shape[0], chunk_rows):
+        chunk = feat[start:start + chunk_rows].float()
+        low = torch.minimum(low, chunk.amin(dim=0))
+        high = torch.maximum(high, chunk.amax(dim=0))
+    return low, high
+
+class QuantizedFeat:
+    """Node features stored as uint8 codes with a per-column scale and zero point (--feat_dtype int8).
+
+    feat[:, c] ~ (code[:, c] - zero_point[c]) * scale[c], with scale = (max - min) / 255 and
+    zero_point = -min / scale of every column, so the min and max of a column are exact and
+    the error of any value is at most scale / 2.
+    The rows of the codes are padded to a multiple of 4 bytes: the gathers (gpu / cpu indexing,
+    gather_pinned_tensor_rows) run on the int32 view `packed` and move a quarter of the float32
+    bytes; dequantize() restores float32 rows on the device right before the first layer.
+    shape is the shape of the float32 matrix.
+    """
+    def __init__(self, codes: torch.Tensor, scale: torch.Tensor, zero_point: torch.Tensor):
+        assert codes.dtype == torch.uint8 and codes.shape[1] % 4 == 0
+        self.codes = codes # [num_nodes, padded width]
+        self.scale = scale # float32 [width]
+        self.zero_point = zero_point # float32 [width]
+        self.params: dict[torch.device, tuple[torch.Tensor, torch.Tensor]] = {}
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size([self.codes.shape[0], self.scale.shape[0]])
+
+    @property
+    def packed(self) -> torch.Tensor:
+        return self.codes.view(torch.int32)
+
+    @staticmethod
+    def padded_width(width: int) -> int:
+        return (width + 3) // 4 * 4
+
+    @staticmethod
+    def params_of(low: torch.Tensor, high: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # constant columns (e.g. the zero padding of get_local_feat) get scale 1
+        span = high - low
+        scale = torch.where(span > 0, span / 255, torch.ones_like(span))
+        return scale, -low / scale
+
+    @staticmethod
+    def encode(rows: torch.Tensor, scale: torch.Tensor, zero_point: torch.Tensor) -> torch.Tensor:
+        codes = torch.zeros((rows.shape[0], QuantizedFeat.padded_width(rows.shape[1])), dtype=torch.uint8)
+        codes[:, :rows.shape[1]] = torch.round(rows.float() / scale + zero_point).clamp_(0, 255).to(torch.uint8)
+        return codes
+
+    @staticmethod
+    def quantize(feat: torch.Tensor, chunk_rows: int = 1 << 20) -> QuantizedFeat:
+        scale, zero_point = QuantizedFeat.params_of(*column_range(feat, chunk_rows))
+        codes = torch.empty((feat.shape[0], QuantizedFeat.padded_width(feat.shape[1])), dtype=torch.uint8)
+        for start in range(0, feat.shape[0], chunk_rows):
+            end = min(start + chunk_rows, feat.shape[0])
+            codes[start:end] = QuantizedFeat.encode(feat[start:end], scale, zero_point)
+        return QuantizedFeat(codes, scale, zero_point)
+
+    def dequantize(self, packed_rows: torch.Tensor) -> torch.Tensor:
+        device = packed_rows.device
+        if device not in self.params:
+            self.params[device] = (self.scale.to(device), self.zero_point.to(device))
+        scale, zero_point = self.params[device]
+        codes = packed_rows.view(torch.uint8)[:, :self.shape[1]]
+        return (codes.float() - zero_point) * scale
+
+    def to(self, device: torch.device) -> QuantizedFeat:
+        return QuantizedFeat(self.codes.to(device), self.scale.to(device), self.zero_point.to(device))
+
+    def clone(self) -> QuantizedFeat:
+        return QuantizedFeat(self.codes.clone(), self.scale.clone(), self.zero_point.clone())
+
+    def nbytes(self) -> int:
+        return self.codes.numel() + 8 * self.scale.numel()
+
+def compress_feat(feat: torch.Tensor, feat_dtype: str) -> torch.Tensor | QuantizedFeat:
+    # copy of feat in the storage dtype of --feat_dtype
+    if feat_dtype == "int8":
+        return QuantizedFeat.quantize(feat)
+    return feat.to(FEAT_DTYPES[feat_dtype], copy=True)
+
+def feat_storage(feat: torch.Tensor | QuantizedFeat) -> torch.Tensor:
+    # the tensor holding the rows (what uva pins)
+    return feat.packed if isinstance(feat, QuantizedFeat) else feat
+
+def fetch_rows(feat: torch.Tensor | QuantizedFeat, input_nodes: torch.Tensor, mode: str, device: torch.device) -> torch.Tensor:
+    # rows of input_nodes on device, still in the storage dtype (packed codes for int8)
+    data = feat_storage(feat)
+    if mode == 'gpu':
+        return data[input_nodes]
+    if mode == 'uva':
+        return gather_pinned_tensor_rows(data, input_nodes)
+    return data[input_nodes.to('cpu')].to(device) # 'cpu'
+
+def decode_rows(feat: torch.Tensor | QuantizedFeat, rows: torch.Tensor) -> torch.Tensor:
+    # float32 rows of the fetch_rows output
+    if isinstance(feat, QuantizedFeat):
+        return feat.dequantize(rows)
+    return rows.float()
+
+def gather_rows(feat: torch.Tensor | QuantizedFeat, input_nodes: torch.Tensor, mode: str, device: torch.device) -> torch.Tensor:
+    """float32 rows of input_nodes on device. mode: gpu / uva / cpu feature extraction.
+    The rows are moved in the storage dtype and converted on the device."""
+    return decode_rows(feat, fetch_rows(feat, input_nodes, mode, device))
@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+import torch
+from utils import get_local_feat
+from feat_quant import FEAT_DTYPES, QuantizedFeat, column_range
+
+class FeatureStore:
+    """Node features on disk, split by column into one .npy file per rank.
+
+    Layout: {root}/{graph_name}_w{world_size}/part{rank}.npy + meta.json
+    Every part holds get_local_feat(rank, world_size, feat, padding) for all the nodes,
+    so P2 / P3 workers can memory-map only their own column slice instead of
+    receiving an in-memory copy from the launcher. world_size=1 stores the full matrix.
+    dtype: storage dtype of the parts (--feat_dtype, None: the dtype of feat); int8 parts are the uint8
+    codes of a QuantizedFeat, with the per-column scale and zero point of the part in part{rank}_scale.npy.
+    """
+    def __init__(self, root: str, graph_name: str, world_size: int, padding: bool = True, dtype: str = None):
+        self.world_size = world_size
+        self.padding = padding
+        self.dtype = dtype
+        self.dir = os.path.join(root, f"{graph_name}_w{world_size}")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.meta = None
+        if self.exists():
+            with open(self.meta_path) as file:
+                self.meta = json.load(file)
+
+    def part_path(self, rank: int) -> str:
+        return os.path.join(self.dir, f"part{rank}.npy")
+
+    def scale_path(self, rank: int) -> str:
+        return os.path.join(self.dir, f"part{rank}_scale.npy")
+
+    def exists(self) -> bool:
+        # meta.json is written last, a partially written store is rebuilt
+        return os.path.exists(self.meta_path)
+
+    def write(self, feat: torch.Tensor, chunk_rows: int = 1 << 20):
+        """Convert feat into per-rank column slices, chunk_rows rows at a time
+        (no full copy of any slice is materialized in memory)."""
+        os.makedirs(self.dir, exist_ok=True)
+        num_nodes = feat.shape[0]
+        widths = []
+        if self.dtype == "int8":
+            bounds = torch.stack(column_range(feat, chunk_rows)) # [min; max] of every column
+        for rank in range(self.world_size):
+            local_feat = lambda rows: get_local_feat(rank, self.world_size, rows, self.padding)
+            width = local_feat(feat[:1]).shape[1]
+            widths.append(width)
+            if self.dtype == "int8":
+                scale, zero_point = QuantizedFeat.params_of(*local_feat(bounds)) # padding columns: min = max = 0
+                np.save(self.scale_path(rank), torch.stack([scale, zero_point]).numpy())
+                encode = lambda rows: QuantizedFeat.encode(rows, scale, zero_point)
+                dtype, stored_width = np.uint8, QuantizedFeat.padded_width(width)
+            else:
+                encode = lambda rows: rows if self.dtype is None else rows.to(FEAT_DTYPES[self.dtype])
+                dtype, stored_width = encode(feat[:1]).numpy().dtype, width
+            part = np.lib.format.open_memmap(self.part_path(rank), mode="w+", dtype=dtype, shape=(num_nodes, stored_width))
+            for start in range(0, num_nodes, chunk_rows):
+                end = min(start + chunk_rows, num_nodes)
+                part[start:end] = encode(local_feat(feat[start:end])).numpy()
+            part.flush()
+            del part
+        self.meta = {
+            "num_nodes": num_nodes,
+            "org_width": feat.shape[1],
+            "local_width": widths[0],
+            "widths": widths,
+            "world_size": self.world_size,
+            "padding": self.padding,
+            "dtype": self.dtype,
+        }
+        with open(self.meta_path, "w") as file:
+            json.dump(self.meta, file)
+
+    def local_width(self) -> int:
+        return self.meta["local_width"]
+
+    def global_width(self) -> int:
+        return sum(self.meta["widths"])
+
+    def load(self, rank: int) -> torch.Tensor | QuantizedFeat:
+        # copy-on-write mapping: pages are read from disk on demand and shared
+        # through the page cache, the tensor is writable without touching the file
+        part = torch.from_numpy(np.load(self.part_path(rank), mmap_mode="c"))
+        if self.meta.get("dtype") == "int8":
+            scale, zero_point = torch.from_numpy(np.load(self.scale_path(rank)))
+            return QuantizedFeat(part, scale, zero_point)
+        return part
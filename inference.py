@@ -0,0 +1,130 @@
+from __future__ import annotations
+import os
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import dgl
+
+class LayerwiseInference:
+    """Full-neighbor inference of every node of the graph, one layer at a time.
+
+    Sampled minibatch inference recomputes the same neighborhoods for many seeds; here layer l
+    is computed once for all the nodes: the nodes are cut into chunks of chunk_size, every chunk
+    becomes a one-layer block with all the in-neighbors of its nodes, and the outputs are streamed
+    into a memory-mapped [num_nodes, width] buffer {out_dir}/layer{l}.npy, which the next layer
+    reads its inputs from. The buffer of layer l - 1 is deleted once layer l is written.
+
+    Every rank computes a contiguous 1 / world_size of the nodes of a layer (rank 0 creates the
+    buffers, all the ranks write their rows into the same file).
+    p3_first_layer() instead follows the P3 first layer: every rank computes the partial
+    outputs of all the nodes on its feature columns and the partials are summed on the rank
+    owning the chunk with dist.reduce.
+    """
+    def __init__(self,
+                 graph: dgl.DGLGraph,
+                 out_dir: str,
+                 device: torch.device,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 chunk_size: int = 16384):
+        self.graph = graph # sampled on the host, or through uva when the trainer's loader pinned it
+        self.out_dir = out_dir
+        self.device = device
+        self.rank = rank
+        self.world_size = world_size
+        self.chunk_size = chunk_size
+        self.num_nodes = graph.num_nodes()
+        self.sampler = dgl.dataloading.MultiLayerFullNeighborSampler(1)
+        self.layer_time: list[float] = []
+
+    def _barrier(self):
+        if self.world_size > 1:
+            dist.barrier()
+
+    def layer_path(self, layer_idx: int) -> str:
+        return os.path.join(self.out_dir, f"layer{layer_idx}.npy")
+
+    def _open(self, layer_idx: int, width: int) -> np.memmap:
+        path = self.layer_path(layer_idx)
+        if self.rank == 0:
+            os.makedirs(self.out_dir, exist_ok=True)
+            np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(self.num_nodes, width)).flush()
+        self._barrier()
+        return np.load(path, mmap_mode="r+")
+
+    def _release(self, layer_idx: int):
+        # every rank finished reading layer_idx
+        self._barrier()
+        if self.rank == 0:
+            os.remove(self.layer_path(layer_idx))
+
+    def _chunks(self, start: int, end: int):
+        for chunk_start in range(start, end, self.chunk_size):
+            yield chunk_start, min(chunk_start + self.chunk_size, end)
+
+    def _block(self, start: int, end: int) -> tuple[torch.Tensor, dgl.DGLGraph]:
+        seeds = torch.arange(start, end, dtype=self.graph.idtype)
+        if self.graph.is_pinned():
+            seeds = seeds.to(self.device)
+        input_nodes, _, blocks = self.sampler.sample(self.graph, seeds)
+        return input_nodes.to(self.device), blocks[0].to(self.device)
+
+    def reader(self, buffer: np.memmap):
+        # feat_fn reading the rows of input_nodes from a layer buffer
+        return lambda input_nodes: torch.from_numpy(buffer[input_nodes.cpu().numpy()]).to(self.device)
+
+    @torch.no_grad()
+    def p3_first_layer(self, layer, feat_fn, width: int) -> np.memmap:
+        """layer: this rank's first layer (on its feature columns), feat_fn(input_nodes): its local features.
+        Collective: every rank runs all the chunks in the same order."""
+        start_time = time.time()
+        out = self._open(0, width)
+        for chunk_idx, (start, end) in enumerate(self._chunks(0, self.num_nodes)):
+            input_nodes, block = self._block(start, end)
+            hid = layer(block, feat_fn(input_nodes)).contiguous()
+            owner = chunk_idx % self.world_size
+            if self.world_size > 1:
+                dist.reduce(hid, dst=owner)
+            if self.rank == owner:
+                out[start:end] = hid.cpu().numpy()
+        out.flush()
+        self.layer_time.append(time.time() - start_time)
+        return out
+
+    @torch.no_grad()
+    def layers(self, model: torch.nn.Module, feat_fn, widths: list[int], first_layer_idx: int = 0, keep: tuple[int] = ()) -> np.memmap:
+        """Runs model.forward_layer(i, block, h) for i = 0 .. len(widths) - 1 over all the nodes.
+        first_layer_idx: index of the model's first layer in the full network (1 for the P3 remaining layers).
+        keep: layer indices whose buffers are not deleted once the next layer is written."""
+        step = int(np.ceil(self.num_nodes / self.world_size))
+        start = min(self.rank * step, self.num_nodes)
+        end = min(start + step, self.num_nodes)
+        out = None
+        for idx, width in enumerate(widths):
+            start_time = time.time()
+            layer_idx = first_layer_idx + idx
+            out = self._open(layer_idx, width)
+            for chunk_start, chunk_end in self._chunks(start, end):
+                input_nodes, block = self._block(chunk_start, chunk_end)
+                out[chunk_start:chunk_end] = model.forward_layer(idx, block, feat_fn(input_nodes)).cpu().numpy()
+            out.flush()
+            if layer_idx > 0 and layer_idx - 1 not in keep:
+                self._release(layer_idx - 1)
+            self._barrier() # the next layer reads rows of the other ranks
+            self.layer_time.append(time.time() - start_time)
+            feat_fn = self.reader(out)
+        return out
+
+    def report(self) -> str:
+        total = sum(self.layer_time)
+        layers = " | ".join(f"layer{idx} {t:.2f}s" for idx, t in enumerate(self.layer_time))
+        return (f"inference: {self.num_nodes} nodes in {total:.2f}s ({self.num_nodes / max(total, 1e-9):.0f} nodes/sec)"
+                f" | {layers} | output {self.out_dir}")
+
+def layer_widths(config) -> list[int]:
+    # output width of every layer of create_model / create_p3_model
+    hid_feats = config.hid_feats
+    if config.model == 'gat':
+        hid_feats = int(config.hid_feats / config.num_heads) * config.num_heads # heads are flattened
+    return [hid_feats] * (len(config.fanouts) - 1) + [config.num_classes]
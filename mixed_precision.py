@@ -0,0 +1,87 @@
+from __future__ import annotations
+import os
+import csv
+import torch
+import torch.distributed as dist
+
+class MixedPrecision:
+    """Autocast and loss scaling of a trainer (--amp).
+
+    cuda: float16 autocast with a GradScaler (dynamic loss scale, steps with inf / nan gradients are skipped).
+    cpu: bfloat16 autocast; bfloat16 has the float32 exponent range, so the loss is not scaled.
+    Disabled, every method is a pass-through and the trainers call them unconditionally.
+
+    P3: the gradients a gpu receives for its local first layer were scaled by the loss scale of the
+    gpu that sent them, so all the gpus must use the same scale. The data-parallel gradients are
+    identical after the DDP allreduce, but the local ones (and so the inf checks) differ per gpu:
+    step(optimizer, sync=True) skips the step on every gpu when the gradients of any gpu are not
+    finite, so all the gpus make the same skip / growth decision and keep the same scale.
+    """
+    def __init__(self, enabled: bool, device: torch.device, world_size: int = 1):
+        self.enabled = enabled
+        self.device = device
+        self.world_size = world_size
+        self.dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype, enabled=self.enabled)
+
+    def scale(self, loss: torch.Tensor) -> torch.Tensor:
+        return self.scaler.scale(loss)
+
+    def step(self, optimizer: torch.optim.Optimizer, sync: bool = False):
+        if sync and self.scaler.is_enabled() and self.world_size > 1:
+            self._sync_found_inf(optimizer)
+        self.scaler.step(optimizer)
+
+    def _sync_found_inf(self, optimizer: torch.optim.Optimizer):
+        # on the device (no host sync): when any gpu has a non-finite gradient, one gradient value of
+        # every gpu is set to inf, so the inf check of the scaler skips the step everywhere
+        grads = [p.grad for group in optimizer.param_groups for p in group["params"] if p.grad is not None]
+        if len(grads) == 0:
+            return
+        found_inf = torch.stack([(~torch.isfinite(grad)).any() for grad in grads]).any().float()
+        dist.all_reduce(found_inf, op=dist.ReduceOp.MAX)
+        first = grads[0].view(-1)[:1]
+        first.copy_(torch.where(found_inf > 0, torch.full_like(first, float("inf")), first))
+
+    def update(self):
+        self.scaler.update()
+
+    def state_dict(self) -> dict:
+        # loss scale and growth tracker (empty when disabled)
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state: dict):
+        if self.scaler.is_enabled() and state:
+            self.scaler.load_state_dict(state)
+
+    def loss_scale(self) -> float:
+        return self.scaler.get_scale() if self.scaler.is_enabled() else 1.0
+
+class PrecisionBaseline:
+    """Per-epoch val_acc / throughput of the full precision run of the same configuration.
+
+    With --amp or a half precision feature store the log path gets a precision tag; the log of the
+    float32 run (same path without the tag) is read, if it exists, and every epoch reports
+    acc_delta = val_acc - baseline val_acc and speedup = throughput / baseline throughput.
+    """
+    def __init__(self, path: str):
+        self.rows: dict[int, dict] = {}
+        if path is None or not os.path.exists(path):
+            return
+        with open(path) as file:
+            for row in csv.DictReader(file):
+                self.rows[int(row["epoch"])] = row
+
+    def delta(self, epoch: int, val_acc: float, throughput: float) -> dict:
+        row = self.rows.get(epoch)
+        if row is None:
+            return {}
+        delta = {}
+        if row.get("val_acc", "nan") != "nan" and val_acc == val_acc: # skipped evaluations are nan
+            delta["acc_delta"] = val_acc - float(row["val_acc"])
+        if float(row.get("throughput", 0) or 0) > 0:
+            delta["speedup"] = throughput / float(row["throughput"])
+        return delta
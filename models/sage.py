@@ -3,6 +3,8 @@ from dgl.nn.pytorch.conv import SAGEConv
 import torch.nn as nn
 import torch
 import torch.distributed as dist
+from utils import DeviceEvent, device_synchronize
+from comm import all_gather_var, OverlappedReduce, WireCodec
 
 class Sage(nn.Module):
     def __init__(self, in_feats: int, hid_feats: int, num_layers: int, out_feats: int):
@@ -26,21 +28,30 @@ class Sage(nn.Module):
 
     def forward(self, blocks, feat):
         hid_feats = feat
-        l1_start = torch.cuda.Event(enable_timing=True)
+        l1_start = DeviceEvent(feat.device)
         l1_start.record()
         for layer_idx, (layer, block) in enumerate(zip(self.layers, blocks)):
             hid_feats = layer(block, hid_feats)
             if (layer_idx == 0):
-                l1_end = torch.cuda.Event(enable_timing=True)
+                l1_end = DeviceEvent(feat.device)
                 l1_end.record()
                 self.fwd_l1_timer.append((l1_start, l1_end))   
             if layer_idx != len(self.layers) - 1:
                 hid_feats = self.activation(hid_feats)
                 hid_feats = self.dropout(hid_feats)
         return hid_feats
-    
+
+    def forward_layer(self, layer_idx: int, block, feat):
+        # layer layer_idx of forward() on its own (layer-wise inference)
+        hid_feats = self.layers[layer_idx](block, feat)
+        if layer_idx != len(self.layers) - 1:
+            hid_feats = self.activation(hid_feats)
+            hid_feats = self.dropout(hid_feats)
+        return hid_feats
+
     def fwd_l1_time(self):
-        torch.cuda.synchronize()
+        if len(self.fwd_l1_timer) > 0:
+            device_synchronize(self.fwd_l1_timer[0][0].device)
         fwd_time = 0.0
         for l1_start, l1_end in self.fwd_l1_timer:
             fwd_time += l1_start.elapsed_time(l1_end)
@@ -48,9 +59,9 @@ class Sage(nn.Module):
         return fwd_time
     
     
-def create_sage_p3(rank:int, in_feats:int, hid_feats:int, num_classes:int, num_layers: int) -> tuple[nn.Module, nn.Module]:
-    first_layer = SAGEConv(in_feats=in_feats, out_feats=hid_feats, aggregator_type="mean").to(rank) # Intra-Model Parallel
-    remain_layers = SageP3(in_feats, hid_feats, num_layers, num_classes).to(rank) # Data Parallel
+def create_sage_p3(device: torch.device, in_feats:int, hid_feats:int, num_classes:int, num_layers: int) -> tuple[nn.Module, nn.Module]:
+    first_layer = SAGEConv(in_feats=in_feats, out_feats=hid_feats, aggregator_type="mean").to(device) # Intra-Model Parallel
+    remain_layers = SageP3(in_feats, hid_feats, num_layers, num_classes).to(device) # Data Parallel
     return (first_layer, remain_layers)
 
 
@@ -63,28 +74,33 @@ class SageP3Shuffle(torch.autograd.Function):
                 self_rank: int, 
                 world_size:int,
                 local_hid: torch.Tensor,
-                local_hids: list[torch.Tensor],
-                global_grads: list[torch.Tensor])->torch.Tensor:
+                local_hids: list[torch.Tensor] | OverlappedReduce,
+                global_grads: list[torch.Tensor],
+                codec: WireCodec = None)->torch.Tensor:
         # print(f"forward {self_rank=} {world_size=} {local_hid.shape}")        
         ctx.self_rank = self_rank
         ctx.world_size = world_size
         ctx.global_grads = global_grads
-        # aggregated_hid = torch.clone(local_hid)
+        ctx.codec = codec
+        if isinstance(local_hids, OverlappedReduce):
+            # reductions were started by the caller while it computed the first layer
+            return local_hids.wait()
         aggregated_hid = local_hid.detach().clone()
-        handle = None
+        handles = []
         for r in range(world_size):
             if r == self_rank:
-                handle = dist.reduce(tensor=aggregated_hid, dst=r, async_op=True) # gathering data from other GPUs
+                handles.append(dist.reduce(tensor=aggregated_hid, dst=r, async_op=True)) # gathering data from other GPUs
             else:
-                dist.reduce(tensor=local_hids[r], dst=r, async_op=True) # TODO: Async gathering data from other GPUs
-        handle.wait()
+                handles.append(dist.reduce(tensor=local_hids[r].detach(), dst=r, async_op=True)) # sending data to other GPUs
+        for handle in handles:
+            handle.wait()
         return aggregated_hid
     
     @staticmethod
     def backward(ctx, grad_outputs):
         # print(f"self.rank={ctx.self_rank} send_grad_shape={grad_outputs.shape} global_grads_shape={[x.shape for x in ctx.global_grads]}")
-        dist.all_gather(tensor=grad_outputs, tensor_list=ctx.global_grads)
-        return None, None, grad_outputs, None, None
+        all_gather_var(tensor_list=ctx.global_grads, tensor=grad_outputs, codec=ctx.codec)
+        return None, None, grad_outputs, None, None, None
     
     
 class SageP3(nn.Module):
@@ -118,4 +134,12 @@ class SageP3(nn.Module):
             if layer_idx != len(self.layers) - 1:
                 hid_feats = self.activation(hid_feats)
                 hid_feats = self.dropout(hid_feats)
-        return hid_feats
\ No newline at end of file
+        return hid_feats
+
+    def forward_layer(self, layer_idx: int, block, feat):
+        # layer layer_idx of forward() on its own (layer-wise inference)
+        hid_feats = self.layers[layer_idx](block, feat)
+        if layer_idx != len(self.layers) - 1:
+            hid_feats = self.activation(hid_feats)
+            hid_feats = self.dropout(hid_feats)
+        return hid_feats
@@ -1,19 +1,41 @@
+from __future__ import annotations
 import torch
 import torch.nn.functional as F
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
 import torch.distributed as dist
-from torch.cuda import Event as event
 import time
 from dgl.dataloading import DataLoader as DglDataLoader
 from dgl import create_block
-from dgl.utils import gather_pinned_tensor_rows
-
-import csv
-import torchmetrics.functional as MF
-from utils import RunConfig, TrainProfiler, QuiverDglSageSample
+from utils import RunConfig, TrainProfiler, device_synchronize, ddp_wrap, quiver
+from tracer import Tracer
+from checkpoint import Checkpointer, rng_state, set_rng_state
+from eval_engine import Evaluator
+from mixed_precision import MixedPrecision, PrecisionBaseline
+from inference import LayerwiseInference, layer_widths
 from models.sage import SageP3Shuffle
-import quiver
+from comm import all_gather_var, allreduce_hook, SizeExchange, PackedAllGather, OverlappedReduce, WireCodec, WIRE_DTYPES, wire_stats
+from prefetch import Prefetcher
+from feat_cache import FeatCache
+from feat_quant import decode_rows, feat_storage, fetch_rows, gather_rows
+from sample_workers import WorkerPoolLoader
+from straggler import WaitRecorder, BlockSizeLog
+
+class P3ExchangeBuffer:
+    """Top blocks and local feature slices of all the gpus for one minibatch."""
+    def __init__(self, world_size: int, est_node_size: int, nid_dtype: torch.dtype, device: torch.device):
+        self.edge_size_lst: list = [(0, 0, 0, 0)] * world_size #(rank, num_edges, num_src_nodes, num_dst_nodes)
+        self.input_node_buffer_lst: list[torch.Tensor] = [] # storing input nodes
+        self.src_edge_buffer_lst: list[torch.Tensor] = [] # storing src nodes
+        self.dst_edge_buffer_lst: list[torch.Tensor] = [] # storing dst nodes
+        self.input_feat_buffer_lst: list[torch.Tensor] = [None] * world_size # storing local features of the input nodes
+        for idx in range(world_size):
+            self.input_node_buffer_lst.append(torch.zeros(est_node_size, dtype=nid_dtype, device=device))
+            self.src_edge_buffer_lst.append(torch.zeros(est_node_size, dtype=nid_dtype, device=device))
+            self.dst_edge_buffer_lst.append(torch.zeros(est_node_size, dtype=nid_dtype, device=device))
+        self.output_nodes: torch.Tensor = None
+        self.blocks: list = None
+        self.dedup_ratio: float = 1.0 # input nodes of all the gpus / unique input nodes
+        # packed mode: input nodes, src and dst edges of all the gpus are received into one arena
+        self.packer = PackedAllGather(world_size, nid_dtype, device, capacity=3 * est_node_size)
 
 class P3Trainer:
     def __init__(
@@ -27,12 +49,13 @@ class P3Trainer:
         node_labels: torch.Tensor,
         global_optimizer: torch.optim.Optimizer,
         local_optimizer: torch.optim.Optimizer,
-        nid_dtype: torch.dtype = torch.int32
+        nid_dtype: torch.dtype = torch.int32,
+        cache_scores: torch.Tensor = None # node ranking of the static feature cache policies
     ) -> None:
         self.config = config
         self.rank = config.rank
         self.world_size = config.world_size
-        self.device = torch.device(f"cuda:{self.rank}")
+        self.device = config.get_device()
         self.local_feat = local_feat
         self.node_labels = node_labels
         self.train_data = train_data
@@ -41,35 +64,222 @@ class P3Trainer:
         self.local_optimizer = local_optimizer
         self.local_model = local_model
         self.feat_mode = config.feat
+        self.packed_gather = config.packed_gather
+        self.dedup = config.dedup_input
+        self.fused = config.fused_first_layer
+        self.fused_hid: torch.Tensor = None # first layer output of all the gpus (fused mode)
         
+        self.waits = WaitRecorder(self.rank, self.world_size, self.device, config.aux_path("wait"), enabled=config.straggler_report)
         if config.world_size == 1:
             self.model = global_model
         elif config.world_size > 1:
-            self.model = DDP(global_model, device_ids=[self.rank], output_device=self.rank)
+            self.model = ddp_wrap(global_model, self.device, comm_hook=self.waits.comm_hook if config.straggler_report else allreduce_hook)
         self.num_classes = config.num_classes
         self.save_every = config.save_every        
         self.log = TrainProfiler(config.log_path)
-        self.checkpt_path = config.checkpt_path
-        # Initialize buffers for storing feature data fetched from other GPUs
-        self.edge_size_lst: list = [(0, 0, 0, 0)] * self.world_size #(rank, num_edges, num_dst_nodes, num_src_nodes)
+        self.tracer = Tracer(self.rank, enabled=config.trace)
+        if config.straggler_report and config.prefetch and self.rank == 0:
+            print("--straggler_report with --prefetch: the size / edge all_gather runs in the prefetch thread and is not in the wait report")
+        self.block_sizes = BlockSizeLog(config.aux_path("blocks"), enabled=config.log_block_sizes and self.rank == 0)
+        self.checkpointer = Checkpointer(config.checkpt_dir(), self.rank, self.world_size, device=self.device)
+        self.start_epoch = 0
+        self.amp = MixedPrecision(config.amp, self.device, self.world_size)
+        self.baseline = PrecisionBaseline(config.baseline_log_path())
         self.est_node_size = self.config.batch_size * 20
         self.local_feat_width = self.local_feat.shape[1]
-        self.input_node_buffer_lst: list[torch.Tensor] = [] # storing input nodes 
-        self.input_feat_buffer_lst: list[torch.Tensor] = [] # storing input nodes 
-        self.src_edge_buffer_lst: list[torch.Tensor] = [] # storing src nodes
-        self.dst_edge_buffer_lst: list[torch.Tensor] = [] # storing dst nodes 
+        self.feat_cache = None
+        if config.feat_cache_ratio > 0 and self.feat_mode != 'gpu':
+            # hot rows of this gpu's local slice, looked up with the input nodes of every gpu
+            num_nodes = self.local_feat.shape[0]
+            # the cached rows stay in the storage dtype of --feat_dtype, decoded after the hit / miss merge
+            storage = feat_storage(self.local_feat)
+            self.feat_cache = FeatCache(self._fetch_local_rows, num_nodes, storage.shape[1], int(config.feat_cache_ratio * num_nodes),
+                                        self.device, policy=config.feat_cache_policy, scores=cache_scores, dtype=storage.dtype)
+        self.nid_dtype = nid_dtype
         self.global_grad_lst: list[torch.Tensor] = [] # storing feature data gathered for other gpus
         self.local_hid_buffer_lst: list[torch.Tensor] = [None] * self.world_size # storing feature data gathered from other gpus
         self.hid_feats = self.config.hid_feats
         for idx in range(self.world_size):
-            self.input_node_buffer_lst.append(torch.zeros(self.est_node_size, dtype=nid_dtype, device=self.device))
-            self.src_edge_buffer_lst.append(torch.zeros(self.est_node_size, dtype=nid_dtype, device=self.device))
-            self.dst_edge_buffer_lst.append(torch.zeros(self.est_node_size, dtype=nid_dtype, device=self.device))
             self.global_grad_lst.append(torch.zeros([self.est_node_size, self.hid_feats], dtype=torch.float32, device=self.device))
-            self.input_feat_buffer_lst.append(torch.zeros([self.est_node_size, self.hid_feats], dtype=torch.float32, device=self.device))
+        # Initialize buffers for storing feature data fetched from other GPUs
+        self.exchange_buffer = P3ExchangeBuffer(self.world_size, self.est_node_size, nid_dtype, self.device)
+        self.size_exchange = SizeExchange(self.world_size, 3, self.device) # num_edges, num_src_nodes, num_dst_nodes
 
-        self.stream = torch.cuda.current_stream(self.device)
         self.shuffle = SageP3Shuffle.apply
+        self.shuffle_mode = config.shuffle_mode
+        # wire format of the hidden features / gradients moved by the shuffle
+        self.codec = WireCodec(WIRE_DTYPES[config.comm_dtype], row_scale=config.comm_row_scale)
+        self.reducer = OverlappedReduce(self.rank, self.world_size, mode="reduce_scatter" if self.shuffle_mode == "reduce_scatter" else "reduce", codec=self.codec)
+        self.prefetcher = None
+        if config.prefetch:
+            # The prefetch thread issues its collectives on a dedicated communicator,
+            # otherwise they could interleave with the shuffle / DDP allreduce in a different order on every rank
+            self.prefetch_group = dist.new_group(backend=config.backend)
+            self.prefetch_size_exchange = SizeExchange(self.world_size, 3, self.device, group=self.prefetch_group)
+            # one buffer for the batch being trained, one being filled and one per queued batch
+            self.prefetch_buffers = [P3ExchangeBuffer(self.world_size, self.est_node_size, nid_dtype, self.device) for _ in range(config.prefetch_depth + 2)]
+            self.prefetch_idx = 0
+            self.prefetcher = Prefetcher(self.train_data, self._prefetch_stage, self.device, depth=config.prefetch_depth)
+        # validation batches are exchanged in the prefetch thread as well when it exists (on the training prefetch buffers,
+        # idle during evaluation); otherwise the exchange stays on the default group and only sampling is overlapped
+        self.evaluator = Evaluator(self.val_data, self.device, self.world_size, config.total_epoch,
+                                   stage=self._prefetch_stage if config.prefetch else None,
+                                   overlap=config.eval_overlap, depth=config.prefetch_depth, every=config.eval_every)
+
+    def _gather_local_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        if self.feat_cache is not None:
+            return decode_rows(self.local_feat, self.feat_cache.gather(input_nodes))
+        return self._fetch_local_feat(input_nodes)
+
+    def _fetch_local_rows(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        return fetch_rows(self.local_feat, input_nodes, self.feat_mode, self.device)
+
+    def _fetch_local_feat(self, input_nodes: torch.Tensor) -> torch.Tensor:
+        # rows are moved in the storage dtype (--feat_dtype) and computed on in float32
+        return gather_rows(self.local_feat, input_nodes, self.feat_mode, self.device)
+
+    # Send and receive the top block (edges + input nodes) of every gpu
+    # and extract the local feature slice of every gpu's input nodes
+    def _exchange(self, buf: P3ExchangeBuffer, input_nodes, output_nodes, blocks, size_exchange: SizeExchange) -> P3ExchangeBuffer:
+        group = size_exchange.group
+        top_block = blocks[0]
+        # 1. Send and Receive edges for all the other gpus
+        src, dst = top_block.adj_tensors('coo') # dgl v1.1 and above
+        # src, dst = top_block.adj_sparse(fmt="coo") # dgl v1.0 and below
+        if group is None:
+            # the prefetch thread's collectives run on their own group and are not matched across ranks
+            self.waits.mark("all_gather")
+        with self.tracer.span("size_exchange"):
+            sizes = size_exchange.exchange(src.shape[0], top_block.num_src_nodes(), top_block.num_dst_nodes())
+        buf.edge_size_lst = [(rank, *size) for rank, size in enumerate(sizes)] # rank, edge_size, src_node_size, dst_node_size
+        if self.packed_gather:
+            # one collective for input nodes, src and dst edges, padded to the largest gpu
+            packed_sizes = [(src_node_size, edge_size, edge_size) for _, edge_size, src_node_size, _ in buf.edge_size_lst]
+            with self.tracer.span("edge_all_gather"):
+                handle, views = buf.packer.all_gather([input_nodes, src, dst], packed_sizes, group=group, async_op=True)
+                handle.wait()
+            for rank, (_input_nodes, _src, _dst) in enumerate(views):
+                buf.input_node_buffer_lst[rank] = _input_nodes
+                buf.src_edge_buffer_lst[rank] = _src
+                buf.dst_edge_buffer_lst[rank] = _dst
+            with self.tracer.span("feat_gather"):
+                self._extract_feats(buf)
+        else:
+            for rank, edge_size, src_node_size, dst_node_size in buf.edge_size_lst:
+                buf.src_edge_buffer_lst[rank].resize_(edge_size)
+                buf.dst_edge_buffer_lst[rank].resize_(edge_size)
+                buf.input_node_buffer_lst[rank].resize_(src_node_size)
+            with self.tracer.span("edge_all_gather"):
+                handle1 = all_gather_var(tensor_list=buf.input_node_buffer_lst, tensor=input_nodes, group=group, async_op=True)
+                handle2 = all_gather_var(tensor_list=buf.src_edge_buffer_lst, tensor=src, group=group, async_op=True)
+                handle3 = all_gather_var(tensor_list=buf.dst_edge_buffer_lst, tensor=dst, group=group, async_op=True)
+                handle1.wait()
+            # 2. Extract local features for the input nodes of all the gpus
+            with self.tracer.span("feat_gather"):
+                self._extract_feats(buf)
+            with self.tracer.span("edge_all_gather"):
+                handle2.wait()
+                handle3.wait()
+        buf.output_nodes = output_nodes
+        buf.blocks = blocks
+        return buf
+
+    def _extract_feats(self, buf: P3ExchangeBuffer):
+        if not self.dedup:
+            for rank, _input_nodes in enumerate(buf.input_node_buffer_lst):
+                buf.input_feat_buffer_lst[rank] = self._gather_local_feat(_input_nodes)
+            return
+        # neighborhoods of different gpus overlap: gather every distinct row once
+        # and hand every gpu its rows through the inverse index
+        all_input_nodes = torch.cat(buf.input_node_buffer_lst)
+        unique_nodes, inverse = torch.unique(all_input_nodes, return_inverse=True)
+        unique_feats = self._gather_local_feat(unique_nodes)
+        sizes = [_input_nodes.shape[0] for _input_nodes in buf.input_node_buffer_lst]
+        for rank, _inverse in enumerate(torch.split(inverse, sizes)):
+            buf.input_feat_buffer_lst[rank] = unique_feats[_inverse]
+        buf.dedup_ratio = all_input_nodes.shape[0] / max(unique_nodes.shape[0], 1)
+
+    def _prefetch_stage(self, batch) -> P3ExchangeBuffer:
+        input_nodes, output_nodes, blocks = batch
+        buf = self.prefetch_buffers[self.prefetch_idx % len(self.prefetch_buffers)]
+        self.prefetch_idx += 1
+        return self._exchange(buf, input_nodes, output_nodes, blocks, self.prefetch_size_exchange)
+
+    def _local_forward(self, block, input_feats: torch.Tensor) -> torch.Tensor:
+        # the partial hid features are reduced and their gradients gathered in float32
+        # (--comm_dtype sets the wire format), so only the first layer itself runs under autocast
+        with self.amp.autocast():
+            local_hid = self.local_model(block, input_feats)
+        return local_hid.float()
+
+    # 3. Compute hid feature (first layer) with local features for all the gpus
+    # returns the reducer with the reductions of the hid features in flight
+    def _first_layer(self, buf: P3ExchangeBuffer, resize_grads=True) -> OverlappedReduce:
+        self.reducer.reset([dst_node_size for _, _, _, dst_node_size in buf.edge_size_lst])
+        if self.fused:
+            return self._fused_first_layer(buf, resize_grads)
+        overlap = self.shuffle_mode != "sync"
+        block = None
+        for r in range(self.world_size):
+            input_feats = buf.input_feat_buffer_lst[r]
+            if r == self.rank:
+                block = buf.blocks[0]
+            else:
+                src = buf.src_edge_buffer_lst[r]
+                dst = buf.dst_edge_buffer_lst[r]
+                src_node_size = buf.edge_size_lst[r][2]
+                dst_node_size = buf.edge_size_lst[r][3]
+                block = create_block(('coo', (src, dst)), num_dst_nodes=dst_node_size, num_src_nodes=src_node_size, device=self.device)
+
+            self.local_hid_buffer_lst[r] = self._local_forward(block, input_feats)
+            if overlap:
+                # reduce the partial hid feature of gpu r while the first layer of gpu r + 1 is computed
+                self.reducer.launch(r, self.local_hid_buffer_lst[r])
+            if resize_grads:
+                self.global_grad_lst[r].resize_([block.num_dst_nodes(), self.hid_feats])
+        if not overlap:
+            for r in range(self.world_size):
+                self.reducer.launch(r, self.local_hid_buffer_lst[r])
+        return self.reducer
+
+    # Fused mode: the top blocks of all the gpus are stacked into one block-diagonal block
+    # and the first layer runs once over the concatenated features.
+    # Blocks take the dst features from the first num_dst_nodes src nodes, so the fused src
+    # nodes are ordered [dst nodes of gpu 0 .. N-1, remaining src nodes of gpu 0 .. N-1]
+    def _fused_first_layer(self, buf: P3ExchangeBuffer, resize_grads=True) -> OverlappedReduce:
+        edge_sizes = [edge_size for _, edge_size, _, _ in buf.edge_size_lst]
+        src_sizes = [src_node_size for _, _, src_node_size, _ in buf.edge_size_lst]
+        dst_sizes = [dst_node_size for _, _, _, dst_node_size in buf.edge_size_lst]
+        total_dst = sum(dst_sizes)
+        num_dst = torch.tensor(dst_sizes, dtype=torch.int64, device=self.device)
+        num_extra = torch.tensor(src_sizes, dtype=torch.int64, device=self.device) - num_dst
+        dst_offset = torch.cumsum(num_dst, 0) - num_dst
+        extra_offset = torch.cumsum(num_extra, 0) - num_extra + total_dst
+        owner = torch.repeat_interleave(torch.arange(self.world_size, device=self.device), torch.tensor(edge_sizes, device=self.device))
+        src = torch.cat(buf.src_edge_buffer_lst).long()
+        dst = torch.cat(buf.dst_edge_buffer_lst).long()
+        src = torch.where(src < num_dst[owner], dst_offset[owner] + src, extra_offset[owner] + src - num_dst[owner])
+        dst = dst_offset[owner] + dst
+        block = create_block(('coo', (src.to(self.nid_dtype), dst.to(self.nid_dtype))), num_dst_nodes=total_dst, num_src_nodes=sum(src_sizes), device=self.device)
+        feats = buf.input_feat_buffer_lst
+        input_feats = torch.cat([feats[r][:dst_sizes[r]] for r in range(self.world_size)] + [feats[r][dst_sizes[r]:] for r in range(self.world_size)])
+
+        self.fused_hid = self._local_forward(block, input_feats)
+        for r, local_hid in enumerate(torch.split(self.fused_hid, dst_sizes)):
+            if r == self.rank:
+                # leaf for the shuffle: the gradient of this gpu's slice is collected here and
+                # the fused output is backpropagated once, together with the gradients of the other gpus
+                local_hid = local_hid.detach().requires_grad_()
+            self.local_hid_buffer_lst[r] = local_hid
+            self.reducer.launch(r, local_hid)
+            if resize_grads:
+                self.global_grad_lst[r].resize_([dst_sizes[r], self.hid_feats])
+        return self.reducer
+
+    def _fused_backward(self):
+        grads = [self.local_hid_buffer_lst[r].grad if r == self.rank else global_grad for r, global_grad in enumerate(self.global_grad_lst)]
+        self.fused_hid.backward(torch.cat(grads))
+        self.fused_hid = None
 
     # fetch partial hid_feat from remote GPUs before forward pass
     # fetch partial gradient from remote GPUs during backward pass
@@ -78,197 +288,199 @@ class P3Trainer:
         backward = 0.0
         sample_time = 0.0
         feat_time = 0.0
+        dedup_ratio = 0.0
+        num_input_nodes = 0
+        num_top_edges = 0
+        num_seeds = 0
+        batches = self.train_data if self.prefetcher is None else self.prefetcher
+        wire_stats.reset()
         start = sample_start = time.time()
         iter_idx = 0
-        for input_nodes, output_nodes, blocks in self.train_data:
-            # dist.barrier()
-            top_block = blocks[0]
+        for batch in batches:
             iter_idx += 1
             feat_start = sample_end = time.time()
-            # 1. Send and Receive edges for all the other gpus
-            src, dst = top_block.adj_tensors('coo') # dgl v1.1 and above
-            # src, dst = top_block.adj_sparse(fmt="coo") # dgl v1.0 and below
-            self.edge_size_lst[self.rank] = (self.rank, src.shape[0], top_block.num_src_nodes(), top_block.num_dst_nodes()) # rank, edge_size, input_node_size
-            dist.all_gather_object(object_list=self.edge_size_lst, obj=self.edge_size_lst[self.rank])
-            # print(f"{self.rank=} {epoch=} {iter_idx=} {self.edge_size_lst=} start sending edges")
-            for rank, edge_size, src_node_size, dst_node_size in self.edge_size_lst:
-                self.src_edge_buffer_lst[rank].resize_(edge_size)
-                self.dst_edge_buffer_lst[rank].resize_(edge_size)
-                self.input_node_buffer_lst[rank].resize_(src_node_size)
-                # self.input_feat_buffer_lst[rank].resize_([src_node_size, self.local_feat_width])
-            # dist.barrier()
-            # dist.all_gather(tensor_list=self.input_node_buffer_lst, tensor=input_nodes, async_op=False)
-            # dist.all_gather(tensor_list=self.src_edge_buffer_lst, tensor=src, async_op=False)
-            # dist.all_gather(tensor_list=self.dst_edge_buffer_lst, tensor=dst, async_op=False)
-            
-            # # print(f"{self.rank=} {epoch=} {iter_idx=} input_node_shapes={[x.shape for x in self.input_node_buffer_lst]} start extracting local features")
-            # for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
-            #     self.input_feat_buffer_lst[rank] = self.local_feat[_input_nodes]
-            handle1 = dist.all_gather(tensor_list=self.input_node_buffer_lst, tensor=input_nodes, async_op=True)
-            handle2 = dist.all_gather(tensor_list=self.src_edge_buffer_lst, tensor=src, async_op=True)
-            handle3 = dist.all_gather(tensor_list=self.dst_edge_buffer_lst, tensor=dst, async_op=True)
-            handle1.wait()
-            for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
-                if self.feat_mode == 'gpu':
-                    self.input_feat_buffer_lst[rank] = self.local_feat[_input_nodes]
-                elif self.feat_mode == 'uva':
-                    self.input_feat_buffer_lst[rank] = gather_pinned_tensor_rows(self.local_feat, _input_nodes)
-                else: # 'cpu'
-                    self.input_feat_buffer_lst[rank] = self.local_feat[_input_nodes.to('cpu')].to(self.device)
-                    
-            handle2.wait()
-            handle3.wait()
-            # print(f"{self.rank=} {epoch=} {iter_idx=} input_feat_shapes={[x.shape for x in self.input_feat_buffer_lst]} start computing first hidden layer")
-            torch.cuda.synchronize()
+            if self.prefetcher is None:
+                input_nodes, output_nodes, blocks = batch
+                buf = self._exchange(self.exchange_buffer, input_nodes, output_nodes, blocks, self.size_exchange)
+            else:
+                # already exchanged by the prefetch thread
+                buf = batch
+            device_synchronize(self.device)
             feat_end = forward_start = time.time()
-            # 3. Fetch feature data and compute hid feature for other GPUs
-            block = None
-            for r in range(self.world_size):
-                input_nodes = self.input_node_buffer_lst[r]
-                input_feats = self.input_feat_buffer_lst[r]
-                if r == self.rank:
-                    block = top_block
-                else:
-                    src = self.src_edge_buffer_lst[r]
-                    dst = self.dst_edge_buffer_lst[r]
-                    src_node_size = self.edge_size_lst[r][2]
-                    dst_node_size = self.edge_size_lst[r][3]
-                    block = create_block(('coo', (src, dst)), num_dst_nodes=dst_node_size, num_src_nodes=src_node_size, device=self.device)
-                                        
-                self.local_hid_buffer_lst[r] = self.local_model(block, input_feats)
-                self.global_grad_lst[r].resize_([block.num_dst_nodes(), self.hid_feats])
+            with self.tracer.span("first_layer"):
+                local_hids = self._first_layer(buf)
+            self.waits.mark("shuffle")
+            with self.tracer.span("shuffle"):
+                local_hid: torch.Tensor = self.shuffle(self.rank, self.world_size, self.local_hid_buffer_lst[self.rank], local_hids, self.global_grad_lst, self.codec)
+            if self.waits.enabled:
+                # the gradient all_gather of the shuffle starts once the gradient of local_hid is ready
+                local_hid.register_hook(lambda grad: self.waits.mark("grad_all_gather"))
+            output_labels = self.node_labels[buf.output_nodes]
 
-            # print(f"{self.rank=} {epoch=} {iter_idx=} start reduce first hidden layer features")
-            # dist.barrier()
-            local_hid: torch.Tensor = self.shuffle(self.rank, self.world_size, self.local_hid_buffer_lst[self.rank], self.local_hid_buffer_lst, self.global_grad_lst)
-            output_labels = self.node_labels[output_nodes]
-            
-            # print(f"{self.rank=} {epoch=} {iter_idx=} local_hid_shape={[x.shape for x in self.local_hid_buffer_lst]} start compute remaining layer features")
-
-            # 6. Compute forward pass locally
-            output_pred = self.model(blocks[1:], local_hid)            
-            loss = F.cross_entropy(output_pred, output_labels) 
-            torch.cuda.synchronize()
+            # 4. Compute forward pass locally
+            with self.amp.autocast():
+                output_pred = self.model(buf.blocks[1:], local_hid)
+                loss = F.cross_entropy(output_pred, output_labels)
+            device_synchronize(self.device)
             forward_end = backward_start = time.time()                
             # Backward Pass
-            # TODO gather error gradients from other GPUs
-            # print(f"{self.rank=} {epoch=} {iter_idx=} start backward pass")
-            # dist.barrier()
-
             self.gloabl_optimizer.zero_grad()
             self.local_optimizer.zero_grad()
-            loss.backward()
-            self.gloabl_optimizer.step()
-            # self.local_optimizer.step()
-            # print(f"{self.rank=} {epoch=} {iter_idx=} global_grad_shape={[x.shape for x in self.global_grad_lst]} start gather error gradient")
-            for r, global_grad in enumerate(self.global_grad_lst):
-                if r != self.rank:
-                    self.local_optimizer.zero_grad()
-                    self.local_hid_buffer_lst[r].backward(global_grad)
-                    # self.local_optimizer.step()
-            # print(f"{self.rank=} {epoch=} {iter_idx=} done")
-            self.local_optimizer.step()
-            torch.cuda.synchronize()
+            # with amp, the gradients of local_hid and the ones gathered from the other gpus carry the (common) loss scale
+            self.amp.scale(loss).backward()
+            with self.tracer.span("optimizer"):
+                self.amp.step(self.gloabl_optimizer)
+            # 5. Backward the error gradients received from other gpus through the local model
+            if self.fused:
+                self._fused_backward()
+            else:
+                for r, global_grad in enumerate(self.global_grad_lst):
+                    if r != self.rank:
+                        self.local_optimizer.zero_grad()
+                        self.local_hid_buffer_lst[r].backward(global_grad)
+            with self.tracer.span("optimizer"):
+                self.amp.step(self.local_optimizer, sync=True)
+                self.amp.update()
+            device_synchronize(self.device)
             backward_end = time.time()
 
             forward += forward_end - forward_start
             backward += backward_end - backward_start
             feat_time += feat_end - feat_start
             sample_time += sample_end - sample_start
-            # concat_time += concat_end - concat_start
-            # torch.cuda.synchronize()
+            num_seeds += buf.output_nodes.shape[0]
+            self.tracer.record("sample", sample_start, sample_end) # waiting on the prefetcher when prefetching
+            self.tracer.record("feat", feat_start, feat_end)
+            self.tracer.record("forward", forward_start, forward_end)
+            self.tracer.record("backward", backward_start, backward_end)
+            self.tracer.next_iter()
+            self.waits.end_iter()
+            self.block_sizes.log(epoch, iter_idx, buf.edge_size_lst)
+            dedup_ratio += buf.dedup_ratio
+            _, edge_size, src_node_size, _ = buf.edge_size_lst[self.rank]
+            num_input_nodes += src_node_size
+            num_top_edges += edge_size
             sample_start = time.time()
 
-
-        # print(f"{self.rank=} done {epoch=}")
-        torch.cuda.synchronize()
+        device_synchronize(self.device)
         end = time.time()
         epoch_time = end - start
-        
-        # print(f"start evaluation for epoch {epoch}")
-        acc = self.evaluate()
+
+        overlap = None
+        extra = {"comm_bytes": wire_stats.reset()}
+        # frontier of this gpu, mean per minibatch (smaller with locality-aware seed partitions)
+        extra["input_nodes"] = num_input_nodes / max(iter_idx, 1)
+        extra["top_edges"] = num_top_edges / max(iter_idx, 1)
+        if self.prefetcher is not None:
+            # the loop above only saw the time spent waiting on the prefetcher,
+            # report the sampling / exchange work done in the background instead
+            sample_time = self.prefetcher.sample_time
+            feat_time = self.prefetcher.stage_time
+            overlap = self.prefetcher.overlap_time()
+            extra["prefetch_wait"] = self.prefetcher.wait_time
+        if self.feat_cache is not None:
+            extra["cache_hit_rate"] = self.feat_cache.reset_stats()
+        if isinstance(self.train_data, WorkerPoolLoader):
+            extra.update(self.train_data.worker_stats())
+        for kind, max_wait in self.waits.report(epoch).items():
+            extra[f"wait_{kind}"] = max_wait
+        if self.dedup:
+            extra["dedup_ratio"] = dedup_ratio / max(iter_idx, 1) # mean over the iterations
+
+        acc = float("nan")
+        extra["eval_time"] = 0.0 # skipped evaluation
+        if self.evaluator.should_run(epoch):
+            eval_start = time.time()
+            acc = self.evaluate()
+            extra["eval_time"] = time.time() - eval_start
+            if self.feat_cache is not None:
+                self.feat_cache.reset_stats() # validation lookups do not count towards the next epoch's hit rate
+        extra["throughput"] = num_seeds * self.world_size / epoch_time # training seeds / second over all the gpus
+        if self.amp.enabled:
+            extra["loss_scale"] = self.amp.loss_scale()
+        extra.update(self.baseline.delta(epoch, acc, extra["throughput"]))
         if self.rank == 0 or self.world_size == 1:
-            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time)
+            info = self.log.log_step(epoch, acc, epoch_time, forward, backward, feat_time, sample_time, overlap=overlap, extra=extra)
             print(info)
             
     def _save_checkpoint(self, epoch):
+        # shared: the data-parallel layers; shards: the first layer of every gpu (trained on its own feature columns)
+        model = self.model.module if self.world_size > 1 else self.model
+        shared = {"epoch": epoch, "model": model.state_dict(), "optimizer": self.gloabl_optimizer.state_dict(), "log": self.log.items,
+                  "amp": self.amp.state_dict()}
+        shard = {
+            "epoch": epoch,
+            "local_model": self.local_model.state_dict(),
+            "local_optimizer": self.local_optimizer.state_dict(),
+            "rng": rng_state(self.device),
+        }
+        self.checkpointer.save(epoch, shared, shard)
         if self.rank == 0 or self.world_size == 1:
-            ckp = None
-            if self.world_size == 1:
-                ckp = self.model.state_dict()
-            elif self.world_size > 1: 
-                # using ddp
-                ckp = self.model.module.state_dict()
-            torch.save(ckp, self.checkpt_path)
-            print(f"Epoch {epoch} | Training checkpoint saved at {self.checkpt_path}")
+            print(f"Epoch {epoch} | Training checkpoint queued for {self.checkpointer.dir}")
+
+    def _resume(self):
+        epoch = self.checkpointer.resume_epoch(self.device)
+        if epoch < 0:
+            print(f"rank {self.rank}: no checkpoint in {self.checkpointer.dir}, starting from epoch 0")
+            return
+        shared, shard = self.checkpointer.load(epoch)
+        model = self.model.module if self.world_size > 1 else self.model
+        model.load_state_dict(shared["model"])
+        self.gloabl_optimizer.load_state_dict(shared["optimizer"])
+        self.local_model.load_state_dict(shard["local_model"])
+        self.local_optimizer.load_state_dict(shard["local_optimizer"])
+        self.log.restore(shared["log"])
+        self.amp.load_state_dict(shared.get("amp", {}))
+        set_rng_state(shard["rng"], self.device)
+        self.start_epoch = epoch + 1
+        assigner = getattr(self.train_data, "assigner", None)
+        if assigner is not None:
+            assigner.epoch = self.start_epoch
+        if isinstance(self.train_data, WorkerPoolLoader):
+            self.train_data.epoch = self.start_epoch # seeds the global shard permutation
+        if self.rank == 0 or self.world_size == 1:
+            print(f"Resumed from the checkpoint of epoch {epoch}")
 
     def train(self):
         self.model.train()
-        for epoch in range(self.config.total_epoch):
+        if self.config.resume:
+            self._resume()
+        for epoch in range(self.start_epoch, self.config.total_epoch):
             self._run_epoch(epoch)
             if self.rank == 0 or self.world_size == 1:
                 self.log.saveToDisk()
-                if epoch % self.save_every == 0 and epoch > 0:
-                    self._save_checkpoint(epoch)
+            if (epoch % self.save_every == 0 and epoch > 0) or epoch == self.config.total_epoch - 1:
+                self._save_checkpoint(epoch)
+        self.checkpointer.wait()
+        self.tracer.export(self.config.trace_path(), self.world_size)
+        self.block_sizes.save()
                         
     def evaluate(self):
         self.model.eval()
-        ys = []
-        y_hats = []
-        for it, (input_nodes, output_nodes, blocks) in enumerate(self.val_data):
+        for batch in self.evaluator.batches():
             with torch.no_grad():
-                top_block = blocks[0]
-                # 1. Send and Receive edges for all the other gpus
-                src, dst = top_block.adj_tensors('coo') # dgl v1.1 and above
-                # src, dst = top_block.adj_sparse(fmt='coo') # dgl v1.0 and below
-                self.edge_size_lst[self.rank] = (self.rank, src.shape[0], top_block.num_src_nodes(), top_block.num_dst_nodes()) # rank, edge_size, input_node_size
-                dist.all_gather_object(object_list=self.edge_size_lst, obj=self.edge_size_lst[self.rank])
-                for rank, edge_size, src_node_size, dst_node_size in self.edge_size_lst:
-                    self.src_edge_buffer_lst[rank].resize_(edge_size)
-                    self.dst_edge_buffer_lst[rank].resize_(edge_size)
-                    self.input_node_buffer_lst[rank].resize_(src_node_size)
-                    # self.input_feat_buffer_lst[rank].resize_([src_node_size, self.local_feat_width])
-                # dist.barrier()
-                handle1 = dist.all_gather(tensor_list=self.input_node_buffer_lst, tensor=input_nodes, async_op=True)
-                handle2 = dist.all_gather(tensor_list=self.src_edge_buffer_lst, tensor=src, async_op=True)
-                handle3 = dist.all_gather(tensor_list=self.dst_edge_buffer_lst, tensor=dst, async_op=True)
-                handle1.wait()
-                for rank, _input_nodes in enumerate(self.input_node_buffer_lst):
-                    if self.feat_mode == 'gpu':
-                        self.input_feat_buffer_lst[rank] = self.local_feat[_input_nodes]
-                    elif self.feat_mode == 'uva':
-                        self.input_feat_buffer_lst[rank] = gather_pinned_tensor_rows(self.local_feat, _input_nodes)
-                    else:
-                        self.input_feat_buffer_lst[rank] = self.local_feat[_input_nodes.to('cpu')].to(self.device)
-                handle2.wait()
-                handle3.wait()
-                # 3. Fetch feature data and compute hid feature for other GPUs
-                block = None
-                for r in range(self.world_size):
-                    input_nodes = self.input_node_buffer_lst[r]
-                    input_feats = self.input_feat_buffer_lst[r]
-                    if r == self.rank:
-                        block = top_block
-                    else:
-                        src = self.src_edge_buffer_lst[r]
-                        dst = self.dst_edge_buffer_lst[r]
-                        src_node_size = self.edge_size_lst[r][2]
-                        dst_node_size = self.edge_size_lst[r][3]
-                        block = create_block(('coo', (src, dst)), num_dst_nodes=dst_node_size, num_src_nodes=src_node_size, device=self.device)
-                                            
-                    self.local_hid_buffer_lst[r] = self.local_model(block, input_feats)
-                    # self.global_grad_lst[r].resize_([block.num_dst_nodes(), self.hid_feats])
-                    del block
-                    
-                local_hid = self.shuffle(self.rank, self.world_size, self.local_hid_buffer_lst[self.rank], self.local_hid_buffer_lst, None)
-                ys.append(self.node_labels[output_nodes])
-                y_hats.append(self.model(blocks[1:], local_hid))
-                
-        acc = MF.accuracy(
-            torch.cat(y_hats),
-            torch.cat(ys),
-            task="multiclass",
-            num_classes=self.num_classes)
-    
-        dist.all_reduce(acc, op=dist.ReduceOp.SUM)
-        return (acc / self.world_size).item()
\ No newline at end of file
+                if self.prefetcher is None:
+                    input_nodes, output_nodes, blocks = batch
+                    buf = self._exchange(self.exchange_buffer, input_nodes, output_nodes, blocks, self.size_exchange)
+                else:
+                    buf = batch # already exchanged by the prefetch thread
+                local_hids = self._first_layer(buf, resize_grads=False)
+                local_hid = self.shuffle(self.rank, self.world_size, self.local_hid_buffer_lst[self.rank], local_hids, None, self.codec)
+                with self.amp.autocast():
+                    output_pred = self.model(buf.blocks[1:], local_hid)
+                self.evaluator.update(output_pred, self.node_labels[buf.output_nodes])
+        self.waits.discard() # arrivals of the validation exchanges
+        return self.evaluator.accuracy()
+
+    def infer(self, graph):
+        # layer-wise full-neighbor inference of all the nodes: the first layer on the local feature
+        # columns of every gpu (summed with dist.reduce), the remaining layers on disjoint node ranges
+        model = self.model.module if self.world_size > 1 else self.model
+        model.eval()
+        self.local_model.eval()
+        widths = layer_widths(self.config)
+        engine = LayerwiseInference(graph, self.config.infer_dir(), self.device, self.rank, self.world_size, self.config.infer_chunk_size)
+        first_hid = engine.p3_first_layer(self.local_model, self._fetch_local_feat, widths[0])
+        engine.layers(model, engine.reader(first_hid), widths[1:], first_layer_idx=1)
+        if self.rank == 0 or self.world_size == 1:
+            print(engine.report())
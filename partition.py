@@ -0,0 +1,48 @@
+from __future__ import annotations
+import os
+import numpy as np
+import torch
+import dgl
+
+SEED_PARTITIONS = ["random", "locality"]
+
+def label_propagation(graph: dgl.DGLGraph, num_iters: int = 10) -> torch.Tensor:
+    """Cluster the nodes by label propagation: every node repeatedly takes the label
+    most frequent among its in-neighbors (ties: smallest label). Returns int64 cluster ids."""
+    num_nodes = graph.num_nodes()
+    src, dst = graph.adj_tensors('coo')
+    src = src.long()
+    dst = dst.long()
+    labels = torch.arange(num_nodes, dtype=torch.int64)
+    for _ in range(num_iters):
+        # count every (node, neighbor label) pair
+        keys, counts = torch.unique(dst * num_nodes + labels[src], return_counts=True)
+        nodes = keys // num_nodes
+        cand = keys % num_nodes
+        best = torch.zeros(num_nodes, dtype=counts.dtype).scatter_reduce_(0, nodes, counts, reduce="amax", include_self=False)
+        is_best = counts == best[nodes]
+        new_labels = labels.clone().scatter_reduce_(0, nodes[is_best], cand[is_best], reduce="amin", include_self=False)
+        changed = (new_labels != labels).sum().item()
+        labels = new_labels
+        if changed == 0:
+            break
+    return labels
+
+def load_clusters(graph: dgl.DGLGraph, cache_dir: str, graph_name: str, num_iters: int = 10) -> torch.Tensor:
+    # computed once per graph and cached under cache_dir
+    path = os.path.join(cache_dir, f"{graph_name}_lp{num_iters}.npy")
+    if os.path.exists(path):
+        return torch.from_numpy(np.load(path))
+    clusters = label_propagation(graph, num_iters)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path, clusters.numpy())
+    return clusters
+
+def locality_partition(nids: torch.Tensor, clusters: torch.Tensor, world_size: int) -> list[torch.Tensor]:
+    """Split nids into world_size equal contiguous slices of the nids ordered by cluster,
+    so the seeds of a rank come from as few clusters as possible.
+    Every rank gets the same number of seeds (the remainder is dropped, like partition_ids)."""
+    order = torch.argsort(clusters[nids.long()], stable=True)
+    nids = nids[order]
+    step = int(nids.shape[0] / world_size)
+    return [nids[rank * step : (rank + 1) * step].clone() for rank in range(world_size)]
@@ -0,0 +1,88 @@
+import threading
+import queue
+import time
+from contextlib import nullcontext
+import torch
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+_END = object()
+
+class Prefetcher:
+    """Runs `stage(batch)` for upcoming batches of `loader` in a background thread.
+
+    The thread samples batch i+1 (and runs `stage` on it) while the caller
+    consumes batch i. At most `depth` finished batches wait in the queue,
+    so depth=1 gives double buffering.
+    On cuda the thread works on a side stream and synchronizes it before
+    handing a batch over, so the consumer can use the results right away.
+
+    Timing (seconds, reset on every __iter__):
+        sample_time: time the thread spent in the loader
+        stage_time: time the thread spent in `stage`
+        wait_time: time the consumer was blocked waiting for a batch
+    """
+    def __init__(self, loader, stage, device: torch.device, depth: int = 1):
+        self.loader = loader
+        self.stage = stage
+        self.device = device
+        self.depth = max(depth, 1)
+        self.queue = None
+        self.thread = None
+        self.sample_time = 0.0
+        self.stage_time = 0.0
+        self.wait_time = 0.0
+
+    def overlap_time(self) -> float:
+        # producer work that did not show up on the consumer's critical path
+        return max(self.sample_time + self.stage_time - self.wait_time, 0.0)
+
+    def _worker(self):
+        stream = None
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+            stream = torch.cuda.Stream(self.device)
+        try:
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                loader_iter = iter(self.loader)
+                while True:
+                    sample_start = time.time()
+                    try:
+                        batch = next(loader_iter)
+                    except StopIteration:
+                        break
+                    stage_start = time.time()
+                    item = self.stage(batch)
+                    if stream is not None:
+                        stream.synchronize()
+                    stage_end = time.time()
+                    self.sample_time += stage_start - sample_start
+                    self.stage_time += stage_end - stage_start
+                    self.queue.put(item)
+        except BaseException as e:
+            self.queue.put(_Failure(e))
+            return
+        self.queue.put(_END)
+
+    def __iter__(self):
+        self.sample_time = 0.0
+        self.stage_time = 0.0
+        self.wait_time = 0.0
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        return self
+
+    def __next__(self):
+        wait_start = time.time()
+        item = self.queue.get()
+        self.wait_time += time.time() - wait_start
+        if item is _END:
+            self.thread.join()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.thread.join()
+            raise item.exc
+        return item
@@ -0,0 +1,148 @@
+import os
+import re
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+import torch
+import dgl
+from feat_store import FeatureStore
+
+SYNTHETIC = "synthetic"
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    # accumulate the wall time of a startup stage into timings[stage]
+    start = time.time()
+    yield
+    timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+def format_timings(timings: dict) -> str:
+    total = sum(timings.values())
+    return ", ".join(f"{stage}={round(sec, 2)}s" for stage, sec in timings.items()) + f", total={round(total, 2)}s"
+
+class GraphCache:
+    """Preprocessed copy of an OGB node property dataset.
+
+    Stores the finished graph (self loops added, int32) as raw CSC arrays, int32 split
+    indices, int64 labels and the features (a single-part FeatureStore), all as .npy
+    files that later runs memory-map instead of re-parsing the dataset.
+    Layout: {root}/{graph_name}_selfloop{0,1}_{idtype}/
+    """
+    def __init__(self, root: str, graph_name: str, self_loop: bool = True, idtype: torch.dtype = torch.int32):
+        self.graph_name = graph_name
+        self.self_loop = self_loop
+        self.idtype = idtype
+        key = f"{graph_name}_selfloop{int(self_loop)}_{str(idtype).replace('torch.', '')}"
+        self.dir = os.path.join(root, key)
+        self.meta_path = os.path.join(self.dir, "meta.json")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, f"{name}.npy")
+
+    def feat_store(self) -> FeatureStore:
+        return FeatureStore(self.dir, "feat", 1, padding=False)
+
+    def exists(self) -> bool:
+        # meta.json is written last, a partially written cache is rebuilt
+        return os.path.exists(self.meta_path)
+
+    def write(self, graph: dgl.DGLGraph, node_labels: torch.Tensor, idx_split: dict, num_classes: int, feat: torch.Tensor):
+        os.makedirs(self.dir, exist_ok=True)
+        indptr, indices, _ = graph.adj_tensors('csc')
+        np.save(self._path("indptr"), indptr.numpy())
+        np.save(self._path("indices"), indices.numpy())
+        np.save(self._path("labels"), node_labels.numpy())
+        for key, nids in idx_split.items():
+            np.save(self._path(f"split_{key}"), nids.numpy())
+        self.feat_store().write(feat)
+        meta = {
+            "graph_name": self.graph_name,
+            "num_nodes": graph.num_nodes(),
+            "num_edges": graph.num_edges(),
+            "num_classes": num_classes,
+            "splits": list(idx_split.keys()),
+        }
+        with open(self.meta_path, "w") as file:
+            json.dump(meta, file)
+
+    def load(self) -> tuple[dgl.DGLGraph, torch.Tensor, dict, int, torch.Tensor]:
+        with open(self.meta_path) as file:
+            meta = json.load(file)
+        indptr = torch.from_numpy(np.load(self._path("indptr"), mmap_mode="c"))
+        indices = torch.from_numpy(np.load(self._path("indices"), mmap_mode="c"))
+        graph = dgl.graph(('csc', (indptr, indices, torch.tensor([], dtype=indptr.dtype))), num_nodes=meta["num_nodes"], idtype=self.idtype)
+        node_labels = torch.from_numpy(np.load(self._path("labels")))
+        idx_split = {}
+        for key in meta["splits"]:
+            idx_split[key] = torch.from_numpy(np.load(self._path(f"split_{key}")))
+        feat = self.feat_store().load(0) # memory-mapped
+        return graph, node_labels, idx_split, meta["num_classes"], feat
+
+def synthetic_name(spec: str) -> str:
+    # "num_nodes,avg_degree,feat_width,num_classes" -> graph name of synthetic_dataset
+    num_nodes, avg_degree, feat_width, num_classes = [int(value) for value in spec.split(",")]
+    return f"{SYNTHETIC}-n{num_nodes}-d{avg_degree}-f{feat_width}-c{num_classes}"
+
+def synthetic_dataset(graph_name: str, seed: int = 0) -> tuple[dgl.DGLGraph, torch.Tensor, dict, int]:
+    """Random dataset for runs without an OGB download (cpu-only / CI machines).
+    graph_name: synthetic-n{num_nodes}-d{avg_degree}-f{feat_width}-c{num_classes}.
+    Uniform random edges (avg_degree in-edges per node on average) and classes; the features are a
+    per-class mean plus gaussian noise, so the labels can be learned. Split: 60% train, 20% valid, 20% test.
+    The same name and seed give the same dataset.
+    """
+    match = re.fullmatch(rf"{SYNTHETIC}-n(\d+)-d(\d+)-f(\d+)-c(\d+)", graph_name)
+    if match is None:
+        raise ValueError(f"bad synthetic graph name {graph_name}")
+    num_nodes, avg_degree, feat_width, num_classes = [int(value) for value in match.groups()]
+    gen = torch.Generator().manual_seed(seed)
+    src = torch.randint(0, num_nodes, [num_nodes * avg_degree], generator=gen)
+    dst = torch.randint(0, num_nodes, [num_nodes * avg_degree], generator=gen)
+    graph = dgl.graph((src, dst), num_nodes=num_nodes)
+    node_labels = torch.randint(0, num_classes, [num_nodes], generator=gen)
+    centers = torch.randn([num_classes, feat_width], generator=gen)
+    graph.ndata["feat"] = centers[node_labels] + 2 * torch.randn([num_nodes, feat_width], generator=gen)
+    perm = torch.randperm(num_nodes, generator=gen)
+    num_train, num_valid = int(0.6 * num_nodes), int(0.2 * num_nodes)
+    idx_split = {
+        "train": perm[:num_train],
+        "valid": perm[num_train:num_train + num_valid],
+        "test": perm[num_train + num_valid:],
+    }
+    return graph, node_labels, idx_split, num_classes
+
+def load_dataset(graph_name: str, data_dir: str, timings: dict, use_cache: bool = False) -> tuple[dgl.DGLGraph, torch.Tensor, dict, int, torch.Tensor, bool]:
+    """Load and preprocess an OGB (or synthetic_dataset) dataset: add self loops, int32 graph / split indices, int64 labels.
+    With use_cache the result is read from (or written to) a GraphCache under data_dir/cache.
+    Returns (graph, node_labels, idx_split, num_classes, feat, from_cache)
+    """
+    cache = GraphCache(os.path.join(data_dir, "cache"), graph_name)
+    if use_cache and cache.exists():
+        with timed(timings, "cache_load"):
+            graph, node_labels, idx_split, num_classes, feat = cache.load()
+        return graph, node_labels, idx_split, num_classes, feat, True
+
+    with timed(timings, "load_dataset"):
+        if graph_name.startswith(SYNTHETIC):
+            graph, node_labels, idx_split, num_classes = synthetic_dataset(graph_name)
+        else:
+            from ogb.nodeproppred import DglNodePropPredDataset # only needed for the OGB datasets
+            dataset = DglNodePropPredDataset(graph_name, root=data_dir)
+            graph: dgl.DGLGraph = dataset[0][0]
+            node_labels: torch.Tensor = dataset[0][1]
+            idx_split = dataset.get_idx_split()
+            num_classes = dataset.num_classes
+    with timed(timings, "self_loop"):
+        graph = dgl.add_self_loop(graph)
+    node_labels = node_labels.flatten().clone()
+    torch.nan_to_num_(node_labels, nan=0.1)
+    node_labels: torch.Tensor = node_labels.type(torch.int64)
+    feat: torch.Tensor = graph.dstdata.pop("feat")
+    with timed(timings, "to_int"):
+        graph = graph.int()
+        for key, nids in idx_split.items():
+            idx_split[key] = nids.type(torch.int32)
+    if use_cache:
+        with timed(timings, "cache_write"):
+            cache.write(graph, node_labels, idx_split, num_classes, feat)
+    return graph, node_labels, idx_split, num_classes, feat, False
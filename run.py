@@ -5,22 +5,29 @@
 # Before every minibatch, feature is fetched from other GPUs for aggregation
 # Model is duplicated across all the GPUs
 # Use Pytorch DDP to synchronize model parameters / gradients across GPUs
-# Use NCCL as the backend for communication
+# Use NCCL (GPU) or Gloo (CPU) as the backend for communication
+from __future__ import annotations
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
 import dgl
 import torch
-from ogb.nodeproppred import DglNodePropPredDataset
 from models.sage import Sage, create_sage_p3
 from models.gat import Gat, create_gat_p3
 from dgl_trainer import DglTrainer
 from distload_trainer import P2Trainer
 from p3_trainer import P3Trainer
 from quiver_trainer import QuiverTrainer
-import quiver
+from feat_store import FeatureStore
+from feat_cache import CACHE_POLICIES, degree_scores, presample_scores
+from partition import SEED_PARTITIONS, load_clusters, locality_partition
+from sampler import CSCNeighborSampler
+from sample_workers import WorkerPoolLoader
+from balance import seed_costs, BalancedAssigner, BalancedBatchLoader
+from preprocess import load_dataset, synthetic_name, timed, format_timings
+from feat_quant import FEAT_STORAGE, QuantizedFeat, compress_feat, feat_storage
 import gc
 from utils import *
-from torch.distributed import init_process_group, destroy_process_group, barrier
+from torch.distributed import init_process_group, destroy_process_group, barrier, all_reduce
 import os
 import torch.multiprocessing as mp
 from dgl.utils import pin_memory_inplace
@@ -30,8 +37,10 @@ def get_dgl_dataloader(config: RunConfig,
                          graph: dgl.DGLGraph, 
                          train_nids: torch.Tensor,
                          use_dpp=True,
-                         use_uva=False) -> dgl.dataloading.dataloader.DataLoader:
-    device = torch.device(f"cuda:{config.rank}")
+                         use_uva=False,
+                         batch_size: int = None,
+                         drop_last: bool = True) -> dgl.dataloading.dataloader.DataLoader:
+    device = config.get_device()
     if config.topo == 'gpu':
         graph = graph.to(device)
     dataloader = dgl.dataloading.DataLoader(
@@ -42,38 +51,93 @@ def get_dgl_dataloader(config: RunConfig,
         device=device,      # Put the sampled MFGs on CPU or GPU
         use_ddp=use_dpp, # enable ddp if using mutiple gpus
         # The following arguments are inherited from PyTorch DataLoader.
-        batch_size=config.batch_size,    # Batch size
+        batch_size=config.batch_size if batch_size is None else batch_size,    # Batch size
         shuffle=True,       # Whether to shuffle the nodes for every epoch
-        drop_last=True,    # Whether to drop the last incomplete batch
+        drop_last=drop_last,    # Whether to drop the last incomplete batch (validation keeps it, the ddp split pads every rank to the same number of batches)
         num_workers=0,       # Number of sampler processes
         use_uva=use_uva
     )
     return dataloader
 
 
+def get_train_dataloader(config: RunConfig,
+                         sampler: dgl.dataloading.NeighborSampler,
+                         graph: dgl.DGLGraph,
+                         train_nids: torch.Tensor,
+                         idx_split: dict,
+                         use_ddp=True) -> dgl.dataloading.dataloader.DataLoader | WorkerPoolLoader:
+    if config.balance_seeds:
+        assigner = BalancedAssigner(train_nids, idx_split['train_cost'], config.batch_size, config.rank, config.world_size)
+        return BalancedBatchLoader(assigner, graph, sampler, config.get_device(), config.topo)
+    if config.sample_workers == 0:
+        return get_dgl_dataloader(config, sampler, graph, train_nids, use_dpp=use_ddp, use_uva=config.uva_sample())
+    # P3 prefetching keeps up to prefetch_depth + 2 batches alive
+    hold = config.prefetch_depth + 2 if config.prefetch and config.mode == 3 else 1
+    return WorkerPoolLoader(sampler, train_nids, config.batch_size, config.get_device(),
+                            num_workers=config.sample_workers, num_slots=config.sample_queue_depth + hold,
+                            hold=hold, rank=config.rank, world_size=config.world_size, use_ddp=use_ddp)
+
 def create_model(config: RunConfig):
     if config.model == 'sage':
-        return Sage(in_feats=config.global_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts),out_feats=config.num_classes).to(config.rank)
+        return Sage(in_feats=config.global_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts),out_feats=config.num_classes).to(config.get_device())
     elif config.model == 'gat':
-        return Gat(in_feats=config.global_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts),out_feats=config.num_classes,num_heads=config.num_heads).to(config.rank)
+        return Gat(in_feats=config.global_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts),out_feats=config.num_classes,num_heads=config.num_heads).to(config.get_device())
 
 def create_p3_model(config: RunConfig):
     if config.model == 'sage':
-        return create_sage_p3(config.rank, config.local_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts), num_classes=config.num_classes)
+        return create_sage_p3(config.get_device(), config.local_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts), num_classes=config.num_classes)
     elif config.model == 'gat':
-        return create_gat_p3(config.rank, config.local_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts), num_classes=config.num_classes, num_heads=config.num_heads)
+        return create_gat_p3(config.get_device(), config.local_in_feats, hid_feats=config.hid_feats, num_layers=len(config.fanouts), num_classes=config.num_classes, num_heads=config.num_heads)
     
     
-def ddp_setup(rank, world_size):
+def ddp_setup(rank, world_size, backend="nccl"):
     """
     Args:
         rank: Unique identifier of each process
         world_size: Total number of processes
+        backend: nccl for GPU training, gloo for CPU training
     """
     os.environ["MASTER_ADDR"] = "localhost"
     os.environ["MASTER_PORT"] = "12355"
-    init_process_group(backend="nccl", rank=rank, world_size=world_size)
-    torch.cuda.set_device(rank)
+    init_process_group(backend=backend, rank=rank, world_size=world_size)
+    if backend == "nccl":
+        torch.cuda.set_device(rank)
+
+def load_worker_feat(config: RunConfig, feats: list[torch.Tensor] | FeatureStore, part: int) -> torch.Tensor | QuantizedFeat:
+    # feature slice 'part' from the launcher's in-memory slices or from the on-disk feature store
+    if not isinstance(feats, FeatureStore):
+        return feats[part]
+    feat = feats.load(part) # memory-mapped
+    if config.feat != 'cpu':
+        # uva pins / gpu copies this worker's slice only
+        feat = feat.clone()
+    return feat
+
+def get_cache_scores(config: RunConfig, graph: dgl.DGLGraph, sampler: dgl.dataloading.NeighborSampler, train_nids: torch.Tensor, use_ddp: bool) -> torch.Tensor:
+    # node ranking for the static feature cache policies
+    if config.feat_cache_ratio <= 0 or config.feat == 'gpu':
+        return None
+    if config.feat_cache_policy == "degree":
+        return degree_scores(graph)
+    elif config.feat_cache_policy == "presample":
+        # collective: the cache of a P2 / P3 rank serves the input nodes of every rank (on its feature
+        # columns), so the counts of all the ranks' batches are summed.
+        # A loader of its own: iterating the training loader would advance the seed assignment of
+        # --balance_seeds and leave an epoch of the --sample_workers pool half consumed
+        dataloader = get_dgl_dataloader(config, sampler, graph, train_nids, use_dpp=use_ddp, use_uva=config.uva_sample())
+        scores = presample_scores(dataloader, graph.num_nodes())
+        if config.world_size > 1:
+            scores = scores.to(config.get_device())
+            all_reduce(scores)
+            scores = scores.cpu()
+        return scores
+    return None
+
+def get_train_nids(config: RunConfig, idx_split) -> tuple[torch.Tensor, bool]:
+    # train seeds of this rank and whether the dataloader still has to shard them (use_ddp)
+    if config.seed_partition == "locality":
+        return idx_split['train_parts'][config.rank], False
+    return idx_split['train'], True
 
 def quiver_train(rank:int, 
          world_size:int, 
@@ -82,17 +146,23 @@ def quiver_train(rank:int,
          sampler: quiver.pyg.GraphSageSampler, 
          node_labels: torch.Tensor, 
          idx_split):
-    ddp_setup(rank, world_size)
-
-    node_labels = node_labels.to(rank)
+    ddp_setup(rank, world_size, config.backend)
+    config.rank = rank
+    node_labels = node_labels.to(config.get_device())
     train_nids = idx_split['train'] # nids must be in 64bit long
     valid_nids = idx_split['valid'] # nids must be in 64bit long
     config.rank = rank
     config.mode = 0
     config.world_size = world_size
     config.set_logpath()
-    train_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.batch_size, nids=train_nids, sampler=sampler)
-    val_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.batch_size, nids=valid_nids, sampler=sampler)
+    if config.balance_seeds:
+        assigner = BalancedAssigner(train_nids, idx_split['train_cost'], config.batch_size, config.rank, config.world_size)
+        train_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.batch_size, nids=train_nids, sampler=sampler, assigner=assigner)
+    elif config.seed_partition == "locality":
+        train_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.batch_size, nids=idx_split['train_parts'][rank], sampler=sampler, partition=False)
+    else:
+        train_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.batch_size, nids=train_nids, sampler=sampler)
+    val_dataloader = QuiverDglSageSample(rank=config.rank, world_size=config.world_size, batch_size=config.eval_batch_size, nids=valid_nids, sampler=sampler)
     model = create_model(config)
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
     trainer = QuiverTrainer(config, model, train_dataloader, val_dataloader, global_feat, node_labels, optimizer, torch.int64)
@@ -102,151 +172,262 @@ def quiver_train(rank:int,
 def dgl_train(rank:int, 
          world_size:int, 
          config: RunConfig,
-         feat: torch.Tensor,
+         feat: torch.Tensor | FeatureStore,
          sampler: dgl.dataloading.NeighborSampler, 
          node_labels: torch.Tensor, 
          idx_split):
-    ddp_setup(rank, world_size)
+    ddp_setup(rank, world_size, config.backend)
+    config.rank = rank
+    if isinstance(feat, FeatureStore):
+        feat = load_worker_feat(config, feat, 0)
     graph = dgl.hetero_from_shared_memory("dglgraph").formats("csc")
-    node_labels = node_labels.to(rank)
-    train_nids = idx_split['train']  # nids must be in 32-bit int
+    node_labels = node_labels.to(config.get_device())
     valid_nids = idx_split['valid']  # nids must be in 32-bit int
     pinned_handle = None
     if config.feat == 'uva':
-        pinned_handle = pin_memory_inplace(feat)
+        pinned_handle = pin_memory_inplace(feat_storage(feat))
     elif config.feat == 'gpu':
-        feat = feat.to(rank)
+        feat = feat.to(config.get_device())
         
     config.rank = rank
     config.mode = 1
     config.world_size = world_size
     config.global_in_feats = int(feat.shape[1])
     config.set_logpath()
-    train_dataloader = get_dgl_dataloader(config, sampler, graph, train_nids, use_dpp=True, use_uva=config.uva_sample())
-    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample())
+    train_nids, use_ddp = get_train_nids(config, idx_split)
+    train_dataloader = get_train_dataloader(config, sampler, graph, train_nids, idx_split, use_ddp=use_ddp)
+    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample(), batch_size=config.eval_batch_size, drop_last=False)
     model = create_model(config)
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
     trainer = DglTrainer(config, model, train_dataloader, val_dataloader, feat, node_labels, optimizer, torch.int64)
     trainer.train()
+    if config.inference:
+        trainer.infer(graph)
+    if isinstance(train_dataloader, WorkerPoolLoader):
+        train_dataloader.close() # sampler processes and their shared memory slots
     destroy_process_group()
     
 def distload_train(rank:int, 
          world_size:int, 
          config: RunConfig,
-         loc_feats: list[torch.Tensor], # CPU feature
+         loc_feats: list[torch.Tensor] | FeatureStore, # CPU feature
          sampler: dgl.dataloading.NeighborSampler, 
          node_labels: torch.Tensor, 
          idx_split):
-    ddp_setup(rank, world_size)
+    ddp_setup(rank, world_size, config.backend)
+    config.rank = rank
     graph = dgl.hetero_from_shared_memory("dglgraph").formats("csc")
-    node_labels = node_labels.to(rank)
-    train_nids = idx_split['train']
+    node_labels = node_labels.to(config.get_device())
     valid_nids = idx_split['valid']
     pinned_handle = None
+    loc_feat = load_worker_feat(config, loc_feats, rank)
     if config.feat == 'uva':
-        pinned_handle = pin_memory_inplace(loc_feats[rank])
-        loc_feat = loc_feats[rank]
+        pinned_handle = pin_memory_inplace(feat_storage(loc_feat))
     elif config.feat == 'gpu':
-        loc_feat = loc_feats[rank].to(rank)
+        loc_feat = loc_feat.to(config.get_device())
         
     config.rank = rank
     config.world_size = world_size
     config.mode = 2
 
     config.set_logpath()
-    train_dataloader = get_dgl_dataloader(config, sampler, graph, train_nids, use_dpp=True, use_uva=config.uva_sample())
-    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample())
+    train_nids, use_ddp = get_train_nids(config, idx_split)
+    train_dataloader = get_train_dataloader(config, sampler, graph, train_nids, idx_split, use_ddp=use_ddp)
+    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample(), batch_size=config.eval_batch_size, drop_last=False)
     model = create_model(config)
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
-    trainer = P2Trainer(config, model, train_dataloader, val_dataloader, loc_feat, node_labels, optimizer, torch.int32)
+    cache_scores = get_cache_scores(config, graph, sampler, train_nids, use_ddp)
+    trainer = P2Trainer(config, model, train_dataloader, val_dataloader, loc_feat, node_labels, optimizer, torch.int32, cache_scores=cache_scores)
     trainer.train()
+    if isinstance(train_dataloader, WorkerPoolLoader):
+        train_dataloader.close() # sampler processes and their shared memory slots
     destroy_process_group()
 
 def p3_train(rank:int, 
          world_size:int, 
          config: RunConfig,
-         loc_feats: list[torch.Tensor], # CPU feature
+         loc_feats: list[torch.Tensor] | FeatureStore, # CPU feature
          sampler: dgl.dataloading.NeighborSampler,
          node_labels: torch.Tensor, 
          idx_split):
-    ddp_setup(rank, world_size)
+    ddp_setup(rank, world_size, config.backend)
+    config.rank = rank
     graph = dgl.hetero_from_shared_memory("dglgraph").formats("csc")
-    node_labels = node_labels.to(rank)
-    train_nids = idx_split['train']
+    node_labels = node_labels.to(config.get_device())
     valid_nids = idx_split['valid']
     loc_feat = None
     pinned_handle = None
+    loc_feat = load_worker_feat(config, loc_feats, rank)
     if config.feat == 'uva':
-        pinned_handle = pin_memory_inplace(loc_feats[rank])
-        loc_feat = loc_feats[rank]
+        pinned_handle = pin_memory_inplace(feat_storage(loc_feat))
     elif config.feat == 'gpu':
-        loc_feat = loc_feats[rank].to(rank)
+        loc_feat = loc_feat.to(config.get_device())
         
     config.rank = rank
     config.world_size = world_size
     config.mode = 3
     config.set_logpath()
     local_model, global_model = create_p3_model(config)                                           
-    train_dataloader = get_dgl_dataloader(config, sampler, graph, train_nids, use_dpp=True, use_uva=config.uva_sample())
-    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample())
+    train_nids, use_ddp = get_train_nids(config, idx_split)
+    train_dataloader = get_train_dataloader(config, sampler, graph, train_nids, idx_split, use_ddp=use_ddp)
+    val_dataloader = get_dgl_dataloader(config, sampler, graph, valid_nids, use_dpp=True, use_uva=config.uva_sample(), batch_size=config.eval_batch_size, drop_last=False)
     global_optimizer = torch.optim.Adam(global_model.parameters(), lr=1e-3)
     local_optimizer = torch.optim.Adam(local_model.parameters(), lr=1e-3)
-    trainer = P3Trainer(config, global_model, local_model, train_dataloader, val_dataloader, loc_feat, node_labels, global_optimizer, local_optimizer, nid_dtype=torch.int32)
+    cache_scores = get_cache_scores(config, graph, sampler, train_nids, use_ddp)
+    trainer = P3Trainer(config, global_model, local_model, train_dataloader, val_dataloader, loc_feat, node_labels, global_optimizer, local_optimizer, nid_dtype=torch.int32, cache_scores=cache_scores)
     trainer.train()
+    if config.inference:
+        trainer.infer(graph)
+    if isinstance(train_dataloader, WorkerPoolLoader):
+        train_dataloader.close() # sampler processes and their shared memory slots
     destroy_process_group()
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='simple distributed training job')
     parser.add_argument('--total_epochs', default=6, type=int, help='Total epochs to train the model')
-    parser.add_argument('--save_every', default=150, type=int, help='How often to save a snapshot')
+    parser.add_argument('--save_every', default=150, type=int, help='How often to save a snapshot (the last epoch is always saved)')
+    parser.add_argument('--resume', action='store_true', help='Restart from the newest complete checkpoint of the same configuration (<log>_ckpt)')
     parser.add_argument('--hid_feats', default=256, type=int, help='Size of a hidden feature')
     parser.add_argument('--batch_size', default=1024, type=int, help='Input batch size on each device (default: 1024)')
+    parser.add_argument('--eval_batch_size', default=4096, type=int, help='Validation batch size on each device (default: 4096)')
+    parser.add_argument('--eval_every', default=1, type=int, help='Evaluate after every n-th epoch and after the last one (0: last epoch only; skipped epochs log val_acc nan)')
+    parser.add_argument('--inference', action='store_true', help='Modes 1 and 3: after training, compute every node\'s output layer by layer with all neighbors, streaming each layer to <log>_infer/layer<i>.npy')
+    parser.add_argument('--infer_chunk_size', default=16384, type=int, help='Destination nodes per block of the layer-wise inference')
+    parser.add_argument('--no_eval_overlap', action='store_true', help='Sample the validation batches in the training thread instead of a background thread')
     parser.add_argument('--mode', default=1, type=int, help='Runner mode (0: Quiver + DP; 1: Dgl DP; 2: Dgl (DP + FP); 3: Dgl (P3)')
     parser.add_argument('--nprocs', default=4, type=int, help='Number of GPUs / processes')
     parser.add_argument('--topo', default="uva", type=str, help='sampling via: uva, gpu, cpu', choices=["cpu", "uva", "gpu"])
     parser.add_argument('--feat', default="uva", type=str, help='feature extraction via: uva, gpu, cpu', choices=["cpu", "uva", "gpu"])
     parser.add_argument('--model', default="gat", type=str, help='Model type: sage or gat', choices=['sage', 'gat'])
     parser.add_argument('--num_heads', default=4, type=int, help='Number of heads for GAT model')
-    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, help="Input graph name any of ['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M']", choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M'])
+    parser.add_argument('--device', default="cuda", type=str, help='execution device: cuda (nccl backend) or cpu (gloo backend)', choices=["cuda", "cpu"])
+    parser.add_argument('--graph_name', default="ogbn-arxiv", type=str, help="Input graph name any of ['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M', 'synthetic']", choices=['ogbn-arxiv', 'ogbn-products', 'ogbn-papers100M', 'synthetic'])
+    parser.add_argument('--synthetic', default="100000,10,128,16", type=str, help='Random graph of --graph_name synthetic (no download): num_nodes,avg_degree,feat_width,num_classes')
+    parser.add_argument('--fanouts', default="20,20,20", type=str, help='Comma-separated sampling fanouts, one per layer')
+    parser.add_argument('--log_dir', default="", type=str, help='Directory of the csv logs, checkpoints and traces (default: logs)')
+    parser.add_argument('--prefetch', action='store_true', help='P3 only: overlap sampling and edge / feature exchange of the next batch with training')
+    parser.add_argument('--prefetch_depth', default=1, type=int, help='Number of batches prepared ahead when --prefetch is set (1: double buffering)')
+    parser.add_argument('--packed_gather', action='store_true', help='P3 only: exchange input nodes and edges with one padded all_gather instead of three')
+    parser.add_argument('--p2_transport', default="all_to_all", type=str, help='P2 only: feature exchange via a single all_to_all or one dist.gather per GPU', choices=["all_to_all", "gather"])
+    parser.add_argument('--shuffle_mode', default="overlap", type=str, help='P3 only: first-layer reduction. sync: reduce after the whole first layer; overlap: reduce each GPU\'s part as soon as it is computed; reduce_scatter: one padded reduce_scatter', choices=["sync", "overlap", "reduce_scatter"])
+    parser.add_argument('--comm_dtype', default="float32", type=str, help='P2 / P3 only: wire format of exchanged features, hidden activations and gradients (accumulation stays in float32)', choices=["float32", "float16", "bfloat16"])
+    parser.add_argument('--comm_row_scale', action='store_true', help='Send per-row scales with --comm_dtype float16 / bfloat16 payloads')
+    parser.add_argument('--fused_first_layer', action='store_true', help='P3 only: stack the top blocks of all the GPUs into one block-diagonal block and run the first layer once; its local update sums the gradients of all the GPUs, the per-peer default steps on the gradient of the last peer')
+    parser.add_argument('--dedup_input', action='store_true', help='P3 only: extract the local features of input nodes shared by several GPUs once')
+    parser.add_argument('--feat_cache_ratio', default=0.0, type=float, help='P2 / P3 only: fraction of every local feature slice cached on the GPU (uva / cpu feature extraction)')
+    parser.add_argument('--feat_cache_policy', default="degree", type=str, help='Feature cache policy. degree / presample: static hottest nodes; lru / lfu: dynamic replacement', choices=CACHE_POLICIES)
+    parser.add_argument('--seed_partition', default="random", type=str, help='Train seed assignment. random: DGL ddp split; locality: contiguous slices of the seeds ordered by label propagation clusters (cached under dataset/partition)', choices=SEED_PARTITIONS)
+    parser.add_argument('--sampler', default="dgl", type=str, help='Neighbor sampler (modes 1-3). dgl: dgl.dataloading.NeighborSampler; csc: in-repo sampler on the shared csc arrays (requires --topo cpu)', choices=["dgl", "csc"])
+    parser.add_argument('--sampler_threads', default=4, type=int, help='Threads of the csc sampler')
+    parser.add_argument('--balance_seeds', action='store_true', help='Deal the seeds of every global batch to the GPUs by their degree-estimated top block size instead of a random split')
+    parser.add_argument('--straggler_report', action='store_true', help='P3 only: record how long every GPU waits at each collective and write max / mean / p95 wait per epoch to <log>_wait.csv (with --prefetch, without the size / edge all_gather of the prefetch thread)')
+    parser.add_argument('--log_block_sizes', action='store_true', help='P3 only: write the per-GPU top block edge / node counts of every minibatch to <log>_blocks.csv')
+    parser.add_argument('--trace', action='store_true', help='Record per-iteration spans on every GPU and write a Chrome trace / Perfetto JSON next to the csv log')
+    parser.add_argument('--sample_workers', default=0, type=int, help='Modes 1-3: sampler processes per GPU writing minibatches into shared memory slots (0: sample in the trainer process; requires --topo cpu)')
+    parser.add_argument('--sample_queue_depth', default=4, type=int, help='Shared memory slots per GPU the sampler processes can fill ahead of the trainer')
+    parser.add_argument('--amp', action='store_true', help='Mixed precision: autocast with float16 and loss scaling on cuda, bfloat16 on cpu (logs throughput, loss scale and, when the float32 log of the same run exists, acc_delta / speedup)')
+    parser.add_argument('--feat_dtype', default="float32", type=str, help='Modes 1-3: storage dtype of the node features; float16 halves and int8 (per-column scale / zero point, dequantized on the device) quarters the host memory and the bytes of the host / device feature gather (the P2 exchange between gpus follows --comm_dtype)', choices=FEAT_STORAGE)
+    parser.add_argument('--cache', action='store_true', help='Preprocess the dataset once (self loops, int32 ids, csc) into dataset/cache and memory-map it on later runs')
+    parser.add_argument('--feat_store', action='store_true', help='Convert features once into per-rank column slices under dataset/feat_store and memory-map them in the workers (mode 1: cpu feature extraction only)')
     args = parser.parse_args()
+    if args.graph_name == 'synthetic':
+        args.graph_name = synthetic_name(args.synthetic)
+    if args.balance_seeds and (args.seed_partition != 'random' or args.sample_workers > 0):
+        parser.error("--balance_seeds replaces the seed split, it cannot be combined with --seed_partition locality or --sample_workers")
+    if args.sample_workers > 0 and (args.topo != 'cpu' or args.mode == 0):
+        parser.error("--sample_workers requires --topo cpu and modes 1-3")
+    if args.inference and args.mode not in [1, 3]:
+        parser.error("--inference supports modes 1 (DGL) and 3 (P3)")
+    if args.feat_dtype != "float32" and args.mode == 0:
+        parser.error("--feat_dtype requires modes 1-3")
+    if args.shuffle_mode == 'reduce_scatter' and args.comm_dtype != 'float32':
+        parser.error("--shuffle_mode reduce_scatter sends float32; a compressed --comm_dtype gathers the parts on their owner instead (use --shuffle_mode overlap)")
+    if args.sampler == 'csc' and args.topo != 'cpu':
+        parser.error("--sampler csc requires --topo cpu")
+    if args.device == 'cpu':
+        if args.mode == 0:
+            parser.error("mode 0 (Quiver) requires --device cuda")
+        if args.topo != 'cpu' or args.feat != 'cpu':
+            parser.error("--device cpu requires --topo cpu --feat cpu")
     project_dir = os.path.dirname(os.path.realpath(__file__))
-    log_dir = os.path.join(project_dir, "logs")
+    log_dir = args.log_dir if args.log_dir != "" else os.path.join(project_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
     data_dir = os.path.join(project_dir, "dataset")
     
     config = RunConfig()
-    world_size = min(args.nprocs, torch.cuda.device_count())
-    print(f"using {world_size} GPUs in mode {args.mode}")
+    config.device = args.device
+    if config.use_cuda():
+        config.backend = "nccl"
+        world_size = min(args.nprocs, torch.cuda.device_count())
+        print(f"using {world_size} GPUs in mode {args.mode}")
+    else:
+        config.backend = "gloo"
+        world_size = args.nprocs
+        print(f"using {world_size} CPU processes in mode {args.mode}")
     print("start loading data")
     
+    timings = {} # startup stage -> seconds
     load_start = time.time()
-    dataset = DglNodePropPredDataset(args.graph_name, root=data_dir)
+    graph, node_labels, idx_split, num_classes, feat, from_cache = load_dataset(args.graph_name, data_dir, timings, use_cache=args.cache)
     load_end = time.time()
-    print(f"finish loading in {round(load_end - load_start, 1)}s")
-    
-    graph: dgl.DGLGraph = dataset[0][0]
-    graph = dgl.add_self_loop(graph)
-    node_labels: torch.Tensor = dataset[0][1]
-    node_labels = node_labels.flatten().clone()
-    torch.nan_to_num_(node_labels, nan=0.1)
-    node_labels: torch.Tensor = node_labels.type(torch.int64)
-    feat: torch.Tensor = graph.dstdata.pop("feat")
+    print(f"finish loading in {round(load_end - load_start, 1)}s" + (" (from cache)" if from_cache else ""))
      
-    config.num_classes = dataset.num_classes
+    config.num_classes = num_classes
     config.batch_size = args.batch_size
     config.total_epoch = args.total_epochs
+    config.eval_batch_size = args.eval_batch_size
+    config.eval_every = args.eval_every
+    config.eval_overlap = not args.no_eval_overlap
+    config.inference = args.inference
+    config.infer_chunk_size = args.infer_chunk_size
     config.hid_feats = args.hid_feats
     config.save_every = args.save_every
+    config.resume = args.resume
     config.graph_name = args.graph_name
     config.topo = args.topo
     config.feat = args.feat
-    config.fanouts = [20, 20, 20]
+    config.fanouts = [int(fanout) for fanout in args.fanouts.split(",")]
     config.global_in_feats = feat.shape[1]
     config.model = args.model
     config.num_heads = args.num_heads
-    idx_split = dataset.get_idx_split()
+    config.prefetch = args.prefetch
+    config.prefetch_depth = args.prefetch_depth
+    config.packed_gather = args.packed_gather
+    config.p2_transport = args.p2_transport
+    config.shuffle_mode = args.shuffle_mode
+    config.comm_dtype = args.comm_dtype
+    config.comm_row_scale = args.comm_row_scale
+    config.fused_first_layer = args.fused_first_layer
+    config.dedup_input = args.dedup_input
+    config.feat_cache_ratio = args.feat_cache_ratio
+    config.seed_partition = args.seed_partition
+    config.trace = args.trace
+    config.balance_seeds = args.balance_seeds
+    config.straggler_report = args.straggler_report
+    config.log_block_sizes = args.log_block_sizes
+    config.sample_workers = args.sample_workers
+    config.sample_queue_depth = args.sample_queue_depth
+    config.feat_cache_policy = args.feat_cache_policy
+    config.amp = args.amp
+    config.feat_dtype = args.feat_dtype
     config.log_dir = log_dir
 
+    if config.seed_partition == "locality":
+        with timed(timings, "partition"):
+            clusters = load_clusters(graph, os.path.join(data_dir, "partition"), args.graph_name)
+            idx_split['train_parts'] = locality_partition(idx_split['train'], clusters, world_size)
+        print(f"locality seed partition: {clusters.unique().shape[0]} clusters")
+        del clusters
+
+    if config.balance_seeds:
+        with timed(timings, "seed_costs"):
+            idx_split['train_cost'] = seed_costs(graph, config.fanouts)[idx_split['train'].long()]
+
+    store_name = args.graph_name # feature store of the storage dtype
+    if config.feat_dtype != "float32":
+        store_name = f"{args.graph_name}_{config.feat_dtype}"
+
     if config.uva_feat():
         print("using uva feature extraction")
     elif config.feat=='GPU':
@@ -254,12 +435,18 @@ if __name__ == "__main__":
         
     print("Global Feature Size: ", get_size_str(feat))    
     if args.mode == 0:
+        import quiver
         quiver.init_p2p(device_list=list(range(world_size)))
         row, col = graph.adj_tensors(fmt="coo") # dgl v1.1 and above
         # row, col = graph.adj_sparse(fmt="coo") # dgl v1.0 and below
-        csr_topo = quiver.CSRTopo(edge_index=(row, col))
+        csr_topo = quiver.CSRTopo(edge_index=(row.long(), col.long()))
         sampler = quiver.pyg.GraphSageSampler(csr_topo=csr_topo, sizes=config.fanouts, mode=config.topo.upper())
-        del dataset, graph, row, col
+        for key, nids in idx_split.items():
+            if key == 'train_parts':
+                idx_split[key] = [part.type(torch.int64) for part in nids]
+            elif key != 'train_cost':
+                idx_split[key] = nids.type(torch.int64)
+        del graph, row, col
     
         # Quiver Sampling + Quiver Feature
         qfeat = quiver.Feature(0, device_list=list(range(world_size)), cache_policy="p2p_clique_replicate", \
@@ -267,38 +454,73 @@ if __name__ == "__main__":
         qfeat.from_cpu_tensor(feat)
         del feat
         gc.collect()
+        print("startup:", format_timings(timings))
         mp.spawn(quiver_train, args=(world_size, config, qfeat, sampler, node_labels, idx_split), nprocs=world_size, daemon=True)
         exit(0)
         
-    graph = graph.int()
-    for key, nids in idx_split.items():
-        idx_split[key] = nids.type(torch.int32)
-    graph.create_formats_()
+    with timed(timings, "shared_memory"):
+        if from_cache:
+            # workers only sample from csc, the cached graph is not converted to the other formats
+            shared_graph = graph.shared_memory("dglgraph", formats=["csc"])
+        else:
+            graph.create_formats_()
+            shared_graph = graph.shared_memory("dglgraph")
     print(f"using dgl sampler, graph formats created: {graph.formats()}")
-    shared_graph = graph.shared_memory("dglgraph")
-    sampler = dgl.dataloading.NeighborSampler(config.fanouts)
-    del dataset, graph
+    if args.sampler == "csc":
+        print(f"using csc sampler with {args.sampler_threads} threads")
+        sampler = CSCNeighborSampler(config.fanouts, num_threads=args.sampler_threads)
+    else:
+        sampler = dgl.dataloading.NeighborSampler(config.fanouts)
+    del graph
     gc.collect()
+    # daemonic processes cannot start the sampling worker processes
+    daemon = config.sample_workers == 0
     
     if args.mode == 1:
         # DGL Data Parallel
-        mp.spawn(dgl_train, args=(world_size, config, feat, sampler, node_labels, idx_split), nprocs=world_size, daemon=True)
+        if args.feat_store and config.feat == 'cpu':
+            # every worker memory-maps the same full feature matrix (shared through the page cache)
+            store = FeatureStore(os.path.join(data_dir, "feat_store"), store_name, 1, padding=False, dtype=config.feat_dtype)
+            if not store.exists():
+                with timed(timings, "feat_store"):
+                    store.write(feat)
+            del feat
+            gc.collect()
+            feat = store
+        elif config.feat_dtype != "float32":
+            with timed(timings, "feat_compress"):
+                feat = compress_feat(feat, config.feat_dtype)
+        print("startup:", format_timings(timings))
+        mp.spawn(dgl_train, args=(world_size, config, feat, sampler, node_labels, idx_split), nprocs=world_size, daemon=daemon)
     elif args.mode == 2 or args.mode == 3:
         # Feature data is horizontally partitioned
-        feats = [None] * world_size
-        for i in range(world_size):
-            feats[i] = get_local_feat(i, world_size, feat, padding=True).clone()
-            if i == 0:
-                config.global_in_feats = feats[i].shape[1] * world_size
-                config.local_in_feats = feats[i].shape[1]
-            assert(config.global_in_feats == feats[i].shape[1] * world_size)
-            assert(config.local_in_feats == feats[i].shape[1])
+        if args.feat_store:
+            # workers memory-map their own slice, the launcher never holds more than the loaded features
+            feats = FeatureStore(os.path.join(data_dir, "feat_store"), store_name, world_size, dtype=config.feat_dtype)
+            if not feats.exists():
+                print("writing feature store to", feats.dir)
+                with timed(timings, "feat_store"):
+                    feats.write(feat)
+            config.global_in_feats = feats.global_width()
+            config.local_in_feats = feats.local_width()
+        else:
+            feats = [None] * world_size
+            partition_start = time.time()
+            for i in range(world_size):
+                feats[i] = compress_feat(get_local_feat(i, world_size, feat, padding=True), config.feat_dtype)
+                if i == 0:
+                    config.global_in_feats = feats[i].shape[1] * world_size
+                    config.local_in_feats = feats[i].shape[1]
+                assert(config.global_in_feats == feats[i].shape[1] * world_size)
+                assert(config.local_in_feats == feats[i].shape[1])
+            timings["feat_partition"] = time.time() - partition_start
 
         del feat
         gc.collect()
+        print("startup:", format_timings(timings))
         if args.mode == 2:
             # P2 Data Vertical Split
-            mp.spawn(distload_train, args=(world_size, config, feats, sampler, node_labels, idx_split), nprocs=world_size, daemon=True)
+            mp.spawn(distload_train, args=(world_size, config, feats, sampler, node_labels, idx_split), nprocs=world_size, daemon=daemon)
         elif args.mode == 3:
             # P3 Data Vertical Split + Intra-Model Parallelism
-            mp.spawn(p3_train, args=(world_size, config, feats, sampler, node_labels, idx_split), nprocs=world_size, daemon=True)            
+            mp.spawn(p3_train, args=(world_size, config, feats, sampler, node_labels, idx_split), nprocs=world_size, daemon=daemon)
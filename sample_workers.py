@@ -0,0 +1,212 @@
+from __future__ import annotations
+import time
+import queue
+from collections import deque
+import torch
+import torch.multiprocessing as mp
+import dgl
+from dgl import create_block
+
+MAX_LAYERS = 8
+HEADER_SIZE = 3 + 3 * MAX_LAYERS # num_layers, num_input, num_output, (num_src, num_dst, num_edges) per block
+
+def _write_slot(slot: torch.Tensor, input_nodes: torch.Tensor, output_nodes: torch.Tensor, blocks: list) -> bool:
+    # Slot layout (int32): header | input nodes | output nodes | (src, dst) of every block
+    # returns False if the batch does not fit
+    coo = [block.adj_tensors('coo') for block in blocks]
+    total = HEADER_SIZE + input_nodes.shape[0] + output_nodes.shape[0] + sum(2 * src.shape[0] for src, _ in coo)
+    if total > slot.shape[0] or len(blocks) > MAX_LAYERS:
+        return False
+    header = [len(blocks), input_nodes.shape[0], output_nodes.shape[0]]
+    for block in blocks:
+        header += [block.num_src_nodes(), block.num_dst_nodes(), block.num_edges()]
+    slot[:len(header)] = torch.tensor(header, dtype=slot.dtype)
+    offset = HEADER_SIZE
+    for tensor in [input_nodes, output_nodes] + [t for pair in coo for t in pair]:
+        slot[offset : offset + tensor.shape[0]] = tensor
+        offset += tensor.shape[0]
+    return True
+
+def _read_slot(slot: torch.Tensor, device: torch.device) -> tuple[torch.Tensor, torch.Tensor, list]:
+    # blocks are built on zero-copy views of the slot (copied once when device is a gpu)
+    header = slot[:HEADER_SIZE].tolist()
+    num_layers, num_input, num_output = header[:3]
+    offset = HEADER_SIZE
+    input_nodes = slot[offset : offset + num_input]
+    offset += num_input
+    output_nodes = slot[offset : offset + num_output]
+    offset += num_output
+    blocks = []
+    for layer in range(num_layers):
+        num_src, num_dst, num_edges = header[3 + 3 * layer : 6 + 3 * layer]
+        src = slot[offset : offset + num_edges]
+        dst = slot[offset + num_edges : offset + 2 * num_edges]
+        offset += 2 * num_edges
+        blocks.append(create_block(('coo', (src, dst)), num_src_nodes=num_src, num_dst_nodes=num_dst, device=device))
+    return input_nodes.to(device), output_nodes.to(device), blocks
+
+def _sample_worker(worker_id: int, sampler, seeds: torch.Tensor, order: torch.Tensor, batch_size: int,
+                   slots: list[torch.Tensor], task_queue: mp.Queue, result_queue: mp.Queue, num_threads: int):
+    torch.set_num_threads(num_threads)
+    graph = dgl.hetero_from_shared_memory("dglgraph").formats("csc")
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_idx, slot_idx = task
+        start = time.time()
+        batch_seeds = seeds[order[batch_idx * batch_size : (batch_idx + 1) * batch_size].long()]
+        input_nodes, output_nodes, blocks = sampler.sample(graph, batch_seeds)
+        fallback = None
+        if not _write_slot(slots[slot_idx], input_nodes, output_nodes, blocks):
+            # too large for a slot: sent through the queue instead (torch moves it to shared memory)
+            fallback = (input_nodes, output_nodes, blocks)
+        result_queue.put((worker_id, batch_idx, slot_idx, time.time() - start, fallback))
+
+class WorkerPoolLoader:
+    """Samples minibatches of `seeds` in num_workers background processes.
+
+    Replacement for the dgl DataLoader (num_workers=0) with topo=cpu: the workers attach to the
+    shared memory graph "dglgraph", sample with `sampler` and write the block COO arrays into a
+    ring of num_slots shared memory slots; the trainer rebuilds the blocks from the slots.
+    Batches are yielded in completion order. A slot is handed back to the workers once `hold`
+    newer batches were taken (the blocks of a batch are views of its slot on cpu).
+
+    use_ddp: shard the seeds across ranks (equal shards, so every rank runs the same number of
+    batches); like the use_ddp dgl DataLoader, the seeds are permuted globally every epoch with the
+    same generator (seed + epoch) on every rank, and every rank takes its slice of the permutation.
+    """
+    def __init__(self,
+                 sampler,
+                 seeds: torch.Tensor,
+                 batch_size: int,
+                 device: torch.device,
+                 num_workers: int = 2,
+                 num_slots: int = 4,
+                 slot_size: int = 1 << 24, # int32 entries per slot
+                 hold: int = 1,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 use_ddp: bool = True,
+                 num_threads: int = 1,
+                 seed: int = 0):
+        seeds = seeds.to('cpu')
+        self.all_seeds = None
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        if use_ddp and world_size > 1:
+            # the shard is refilled in place by every __iter__ (the workers hold the shared tensor)
+            self.all_seeds = seeds
+            self.shard_size = int(seeds.shape[0] / world_size)
+            seeds = seeds[:self.shard_size]
+        self.seeds = seeds.clone().share_memory_()
+        self.order = torch.arange(self.seeds.shape[0], dtype=torch.int64).share_memory_()
+        self.batch_size = batch_size
+        self.device = device
+        self.num_batches = int(self.seeds.shape[0] / batch_size) # drop_last
+        self.num_workers = num_workers
+        self.hold = hold
+        self.slots = [torch.zeros(slot_size, dtype=self.seeds.dtype).share_memory_() for _ in range(max(num_slots, hold + 1))]
+        ctx = mp.get_context("spawn")
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.workers = []
+        for worker_id in range(num_workers):
+            worker = ctx.Process(target=_sample_worker, args=(worker_id, sampler, self.seeds, self.order, batch_size,
+                                                              self.slots, self.task_queue, self.result_queue, num_threads), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.free_slots: deque[int] = deque(range(len(self.slots)))
+        self.held_slots: deque[int] = deque()
+        self.next_batch = 0
+        self.received = 0
+        self.in_flight = 0
+        self.worker_batches = [0] * num_workers
+        self.worker_time = [0.0] * num_workers
+        self.fallbacks = 0
+
+    def __len__(self) -> int:
+        return self.num_batches
+
+    def _dispatch(self, slot_idx: int):
+        if self.next_batch < self.num_batches:
+            self.task_queue.put((self.next_batch, slot_idx))
+            self.next_batch += 1
+            self.in_flight += 1
+        else:
+            self.free_slots.append(slot_idx)
+
+    def __iter__(self):
+        # drain an epoch that was not consumed to the end
+        while self.in_flight > 0:
+            _, _, slot_idx, _, _ = self.result_queue.get()
+            self.in_flight -= 1
+            self.free_slots.append(slot_idx)
+        self.free_slots.extend(self.held_slots)
+        self.held_slots.clear()
+        if self.all_seeds is not None:
+            # same permutation on every rank
+            perm = torch.randperm(self.all_seeds.shape[0], generator=torch.Generator().manual_seed(self.seed + self.epoch))
+            self.seeds.copy_(self.all_seeds[perm[self.rank * self.shard_size : (self.rank + 1) * self.shard_size]])
+        self.epoch += 1
+        self.order.copy_(torch.randperm(self.seeds.shape[0]))
+        self.next_batch = 0
+        self.received = 0
+        self.worker_batches = [0] * self.num_workers
+        self.worker_time = [0.0] * self.num_workers
+        self.fallbacks = 0
+        free_slots = list(self.free_slots)
+        self.free_slots.clear()
+        for slot_idx in free_slots:
+            self._dispatch(slot_idx)
+        return self
+
+    def __next__(self):
+        while len(self.held_slots) >= self.hold:
+            self._dispatch(self.held_slots.popleft())
+        if self.received == self.num_batches:
+            raise StopIteration
+        while True:
+            try:
+                worker_id, batch_idx, slot_idx, sample_time, fallback = self.result_queue.get(timeout=60)
+                break
+            except queue.Empty:
+                dead = [worker.pid for worker in self.workers if not worker.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError(f"sampling workers {dead} exited unexpectedly")
+        self.in_flight -= 1
+        self.received += 1
+        self.worker_batches[worker_id] += 1
+        self.worker_time[worker_id] += sample_time
+        if fallback is not None:
+            self.fallbacks += 1
+            self._dispatch(slot_idx)
+            input_nodes, output_nodes, blocks = fallback
+            return input_nodes.to(self.device), output_nodes.to(self.device), [block.to(self.device) for block in blocks]
+        batch = _read_slot(self.slots[slot_idx], self.device)
+        if self.device.type == 'cpu':
+            self.held_slots.append(slot_idx)
+        else:
+            # the blocks were copied to the gpu, the slot can be refilled right away
+            self._dispatch(slot_idx)
+        return batch
+
+    def worker_stats(self) -> dict:
+        # per worker throughput (batches / second of sampling) in the last epoch
+        stats = {}
+        for worker_id, (batches, sample_time) in enumerate(zip(self.worker_batches, self.worker_time)):
+            stats[f"worker{worker_id}_bps"] = batches / sample_time if sample_time > 0 else 0.0
+        stats["slot_fallbacks"] = self.fallbacks
+        return stats
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        # drop the shared memory slots (freed once the blocks of the last batches are gone too)
+        self.slots = []
+        self.free_slots.clear()
+        self.held_slots.clear()
@@ -0,0 +1,114 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import dgl
+from dgl import create_block
+
+class CSCNeighborSampler(dgl.dataloading.Sampler):
+    """Uniform neighbor sampler working directly on the csc arrays of a cpu graph.
+
+    Drop-in replacement for dgl.dataloading.NeighborSampler(fanouts) with topo=cpu:
+    sample(graph, seeds) returns the same (input_nodes, output_nodes, blocks) triple.
+    The neighbors of every layer are drawn with batched torch ops (no per-node python loop);
+    the seeds are split into num_threads chunks sampled in a thread pool (torch releases the GIL).
+    Sampling is without replacement: nodes with at most fanout in-neighbors keep all of them.
+    """
+    def __init__(self, fanouts: list[int], num_threads: int = 4, max_redraws: int = 32):
+        super().__init__()
+        self.fanouts = fanouts
+        self.num_threads = num_threads
+        self.max_redraws = max_redraws
+        # created on first use, the sampler is pickled into the worker processes
+        self.pool: ThreadPoolExecutor = None
+        self.indptr: torch.Tensor = None
+        self.indices: torch.Tensor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["indptr"] = None
+        state["indices"] = None
+        return state
+
+    def _bind(self, graph: dgl.DGLGraph):
+        if self.indptr is None:
+            # views of the (shared memory) csc arrays, nothing is copied
+            indptr, indices, _ = graph.adj_tensors('csc')
+            self.indptr = indptr.long()
+            self.indices = indices
+        if self.pool is None and self.num_threads > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.num_threads)
+
+    def _sample_offsets(self, deg: torch.Tensor, fanout: int) -> torch.Tensor:
+        # fanout distinct offsets in [0, deg) for every row (all deg > fanout):
+        # draw with replacement, redraw the duplicates (at most max_redraws rounds), then
+        # the rows that still have duplicates take a randperm prefix (exact, one row at a time)
+        offsets = (torch.rand(deg.shape[0], fanout) * deg.unsqueeze(1)).long()
+        for redraw in range(self.max_redraws + 1):
+            offsets, _ = offsets.sort(dim=1)
+            dup = torch.zeros_like(offsets, dtype=torch.bool)
+            dup[:, 1:] = offsets[:, 1:] == offsets[:, :-1]
+            num_dup = int(dup.sum())
+            if num_dup == 0:
+                return offsets
+            if redraw == self.max_redraws:
+                break
+            rows = dup.nonzero()[:, 0]
+            offsets[dup] = (torch.rand(num_dup) * deg[rows]).long()
+        for row in dup.any(dim=1).nonzero()[:, 0].tolist():
+            offsets[row] = torch.randperm(int(deg[row]))[:fanout]
+        return offsets
+
+    def _sample_neighbors(self, seeds: torch.Tensor, fanout: int) -> tuple[torch.Tensor, torch.Tensor]:
+        # returns (neighbors, counts): the sampled in-neighbors of every seed, concatenated
+        start = self.indptr[seeds]
+        deg = self.indptr[seeds + 1] - start
+        counts = deg.clamp(max=fanout)
+        full = deg <= fanout
+        # nodes with deg <= fanout: all in-edges
+        full_start = start[full]
+        full_counts = deg[full]
+        full_pos = torch.repeat_interleave(full_start - torch.cumsum(full_counts, 0) + full_counts, full_counts) + torch.arange(int(full_counts.sum()))
+        # nodes with deg > fanout: fanout distinct in-edges
+        part_pos = (start[~full].unsqueeze(1) + self._sample_offsets(deg[~full], fanout)).flatten()
+        # restore the seed order: rows of the full and partial seeds interleaved
+        edge_pos = torch.empty(int(counts.sum()), dtype=torch.int64)
+        seg = torch.repeat_interleave(full.to(torch.uint8), counts).bool()
+        edge_pos[seg] = full_pos
+        edge_pos[~seg] = part_pos
+        return self.indices[edge_pos].long(), counts
+
+    def _sample_layer(self, seeds: torch.Tensor, fanout: int) -> tuple[torch.Tensor, torch.Tensor]:
+        if self.pool is None or seeds.shape[0] < 2 * self.num_threads:
+            return self._sample_neighbors(seeds, fanout)
+        futures = [self.pool.submit(self._sample_neighbors, chunk, fanout) for chunk in torch.chunk(seeds, self.num_threads)]
+        results = [future.result() for future in futures]
+        return torch.cat([nbrs for nbrs, _ in results]), torch.cat([counts for _, counts in results])
+
+    def sample(self, g: dgl.DGLGraph, seed_nodes: torch.Tensor, exclude_eids=None):
+        self._bind(g)
+        idtype = g.idtype
+        output_nodes = seed_nodes
+        seeds = seed_nodes.to('cpu').long()
+        blocks = []
+        for fanout in reversed(self.fanouts):
+            nbrs, counts = self._sample_layer(seeds, fanout)
+            # reindex: src nodes are the seeds (in order) followed by the new neighbors in order of appearance
+            num_dst = seeds.shape[0]
+            all_nodes = torch.cat([seeds, nbrs])
+            uniq, inverse = torch.unique(all_nodes, return_inverse=True)
+            first = torch.full([uniq.shape[0]], all_nodes.shape[0], dtype=torch.int64)
+            first.scatter_reduce_(0, inverse, torch.arange(all_nodes.shape[0]), reduce="amin")
+            order = torch.argsort(first)
+            local_id = torch.empty_like(order)
+            local_id[order] = torch.arange(order.shape[0])
+            src = local_id[inverse[num_dst:]]
+            dst = torch.repeat_interleave(torch.arange(num_dst), counts)
+            block = create_block(('coo', (src.to(idtype), dst.to(idtype))), num_src_nodes=uniq.shape[0], num_dst_nodes=num_dst)
+            src_nodes = uniq[order]
+            block.srcdata[dgl.NID] = src_nodes.to(idtype)
+            block.dstdata[dgl.NID] = seeds.to(idtype)
+            blocks.insert(0, block)
+            seeds = src_nodes
+        input_nodes = seeds.to(seed_nodes.dtype)
+        return input_nodes, output_nodes, blocks
@@ -0,0 +1,133 @@
+from __future__ import annotations
+import os
+import csv
+import time
+import torch
+import torch.distributed as dist
+from comm import allreduce_hook
+from utils import device_synchronize
+
+class WaitRecorder:
+    """Measures how long every rank waits for the slowest rank at each collective.
+
+    mark(kind) is called on every rank right before a collective of that kind and records the
+    arrival time (after synchronizing the device, so queued gpu work counts as not arrived).
+    The n-th arrival of a kind in an iteration is matched across ranks, and the wait of rank r is
+    latest arrival - arrival of rank r: the time it idles inside the collective on the straggler.
+    Arrivals are kept locally and exchanged once per epoch in report().
+    Timestamps are host wall clock, so the ranks must share a machine.
+    """
+    def __init__(self, rank: int, world_size: int, device: torch.device, path: str, enabled: bool = False):
+        self.rank = rank
+        self.world_size = world_size
+        self.device = device
+        self.path = path
+        self.enabled = enabled
+        self.current: dict[str, list[float]] = {}
+        self.iters: list[dict[str, list[float]]] = []
+        self.rows: list[dict] = []
+
+    def mark(self, kind: str):
+        if not self.enabled:
+            return
+        device_synchronize(self.device)
+        self.current.setdefault(kind, []).append(time.time())
+
+    def end_iter(self):
+        if not self.enabled:
+            return
+        self.iters.append(self.current)
+        self.current = {}
+
+    def discard(self):
+        # drop arrivals marked outside of the training iterations
+        self.current = {}
+
+    def comm_hook(self, state, bucket):
+        # DDP comm hook: the (counted) default allreduce, marking the arrival of every gradient bucket
+        self.mark("allreduce")
+        return allreduce_hook(state, bucket)
+
+    def _flatten(self) -> tuple[list[str], list[float]]:
+        kinds = []
+        arrivals = []
+        for it in self.iters:
+            for kind in sorted(it.keys()):
+                kinds += [kind] * len(it[kind])
+                arrivals += it[kind]
+        return kinds, arrivals
+
+    def report(self, epoch: int) -> dict:
+        """Collective. Returns (rank 0) the max / mean / p95 wait summary of the epoch per collective kind
+        and appends it to the csv at self.path."""
+        if not self.enabled:
+            return {}
+        kinds, arrivals = self._flatten()
+        num_iters = len(self.iters)
+        iter_ids = [idx for idx, it in enumerate(self.iters) for kind in sorted(it.keys()) for _ in it[kind]]
+        self.iters = []
+        gathered = [None] * self.world_size if self.rank == 0 else None
+        dist.gather_object(arrivals, object_gather_list=gathered, dst=0)
+        if self.rank != 0:
+            return {}
+        if any(len(rank_arrivals) != len(arrivals) for rank_arrivals in gathered):
+            print(f"epoch {epoch}: collective sequences differ across ranks, wait report skipped")
+            return {}
+        arrival = torch.tensor(gathered, dtype=torch.float64) # [world_size, num_events]
+        wait = arrival.max(dim=0).values - arrival
+        iter_ids = torch.tensor(iter_ids, dtype=torch.int64)
+        summary = {}
+        for kind in sorted(set(kinds)):
+            mask = torch.tensor([k == kind for k in kinds])
+            # [world_size, num_iters]: wait of every rank in every iteration
+            per_iter = torch.zeros([self.world_size, num_iters], dtype=torch.float64)
+            per_iter.index_add_(1, iter_ids[mask], wait[:, mask])
+            total = per_iter.sum(dim=1)
+            mean = total.mean().item()
+            row = {
+                "epoch": epoch,
+                "collective": kind,
+                "mean_wait": mean,
+                "max_wait": total.max().item(),
+                "imbalance": total.max().item() / mean if mean > 0 else 1.0,
+                "p95_wait": torch.quantile(per_iter.flatten(), 0.95).item(),
+                "straggler": int(total.argmin()), # the rank the others wait for waits the least
+            }
+            for r in range(self.world_size):
+                row[f"wait_r{r}"] = total[r].item()
+            for k, v in row.items():
+                if type(v) == float:
+                    row[k] = round(v, 5)
+            self.rows.append(row)
+            summary[kind] = row["max_wait"]
+        self._save()
+        return summary
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w+") as file:
+            writer = csv.DictWriter(file, list(self.rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+class BlockSizeLog:
+    # per-rank top block sizes of every minibatch (the inputs of the P3 first-layer imbalance)
+    def __init__(self, path: str, enabled: bool = False):
+        self.path = path
+        self.enabled = enabled
+        self.rows: list[list[int]] = []
+
+    def log(self, epoch: int, iter_idx: int, edge_size_lst: list):
+        if not self.enabled:
+            return
+        for rank, edge_size, src_node_size, dst_node_size in edge_size_lst:
+            self.rows.append([epoch, iter_idx, rank, edge_size, src_node_size, dst_node_size])
+
+    def save(self):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w+") as file:
+            writer = csv.writer(file)
+            writer.writerow(["epoch", "iter", "rank", "edges", "src_nodes", "dst_nodes"])
+            writer.writerows(self.rows)
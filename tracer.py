@@ -0,0 +1,116 @@
+from __future__ import annotations
+import os
+import json
+import time
+import threading
+import torch.distributed as dist
+
+class _Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer: Tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.time())
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """Per-iteration timeline of named spans (sample, feat_gather, forward, ...) of one rank.
+
+    Spans are kept in a fixed size ring buffer (the newest `capacity` spans survive),
+    so recording is a few list stores and never grows memory. Timestamps are host wall clock
+    (time.time, comparable across the processes of a machine): spans of asynchronous gpu work
+    cover its launch only, unless the trainer synchronizes around them as it does at the
+    feat / forward / backward boundaries.
+    export() gathers the spans of all the ranks on rank 0 and writes a Chrome trace / Perfetto
+    JSON file with one process per rank and one thread per recording thread.
+    A disabled tracer hands out a shared no-op span.
+    """
+    def __init__(self, rank: int, enabled: bool = False, capacity: int = 1 << 16):
+        self.rank = rank
+        self.enabled = enabled
+        self.capacity = capacity
+        self.names: list[str] = [None] * capacity
+        self.starts: list[float] = [0.0] * capacity
+        self.ends: list[float] = [0.0] * capacity
+        self.iters: list[int] = [0] * capacity
+        self.threads: list[int] = [0] * capacity
+        self.count = 0
+        self.iter_idx = 0
+        self.lock = threading.Lock() # the P3 prefetch thread records too
+
+    def span(self, name: str) -> _Span | _NullSpan:
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, start: float, end: float):
+        # span from already measured timestamps (seconds, time.time)
+        if not self.enabled:
+            return
+        with self.lock:
+            idx = self.count % self.capacity
+            self.count += 1
+        self.names[idx] = name
+        self.starts[idx] = start
+        self.ends[idx] = end
+        self.iters[idx] = self.iter_idx
+        self.threads[idx] = threading.get_ident()
+
+    def next_iter(self):
+        self.iter_idx += 1
+
+    def events(self) -> list[dict]:
+        num = min(self.count, self.capacity)
+        first = self.count - num
+        thread_ids = {}
+        events = []
+        for pos in range(first, self.count):
+            idx = pos % self.capacity
+            tid = thread_ids.setdefault(self.threads[idx], len(thread_ids))
+            events.append({
+                "name": self.names[idx],
+                "ph": "X",
+                "ts": self.starts[idx] * 1e6,
+                "dur": (self.ends[idx] - self.starts[idx]) * 1e6,
+                "pid": self.rank,
+                "tid": tid,
+                "args": {"iter": self.iters[idx]},
+            })
+        return events
+
+    def export(self, path: str, world_size: int = 1):
+        # collective: every rank must call export
+        if not self.enabled:
+            return
+        events = self.events()
+        if world_size > 1:
+            gathered = [None] * world_size if self.rank == 0 else None
+            dist.gather_object(events, object_gather_list=gathered, dst=0)
+            if self.rank != 0:
+                return
+            events = [event for rank_events in gathered for event in rank_events]
+        for rank in range(world_size):
+            events.append({"name": "process_name", "ph": "M", "pid": rank, "args": {"name": f"rank {rank}"}})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        print(f"trace of {world_size} ranks written to {path}")
@@ -1,4 +1,9 @@
-import torch, quiver, dgl
+from __future__ import annotations
+import torch, dgl
+try:
+    import quiver
+except ImportError: # quiver is only needed by mode 0 (and requires CUDA)
+    quiver = None
 from torch.nn.parallel import DistributedDataParallel as DDP
 import numpy as np
 from ogb.nodeproppred import DglNodePropPredDataset
@@ -7,6 +12,7 @@ import csv
 from dataclasses import dataclass
 from dgl import create_block
 import os
+from comm import allreduce_hook
 
 def partition_ids(rank: int, world_size: int, nids: torch.Tensor) -> torch.Tensor:
     step = int(nids.shape[0] / world_size)
@@ -15,6 +21,43 @@ def partition_ids(rank: int, world_size: int, nids: torch.Tensor) -> torch.Tenso
     loc_ids = nids[start_idx : end_idx]
     return loc_ids.to(rank)
 
+def device_synchronize(device: torch.device):
+    # torch.cuda.synchronize for cuda devices, no-op on cpu (all cpu ops are synchronous)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def ddp_wrap(model: torch.nn.Module, device: torch.device, comm_hook=allreduce_hook) -> DDP:
+    # comm_hook: the gradient allreduce, counted in comm.wire_stats (comm_bytes of every mode)
+    if device.type == 'cuda':
+        model = DDP(model, device_ids=[device.index], output_device=device.index)
+    else:
+        model = DDP(model)
+    model.register_comm_hook(None, comm_hook)
+    return model
+
+class DeviceEvent:
+    """Device-agnostic replacement for torch.cuda.Event(enable_timing=True).
+    Uses cuda events on gpu and wall clock time on cpu.
+    elapsed_time returns milliseconds like torch.cuda.Event.
+    """
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.event = None
+        self.timestamp = 0.0
+        if device.type == 'cuda':
+            self.event = torch.cuda.Event(enable_timing=True)
+
+    def record(self):
+        if self.event is not None:
+            self.event.record()
+        else:
+            self.timestamp = time.time()
+
+    def elapsed_time(self, end: DeviceEvent) -> float:
+        if self.event is not None:
+            return self.event.elapsed_time(end.event)
+        return (end.timestamp - self.timestamp) * 1000.0
+
 def print_model_weights(model: torch.nn.Module):
     for name, weight in model.named_parameters():
         if weight.requires_grad:
@@ -116,8 +159,10 @@ class QuiverDglSageSample():
                  nids:torch.Tensor, 
                  sampler: quiver.pyg.GraphSageSampler,
                  shuffle=True,
-                 partition=True):
+                 partition=True,
+                 assigner=None):
         self.rank = rank
+        self.assigner = assigner # BalancedAssigner: per-epoch load-balanced seeds instead of the contiguous partition
         if partition:
             self.nids = partition_ids(rank, world_size, nids)
         else:
@@ -131,7 +176,10 @@ class QuiverDglSageSample():
 
     def __iter__(self):
         self.cur_idx = 0
-        if self.shuffle:
+        if self.assigner is not None:
+            self.nids = self.assigner.next_epoch().to(self.rank)
+            self.max_idx = self.nids.shape[0]
+        elif self.shuffle:
             dim = 0
             idx = torch.randperm(self.nids.shape[dim]).to(self.rank)
             self.nids = self.nids[idx]
@@ -151,6 +199,12 @@ class TrainProfiler:
         self.path = filepath
         self.fields = ["epoch", "val_acc", "epoch_time", "forward", "backward", "feat", "sample", "other"]        
     
+    def restore(self, items: list[dict]):
+        # rows of the epochs before a resumed checkpoint
+        self.items = items
+        if len(items) > 0:
+            self.fields = list(items[-1].keys())
+
     def log_step_dict(self, item: dict):
         for k, v in item.items():
             if (type(v) == float):
@@ -165,8 +219,11 @@ class TrainProfiler:
                 forward: float,
                 backward: float,
                 feat: float,
-                sample: float) -> dict:
-        
+                sample: float,
+                overlap: float = None,
+                extra: dict = None) -> dict:
+        # overlap: part of feat + sample that ran in the background (prefetching)
+        # extra: additional columns appended to the row
         other = epoch_time - forward - backward - feat - sample
         item = {
             "epoch": epoch,
@@ -178,11 +235,17 @@ class TrainProfiler:
             "sample": sample,
             "other": other
         }
+        if overlap is not None:
+            item["other"] = other + overlap
+            item["overlap"] = overlap
+        if extra is not None:
+            item.update(extra)
 
         for k, v in item.items():
             if (type(v) == type(1.0)):
                 item[k] = round(v, 5)
         self.items.append(item)
+        self.fields = list(item.keys())
         return item
     
     def avg_epoch(self) -> float:
@@ -197,10 +260,17 @@ class TrainProfiler:
         return avg_epoch_time / epoch
     
     
+    def columns(self) -> list[str]:
+        # union of the keys of all the rows (some columns, e.g. acc_delta, are not in every row)
+        fields = list(self.fields)
+        for item in self.items:
+            fields += [key for key in item.keys() if key not in fields]
+        return fields
+
     def saveToDisk(self):
         print("AVERAGE EPOCH TIME: ", round(self.avg_epoch(), 4))
         with open(self.path, "w+") as file:
-            writer = csv.DictWriter(file, self.fields)
+            writer = csv.DictWriter(file, self.columns())
             writer.writeheader()
             for idx, item in enumerate(self.items):
                 if idx > 0:
@@ -218,7 +288,15 @@ class RunConfig:
     num_classes: int = -1 # output feature size
     batch_size: int = 1024
     total_epoch: int = 30
+    eval_batch_size: int = 4096 # validation minibatch size (no activations are kept, so it can be much larger)
+    eval_every: int = 1 # evaluate after every n-th epoch and after the last one (0: last epoch only)
+    eval_overlap: bool = True # sample the next validation batch in a background thread
+    inference: bool = False # after training, compute the outputs of all the nodes with layer-wise full-neighbor inference
+    infer_chunk_size: int = 16384 # destination nodes per layer-wise inference block
     save_every: int = 30
+    amp: bool = False # autocast (float16 + loss scaling on cuda, bfloat16 on cpu)
+    feat_dtype: str = "float32" # storage dtype of the features (float16 halves the bytes moved by the feature gather)
+    resume: bool = False # restart from the newest complete checkpoint in checkpt_dir()
     fanouts: list[int] = None
     log_dir: str = ""
     graph_name: str = "ogbn-arxiv"
@@ -227,14 +305,73 @@ class RunConfig:
     model: str = "sage" # model (sage or gat)
     num_heads: int = 3 # if use GAT, number of heads in the model
     mode: int = 1 # runner version
+    device: str = "cuda" # execution device (cuda or cpu)
+    backend: str = "nccl" # torch.distributed backend (nccl or gloo)
+    prefetch: bool = False # P3: sample and exchange the next batch in a background thread
+    prefetch_depth: int = 1 # number of batches prepared ahead (1: double buffering)
+    p2_transport: str = "all_to_all" # P2 feature exchange: all_to_all (one collective) or gather (one dist.gather per gpu)
+    packed_gather: bool = False # P3: move input nodes, src and dst edges with a single padded all_gather
+    comm_dtype: str = "float32" # P2 / P3 wire format of features, activations and gradients (float32, float16, bfloat16)
+    comm_row_scale: bool = False # scale every row by its max magnitude before casting to comm_dtype
+    shuffle_mode: str = "overlap" # P3 first-layer reduction: sync, overlap (async reduce per gpu) or reduce_scatter
+    fused_first_layer: bool = False # P3: run the first layer of all the gpus as one block-diagonal block
+    dedup_input: bool = False # P3: extract the local features of the union of all the gpus' input nodes once
+    seed_partition: str = "random" # train seed assignment: random (dgl ddp split) or locality (label propagation clusters)
+    balance_seeds: bool = False # deal every global batch's seeds to the ranks by expected top block size
+    straggler_report: bool = False # P3: per-rank wait at every collective, summarized per epoch in <log>_wait.csv
+    log_block_sizes: bool = False # P3: per-rank top block edges / nodes of every minibatch in <log>_blocks.csv
+    trace: bool = False # record a per-iteration span timeline, written as a chrome trace next to the log
+    sample_workers: int = 0 # sampler processes per gpu (0: sample in the trainer process)
+    sample_queue_depth: int = 4 # shared memory slots the sampler processes can fill ahead
+    feat_cache_ratio: float = 0.0 # P2 / P3: fraction of the local feature rows cached on the device (uva / cpu feature extraction)
+    feat_cache_policy: str = "degree" # degree / presample (static) or lru / lfu (dynamic)
     def uva_sample(self) -> bool:
         return self.topo == 'uva'
+
+    def use_cuda(self) -> bool:
+        return self.device == 'cuda'
+
+    def get_device(self) -> torch.device:
+        if self.use_cuda():
+            return torch.device(f"cuda:{self.rank}")
+        return torch.device("cpu")
     
     def uva_feat(self) -> bool:
         return self.feat == 'uva'
     
-    def set_logpath(self):
+    def aux_path(self, suffix: str) -> str:
+        # csv written next to the log, e.g. <log>_wait.csv
+        return os.path.splitext(self.log_path)[0] + f"_{suffix}.csv"
+
+    def checkpt_dir(self) -> str:
+        # shared / per-rank checkpoint files of the run
+        return os.path.splitext(self.log_path)[0] + "_ckpt"
+
+    def infer_dir(self) -> str:
+        # layer buffers of the layer-wise inference
+        return os.path.splitext(self.log_path)[0] + "_infer"
+
+    def trace_path(self) -> str:
+        return os.path.splitext(self.log_path)[0] + ".trace.json"
+
+    def precision_tag(self) -> str:
+        # empty for the full precision run
+        tag = "_amp" if self.amp else ""
+        if self.feat_dtype != "float32":
+            tag += f"_{self.feat_dtype}feat"
+        return tag
+
+    def _log_name(self) -> str:
         feat_setting = f"{self.feat.lower()}feat"
         topo_setting = f"{self.topo.lower()}topo"
-        self.log_path = os.path.join(self.log_dir, f"{self.graph_name}_v{self.mode}_w{self.world_size}_{feat_setting}_{topo_setting}_h{self.hid_feats}_b{self.batch_size}.csv")
+        return f"{self.graph_name}_v{self.mode}_w{self.world_size}_{feat_setting}_{topo_setting}_h{self.hid_feats}_b{self.batch_size}"
+
+    def baseline_log_path(self) -> str:
+        # log of the full precision run with the same settings (None for the full precision run itself)
+        if self.precision_tag() == "":
+            return None
+        return os.path.join(self.log_dir, self._log_name() + ".csv")
+
+    def set_logpath(self):
+        self.log_path = os.path.join(self.log_dir, self._log_name() + self.precision_tag() + ".csv")
 